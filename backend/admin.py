@@ -0,0 +1,74 @@
+"""
+Admin-only diagnostics: trace lookup, live profiling and LLM usage.
+
+All routes require the ``X-Admin-Token`` header to match ``ADMIN_TOKEN``.
+When ``ADMIN_TOKEN`` is not configured the routes answer 404 so they are
+effectively disabled.
+"""
+import hmac
+import os
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from executors import io_pool, runs_on
+from json_logging import get_logger
+from profiler import run_profile, ProfilerBusy, MAX_PROFILE_SECONDS
+from tracing import get_trace
+from usage_ledger import usage_ledger, usage_day
+
+logger = get_logger(__name__)
+
+
+def require_admin(x_admin_token: str = Header(default="")):
+    expected = os.getenv("ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(x_admin_token.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+admin_router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@admin_router.get("/traces/{request_id}")
+def get_request_trace(request_id: str):
+    """Spans recorded for one request (use the X-Request-ID response header)"""
+    spans = get_trace(request_id)
+    if spans is None:
+        raise HTTPException(status_code=404, detail="Trace not found (unknown or evicted)")
+    return {"request_id": request_id, "spans": spans}
+
+
+@admin_router.get("/profile")
+async def profile(
+    seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS, description="Sampling duration"),
+    mode: str = Query("wall", pattern="^(wall|cpu)$", description="wall includes blocked time, cpu only on-CPU time"),
+    interval_ms: float = Query(5, ge=1, le=1000, description="Sampling interval"),
+    memory: bool = Query(False, description="Also diff tracemalloc snapshots over the window"),
+    format: str = Query("folded", pattern="^(folded|json)$", description="folded = flamegraph.pl input"),
+):
+    """Sample the live process and return flamegraph-compatible folded stacks"""
+    logger.info("Starting profile", extra={"seconds": seconds, "mode": mode, "memory": memory})
+    try:
+        # Sampling mostly sleeps between samples, so it waits on the io pool like other blocking calls
+        result = await io_pool.run(run_profile, seconds, mode=mode, interval=interval_ms / 1000, memory=memory)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if format == "folded":
+        return PlainTextResponse(result["folded"] + "\n")
+    return result
+
+
+@admin_router.get("/usage")
+@runs_on(io_pool)
+def llm_usage(
+    day: str = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$", description="UTC day, default today"),
+    group_by: str = Query("endpoint", pattern="^(endpoint|user|model|purpose|cache)$"),
+):
+    """LLM calls, tokens and estimated cost for one day, grouped, most expensive first"""
+    day = day or usage_day()
+    return {"day": day, "group_by": group_by, "budget": usage_ledger.snapshot(),
+            "rows": usage_ledger.report(day, group_by)}
@@ -0,0 +1,304 @@
+"""
+Admission control: per-client quotas and bounded queues for expensive work.
+
+Every request has a cost in work units (``ROUTE_COSTS``, longest prefix
+wins). A summary costs 10, a listing 1, a status poll nothing. Before the
+endpoint runs, the request must pass three checks:
+
+* the client's rate quota: a token bucket of ``ADMISSION_CLIENT_RATE`` units
+  per minute, bursting to ``ADMISSION_CLIENT_BURST``. Over it: ``429``;
+* the client's concurrency quota: at most ``ADMISSION_CLIENT_CONCURRENCY``
+  units in flight. Over it: ``429``;
+* the server's capacity: at most ``ADMISSION_CAPACITY`` units in flight for
+  everyone. When full, requests wait in a FIFO queue of at most
+  ``ADMISSION_QUEUE_SIZE`` for up to ``ADMISSION_QUEUE_TIMEOUT`` seconds
+  (and never past the request deadline). A full queue or a wait that runs
+  out answers ``503``.
+
+Every rejection carries ``Retry-After``. Clients are identified by their
+``X-API-Key`` header (or bearer token) when the key is known, i.e. listed
+in ``ADMISSION_API_KEYS`` or ``ADMISSION_KEY_QUOTAS``, else by IP address:
+an unknown key must not buy a fresh quota. Requests forwarded by a cluster
+peer (carrying ``CLUSTER_SECRET``) were admitted there and pass through.
+``ADMISSION_KEY_QUOTAS`` can give known keys their own limits, e.g.
+``{"<key>": {"rate": 600, "burst": 120, "concurrency": 60}}``.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+
+from starlette.responses import JSONResponse
+
+from cluster import cluster
+from deadline import current_deadline
+from json_logging import get_logger
+from metrics import Counter, Gauge
+
+logger = get_logger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_CAPACITY = float(os.getenv("ADMISSION_CAPACITY", "64"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+ADMISSION_CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "120"))  # units per minute
+ADMISSION_CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "60"))
+ADMISSION_CLIENT_CONCURRENCY = float(os.getenv("ADMISSION_CLIENT_CONCURRENCY", "24"))
+ADMISSION_KEY_QUOTAS = json.loads(os.getenv("ADMISSION_KEY_QUOTAS", "{}"))
+# Keys that identify a client (with the default quotas unless ADMISSION_KEY_QUOTAS has their own)
+ADMISSION_API_KEYS = {key.strip() for key in os.getenv("ADMISSION_API_KEYS", "").split(",") if key.strip()}
+ADMISSION_TRUST_PROXY = os.getenv("ADMISSION_TRUST_PROXY", "0") == "1"
+# Clients remembered for their quotas; the least recently seen are forgotten first
+ADMISSION_MAX_CLIENTS = 10000
+
+# Work units per request, longest-prefix match on the path
+ROUTE_COSTS = {
+    "/summarize": 10,
+    "/summarize/status/": 0,
+    "/upload-pdf": 10,
+    "/api/create_rag_session": 8,
+    "/api/chat_with_rag": 3,
+    "/api/rag_progress/": 0,
+    "/api/corpus/chat": 3,
+    "/api/corpus/": 1,
+    "/api/bulk/jobs": 20,
+    "/api/bulk/jobs/": 0,
+    "/api/internal/": 0,
+    "/arxiv/": 1,
+    "/papers/": 1,
+    "/admin/": 1,
+}
+DEFAULT_COST = 1
+FREE_PATHS = {"/", "/health", "/ready", "/metrics"}
+
+ADMISSION_REJECTED = Counter(
+    "botchana_admission_rejected_total",
+    "Requests turned away by admission control",
+    ["reason"],
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "botchana_admission_queue_depth",
+    "Requests waiting for server capacity",
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "botchana_admission_units_in_flight",
+    "Work units of admitted requests still running",
+)
+
+
+def cost_for(method, path):
+    if method in ("OPTIONS", "HEAD") or path in FREE_PATHS:
+        return 0
+    best, best_len = DEFAULT_COST, -1
+    for prefix, cost in ROUTE_COSTS.items():
+        if path.startswith(prefix) and len(prefix) > best_len:
+            best, best_len = cost, len(prefix)
+    return best
+
+
+def _headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+
+
+def known_key(key):
+    return bool(key) and (key in ADMISSION_API_KEYS or key in ADMISSION_KEY_QUOTAS)
+
+
+def client_id(scope):
+    """``key:<hash>`` for clients with a known API key, ``ip:<address>`` otherwise; also returns the key"""
+    headers = _headers(scope)
+    key = headers.get("x-api-key")
+    if not key and headers.get("authorization", "").lower().startswith("bearer "):
+        key = headers["authorization"][7:].strip()
+    if known_key(key):
+        return "key:" + hashlib.sha256(key.encode()).hexdigest()[:16], key
+    if ADMISSION_TRUST_PROXY and headers.get("x-forwarded-for"):
+        return "ip:" + headers["x-forwarded-for"].split(",")[0].strip(), None
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown"), None
+
+
+def authenticated_user(scope):
+    """Client id of a request with a known API key, else None (an IP address is no identity)"""
+    client, key = client_id(scope)
+    return client if key else None
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after, detail):
+        super().__init__(detail)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.detail = detail
+
+
+@dataclass
+class _Client:
+    rate: float  # units per second
+    burst: float
+    concurrency: float
+    tokens: float
+    updated: float
+    in_flight: float = 0.0
+
+
+class AdmissionController:
+    def __init__(self, capacity=ADMISSION_CAPACITY, queue_size=ADMISSION_QUEUE_SIZE, queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+                 client_rate=ADMISSION_CLIENT_RATE, client_burst=ADMISSION_CLIENT_BURST,
+                 client_concurrency=ADMISSION_CLIENT_CONCURRENCY, key_quotas=ADMISSION_KEY_QUOTAS, clock=time.monotonic):
+        self.capacity = capacity
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.client_concurrency = client_concurrency
+        self.key_quotas = key_quotas
+        self._clock = clock
+        self._clients = OrderedDict()
+        self._in_flight = 0.0
+        self._waiters = deque()  # (cost, future), FIFO
+
+    def _client(self, client, api_key):
+        state = self._clients.get(client)
+        now = self._clock()
+        if state is None:
+            quota = self.key_quotas.get(api_key, {}) if api_key else {}
+            burst = float(quota.get("burst", self.client_burst))
+            state = self._clients[client] = _Client(
+                rate=float(quota.get("rate", self.client_rate)) / 60.0,
+                burst=burst,
+                concurrency=float(quota.get("concurrency", self.client_concurrency)),
+                tokens=burst,
+                updated=now,
+            )
+            while len(self._clients) > ADMISSION_MAX_CLIENTS:
+                oldest, oldest_state = next(iter(self._clients.items()))
+                if oldest_state.in_flight:
+                    self._clients.move_to_end(oldest)
+                    break
+                self._clients.popitem(last=False)
+        else:
+            state.tokens = min(state.burst, state.tokens + (now - state.updated) * state.rate)
+            state.updated = now
+            self._clients.move_to_end(client)
+        return state
+
+    async def acquire(self, client, cost, api_key=None):
+        """Admit ``cost`` units for ``client`` or raise ``Rejected``; pair with ``release``"""
+        state = self._client(client, api_key)
+        # A request dearer than the whole burst would never pass otherwise
+        charge = min(cost, state.burst)
+        if state.tokens < charge:
+            ADMISSION_REJECTED.inc(reason="client_rate")
+            wait = (charge - state.tokens) / state.rate if state.rate > 0 else 60
+            raise Rejected(429, "client_rate", wait, "Rate limit exceeded for this client")
+        if state.in_flight and state.in_flight + cost > state.concurrency:
+            ADMISSION_REJECTED.inc(reason="client_concurrency")
+            raise Rejected(429, "client_concurrency", 1, "Too many requests in progress for this client")
+        state.tokens -= charge
+        state.in_flight += cost
+        try:
+            await self._reserve(cost)
+        except BaseException:
+            state.in_flight -= cost
+            state.tokens = min(state.burst, state.tokens + charge)  # not served, not charged
+            raise
+
+    async def _reserve(self, cost):
+        # Never deadlock on a request larger than the whole server
+        cost = min(cost, self.capacity)
+        if not self._waiters and self._in_flight + cost <= self.capacity:
+            self._in_flight += cost
+            ADMISSION_IN_FLIGHT.set(self._in_flight)
+            return
+        if len(self._waiters) >= self.queue_size:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise Rejected(503, "queue_full", self.queue_timeout, "Server is at capacity, try again later")
+        deadline = current_deadline()
+        timeout = self.queue_timeout if deadline is None else min(self.queue_timeout, deadline.remaining())
+        waiter = (cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter[1]), timeout=max(0.0, timeout))
+        except asyncio.TimeoutError:
+            if waiter[1].done() and not waiter[1].cancelled():
+                return  # admitted just as we gave up
+            waiter[1].cancel()
+            ADMISSION_REJECTED.inc(reason="queue_timeout")
+            raise Rejected(503, "queue_timeout", self.queue_timeout, "Server is at capacity, try again later")
+        except BaseException:
+            if waiter[1].done() and not waiter[1].cancelled():
+                self._release_capacity(cost)  # admitted, but the request went away
+            else:
+                waiter[1].cancel()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def release(self, client, cost):
+        state = self._clients.get(client)
+        if state is not None:
+            state.in_flight = max(0.0, state.in_flight - cost)
+        self._release_capacity(min(cost, self.capacity))
+
+    def _release_capacity(self, cost):
+        self._in_flight = max(0.0, self._in_flight - cost)
+        while self._waiters:
+            waiter_cost, future = self._waiters[0]
+            if future.cancelled():
+                self._waiters.popleft()
+                continue
+            if self._in_flight + waiter_cost > self.capacity:
+                break
+            self._waiters.popleft()
+            self._in_flight += waiter_cost
+            future.set_result(True)
+        ADMISSION_IN_FLIGHT.set(self._in_flight)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def snapshot(self):
+        return {"units_in_flight": self._in_flight, "capacity": self.capacity, "queued": len(self._waiters),
+                "clients": len(self._clients)}
+
+
+admission_controller = AdmissionController()
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware, so admitted work stays counted until a streamed response has finished."""
+
+    def __init__(self, app, controller=None):
+        self.app = app
+        self.controller = controller or admission_controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        cost = cost_for(scope["method"], scope["path"])
+        if cost and cluster.is_internal(_headers(scope)):
+            cost = 0  # forwarded by a peer that already admitted it, or a session hand-off
+        if not cost:
+            await self.app(scope, receive, send)
+            return
+        client, api_key = client_id(scope)
+        try:
+            await self.controller.acquire(client, cost, api_key)
+        except Rejected as e:
+            logger.warning(f"Rejected {scope['method']} {scope['path']} from {client}: {e.reason}")
+            response = JSONResponse(status_code=e.status, content={"detail": e.detail, "reason": e.reason},
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(client, cost)
@@ -0,0 +1,140 @@
+"""
+Semantic answer cache for paper chat.
+
+Answers are stored per paper (content hash of its chunks) together with an
+embedding of the question. A later question about the same paper is served
+from the cache when its embedding is close enough to a stored one, so
+"What is the main contribution?" and "what's the paper's main contribution"
+share one LLM answer.
+
+Bounded in three ways: entries expire after ``ttl`` seconds, each paper
+keeps at most ``max_per_paper`` answers, and the least recently used papers
+are evicted past ``max_papers``.
+
+A semantic match also has to mention the same numbers: one differing token
+in a long question ("... in table 2" / "... in table 3") barely moves the
+cosine, but it asks about something else.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from embeddings import cosine, embed, normalize, numbers
+from metrics import CACHE_EVENTS, Gauge, Histogram
+
+ANSWER_CACHE_ENTRIES = Gauge(
+    "botchana_answer_cache_entries",
+    "Answers held in the semantic answer cache",
+)
+ANSWER_CACHE_SIMILARITY = Histogram(
+    "botchana_answer_cache_similarity",
+    "Best question similarity found on each lookup",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99, 1.0),
+)
+
+
+def content_hash(chunks):
+    """Stable identity of a paper's text, independent of the session it was uploaded in"""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class _Entry:
+    question: str
+    vector: dict
+    answer: dict
+    created: float
+    numbers: frozenset = frozenset()
+    hits: int = 0
+
+
+class AnswerCache:
+    def __init__(self, threshold=None, ttl=None, max_papers=None, max_per_paper=None, clock=time.monotonic):
+        self.threshold = threshold or float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.85"))
+        self.ttl = ttl or float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+        self.max_papers = max_papers or int(os.getenv("ANSWER_CACHE_MAX_PAPERS", "1000"))
+        self.max_per_paper = max_per_paper or int(os.getenv("ANSWER_CACHE_MAX_PER_PAPER", "50"))
+        self._clock = clock
+        self._papers = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _live_entries(self, key, now):
+        entries = self._papers.get(key)
+        if entries is None:
+            return None
+        fresh = [entry for entry in entries if now - entry.created < self.ttl]
+        self._size -= len(entries) - len(fresh)
+        self._papers[key] = fresh
+        return fresh
+
+    def get(self, paper_hash, question, mode="two_pass"):
+        """Cached answer for a question close enough to ``question``, or None."""
+        key = (paper_hash, mode)
+        normalized = normalize(question)
+        vector = embed(question)
+        mentioned = numbers(question)
+        with self._lock:
+            entries = self._live_entries(key, self._clock())
+            best, best_score = None, 0.0
+            for entry in entries or ():
+                if entry.question == normalized:
+                    best, best_score = entry, 1.0
+                    break
+                if entry.numbers != mentioned:
+                    continue
+                score = cosine(vector, entry.vector)
+                if score > best_score:
+                    best, best_score = entry, score
+            if entries is not None:
+                self._papers.move_to_end(key)
+            ANSWER_CACHE_ENTRIES.set(self._size)
+            if best is None or best_score < self.threshold:
+                if entries:
+                    ANSWER_CACHE_SIMILARITY.observe(best_score)
+                CACHE_EVENTS.inc(cache="answer", result="miss")
+                return None
+            best.hits += 1
+        ANSWER_CACHE_SIMILARITY.observe(best_score)
+        CACHE_EVENTS.inc(cache="answer", result="hit")
+        return dict(best.answer, similarity=round(best_score, 3))
+
+    def put(self, paper_hash, question, answer, mode="two_pass"):
+        key = (paper_hash, mode)
+        now = self._clock()
+        entry = _Entry(normalize(question), embed(question), dict(answer), now, numbers(question))
+        with self._lock:
+            entries = self._live_entries(key, now)
+            if entries is None:
+                entries = self._papers[key] = []
+            entries = [e for e in entries if e.question != entry.question]
+            entries.append(entry)
+            while len(entries) > self.max_per_paper:
+                # Evict the older answer that has earned its place least: fewest hits, then oldest
+                entries.remove(min(entries[:-1], key=lambda e: (e.hits, e.created)))
+            self._size += len(entries) - len(self._papers[key])
+            self._papers[key] = entries
+            self._papers.move_to_end(key)
+            while len(self._papers) > self.max_papers:
+                _, evicted = self._papers.popitem(last=False)
+                self._size -= len(evicted)
+            ANSWER_CACHE_ENTRIES.set(self._size)
+
+    def invalidate(self, paper_hash):
+        with self._lock:
+            for key in [key for key in self._papers if key[0] == paper_hash]:
+                self._size -= len(self._papers.pop(key))
+            ANSWER_CACHE_ENTRIES.set(self._size)
+
+    def __len__(self):
+        return self._size
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,28 @@
+"""
+Canonical arXiv identifiers.
+
+arXiv ids reach us as entry ids (``http://arxiv.org/abs/2101.00001v2``),
+PDF links (``https://arxiv.org/pdf/2101.00001v2.pdf``), bare ids with or
+without a version and old-style ids (``hep-th/9901001v1``). Everything that
+stores or caches a paper keys it by the canonical id, without the version.
+"""
+import re
+
+_ARXIV_ID = re.compile(
+    r"(?P<id>\d{4}\.\d{4,5}|[a-z][a-z\-]*(?:\.[A-Z]{2})?/\d{7})(?:v(?P<version>\d+))?(?:\.pdf)?/?$"
+)
+
+
+def parse_arxiv_id(value):
+    """(canonical id, version or None) for anything that ends in an arXiv id, else (None, None)"""
+    if not value:
+        return None, None
+    match = _ARXIV_ID.search(value.strip())
+    if not match:
+        return None, None
+    version = match.group("version")
+    return match.group("id"), int(version) if version else None
+
+
+def canonical_arxiv_id(value):
+    return parse_arxiv_id(value)[0]
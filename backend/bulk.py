@@ -0,0 +1,65 @@
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from bulk_jobs import bulk_jobs, BULK_MAX_ITEMS
+from deadline import RequestAborted
+from json_logging import get_logger
+from service import fetch_arxiv_entries
+
+logger = get_logger(__name__)
+
+bulk_router = APIRouter()
+
+# สรุป paper ทีละหลายเรื่อง (reading list) เป็น job เบื้องหลัง แล้ว poll ดูสถานะ
+
+class BulkJobRequest(BaseModel):
+    ids: Optional[List[str]] = None
+    query: Optional[str] = None
+    category: Optional[str] = None
+    max_results: int = 50
+
+def _search_query(request):
+    parts = []
+    if request.query:
+        parts.append(f"all:{request.query}")
+    if request.category:
+        parts.append(f"cat:{request.category}")
+    return " AND ".join(parts)
+
+@bulk_router.post("/jobs")
+def create_bulk_job(request: BulkJobRequest):
+    """Start summarizing a list of arXiv ids, or the results of a query and/or category"""
+    search_query = _search_query(request)
+    if not request.ids and not search_query:
+        raise HTTPException(status_code=400, detail="Give ids, or a query and/or category")
+    if request.ids and len(request.ids) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} papers per job")
+    try:
+        entries = fetch_arxiv_entries(ids=request.ids, search_query=search_query,
+                                      max_results=max(1, min(request.max_results, BULK_MAX_ITEMS)))
+    except RequestAborted:
+        raise
+    except Exception as e:
+        logger.error(f"Bulk job lookup failed: {e}")
+        return JSONResponse(status_code=502, content={"error": "Failed to connect to ArXiv. Please try again later."})
+    if not entries:
+        raise HTTPException(status_code=404, detail="No papers found for this job")
+    status = bulk_jobs.create(entries, request.model_dump())
+    logger.info(f"Bulk job {status['job_id']} started with {status['total']} papers")
+    return JSONResponse(status_code=202, content=status)
+
+@bulk_router.get("/jobs/{job_id}")
+def bulk_job_status(job_id: str, items: bool = Query(True, description="รวมสถานะและ summary ของแต่ละ paper")):
+    status = bulk_jobs.status(job_id, include_items=items)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@bulk_router.delete("/jobs/{job_id}")
+def cancel_bulk_job(job_id: str):
+    if not bulk_jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="No running job with this id")
+    return bulk_jobs.status(job_id, include_items=False)
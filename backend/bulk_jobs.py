@@ -0,0 +1,428 @@
+"""
+Bulk summarization jobs for reading lists.
+
+A job is a list of arXiv papers (explicit ids or a search) that all go
+through one staged pipeline shared by every job:
+
+    download (BULK_DOWNLOAD_WORKERS threads, network bound)
+      -> extract (BULK_EXTRACT_WORKERS threads, CPU bound)
+      -> summarize (BULK_LLM_WORKERS threads, paced by the LLM gateway)
+
+The stages are connected by bounded queues (``BULK_QUEUE_SIZE``), so they
+work on different papers at the same time, and a slow stage holds the
+earlier ones back instead of piling PDFs up in memory.
+
+Each item's state is checkpointed in SQLite (``BULK_JOBS_PATH``) after every
+stage, including the extracted text, so a job interrupted by a restart
+resumes where it stopped: extracted papers go straight to the LLM and
+only unfinished downloads are repeated. Papers that already have a current
+full summary are answered from the ``papers`` table without any work.
+Extracted papers are also chunked into the upload store, so RAG sessions on
+them start without a download.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import llm_gateway
+from answer_cache import content_hash
+from arxiv_ids import parse_arxiv_id
+from corpus_index import corpus_index
+from document import document_for_url
+from json_logging import get_logger
+from metrics import Counter, Gauge
+from paper_repository import paper_repository
+from paper_versions import paper_versions
+from upload_store import upload_store
+from service import (
+    arxiv_pdf_link, fetch_arxiv_pdf, parse_arxiv_pdf, make_bibtex, stored_full_summary, record_version,
+    near_duplicate, remember_summary, summarize_text_with_gpt, FALLBACK_PREFIX, FULL_TIER,
+)
+
+logger = get_logger(__name__)
+
+BULK_JOBS_PATH = os.getenv("BULK_JOBS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bulk_jobs.sqlite"))
+BULK_DOWNLOAD_WORKERS = int(os.getenv("BULK_DOWNLOAD_WORKERS", "4"))
+BULK_EXTRACT_WORKERS = int(os.getenv("BULK_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+BULK_LLM_WORKERS = int(os.getenv("BULK_LLM_WORKERS", "4"))
+BULK_QUEUE_SIZE = int(os.getenv("BULK_QUEUE_SIZE", "4"))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "200"))
+# Usage-ledger purpose of summaries made for off-peak precompute jobs (``"precompute": true`` in the request)
+PRECOMPUTE_PURPOSE = "precompute"
+
+# Item states; the last four are final
+QUEUED, DOWNLOADING, EXTRACTING, EXTRACTED, SUMMARIZING = "queued", "downloading", "extracting", "extracted", "summarizing"
+DONE, STORED, FAILED, CANCELLED = "done", "stored", "failed", "cancelled"
+FINAL_STATES = (DONE, STORED, FAILED, CANCELLED)
+
+BULK_ITEMS = Counter(
+    "botchana_bulk_items_total",
+    "Bulk job items finished, by outcome",
+    ["result"],
+)
+BULK_QUEUE_DEPTH = Gauge(
+    "botchana_bulk_queue_depth",
+    "Items waiting in front of each bulk pipeline stage",
+    ["stage"],
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    request TEXT NOT NULL,
+    created_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    ordinal INTEGER NOT NULL,
+    arxiv_id TEXT,
+    entry TEXT NOT NULL,
+    status TEXT NOT NULL,
+    text TEXT,
+    summary TEXT,
+    error TEXT,
+    download_seconds REAL,
+    extract_seconds REAL,
+    llm_seconds REAL,
+    updated_at REAL,
+    PRIMARY KEY (job_id, ordinal)
+);
+"""
+
+
+def entry_record(entry):
+    """What the pipeline needs from an Atom entry, as a JSON-able dict (kept in the checkpoint)"""
+    arxiv_id, version = parse_arxiv_id(entry.id)
+    pdf_link, _ = arxiv_pdf_link(entry)
+    return {
+        "id": entry.id,
+        "arxiv_id": arxiv_id,
+        "version": version,
+        "title": " ".join(entry.title.split()),
+        "authors": ", ".join(author.name for author in entry.authors) if hasattr(entry, "authors") else "Unknown",
+        "published": entry.get("published", "Unknown"),
+        "pdf_link": pdf_link,
+        "bibtex": make_bibtex(entry),
+    }
+
+
+class BulkJobStore:
+    def __init__(self, path=BULK_JOBS_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    init = sqlite3.connect(self.path)
+                    init.execute("PRAGMA journal_mode=WAL")
+                    init.executescript(_SCHEMA)
+                    init.close()
+                    self._initialized = True
+        conn = self._local.conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, request, records):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT INTO jobs (job_id, status, request, created_at) VALUES (?, 'running', ?, ?)",
+                         (job_id, json.dumps(request), now))
+            conn.executemany(
+                "INSERT INTO items (job_id, ordinal, arxiv_id, entry, status, summary, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(job_id, ordinal, record["arxiv_id"], json.dumps(record), STORED if summary else QUEUED, summary, now)
+                 for ordinal, (record, summary) in enumerate(records)],
+            )
+        return job_id
+
+    def update_item(self, job_id, ordinal, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        conn = self._conn()
+        with conn:
+            # A cancelled item stays cancelled even if a stage was still working on it
+            conn.execute(f"UPDATE items SET {assignments} WHERE job_id = ? AND ordinal = ? AND status != 'cancelled'",
+                         (*fields.values(), job_id, ordinal))
+
+    def finish_item(self, job_id, ordinal, status, **fields):
+        """Final state for one item (drops the text checkpoint); closes the job when it was the last one"""
+        self.update_item(job_id, ordinal, status=status, text=None, **fields)
+        BULK_ITEMS.inc(result=status)
+        self.close_if_complete(job_id)
+
+    def close_if_complete(self, job_id):
+        """Mark the job done once every item is final; returns whether it is"""
+        conn = self._conn()
+        with conn:
+            open_items = conn.execute(
+                f"SELECT COUNT(*) FROM items WHERE job_id = ? AND status NOT IN ({','.join('?' * len(FINAL_STATES))})",
+                (job_id, *FINAL_STATES),
+            ).fetchone()[0]
+            if not open_items:
+                conn.execute("UPDATE jobs SET status = 'done', finished_at = ? WHERE job_id = ? AND status = 'running'",
+                             (time.time(), job_id))
+        return not open_items
+
+    def cancel(self, job_id):
+        conn = self._conn()
+        with conn:
+            updated = conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'running'",
+                                   (time.time(), job_id)).rowcount
+            conn.execute(
+                f"UPDATE items SET status = 'cancelled', text = NULL WHERE job_id = ? AND status NOT IN ({','.join('?' * len(FINAL_STATES))})",
+                (job_id, *FINAL_STATES),
+            )
+        return bool(updated)
+
+    def job(self, job_id):
+        row = self._conn().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def job_status(self, job_id):
+        row = self._conn().execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def running_jobs(self):
+        return [row[0] for row in self._conn().execute("SELECT job_id FROM jobs WHERE status = 'running' ORDER BY created_at")]
+
+    def items(self, job_id, statuses=None):
+        sql, params = "SELECT * FROM items WHERE job_id = ?", [job_id]
+        if statuses:
+            sql += f" AND status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        return [dict(row) for row in self._conn().execute(sql + " ORDER BY ordinal", params)]
+
+
+class BulkPipeline:
+    def __init__(self, store, download_workers=BULK_DOWNLOAD_WORKERS, extract_workers=BULK_EXTRACT_WORKERS,
+                 llm_workers=BULK_LLM_WORKERS, queue_size=BULK_QUEUE_SIZE):
+        self.store = store
+        self._stages = [
+            ("download", queue.Queue(maxsize=queue_size), download_workers, self._download),
+            ("extract", queue.Queue(maxsize=queue_size), extract_workers, self._extract),
+            ("summarize", queue.Queue(maxsize=queue_size), llm_workers, self._summarize),
+        ]
+        self._downloads, self._extracts, self._summaries = (stage[1] for stage in self._stages)
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            for name, source, workers, handler in self._stages:
+                for number in range(max(1, workers)):
+                    threading.Thread(target=self._work, args=(name, source, handler),
+                                     name=f"bulk-{name}-{number}", daemon=True).start()
+            self._started = True
+
+    def _put(self, stage, target, item):
+        target.put(item)  # blocks while the next stage is behind
+        BULK_QUEUE_DEPTH.set(target.qsize(), stage=stage)
+
+    def submit(self, job_id):
+        """Feed a job's unfinished items into the pipeline (also used to resume after a restart)"""
+        self._ensure_started()
+        threading.Thread(target=self._feed, args=(job_id,), name=f"bulk-feed-{job_id[:8]}", daemon=True).start()
+
+    def _feed(self, job_id):
+        items = self.store.items(job_id, [QUEUED, DOWNLOADING, EXTRACTING, EXTRACTED, SUMMARIZING])
+        # Checkpointed text skips straight to the LLM stage
+        for item in sorted(items, key=lambda item: item["status"] not in (EXTRACTED, SUMMARIZING)):
+            if self.store.job_status(job_id) != "running":
+                return
+            record = json.loads(item["entry"])
+            if item["status"] in (EXTRACTED, SUMMARIZING) and item["text"]:
+                self._put("summarize", self._summaries, (job_id, item["ordinal"], (record, item["text"])))
+            else:
+                self._put("download", self._downloads, (job_id, item["ordinal"], record))
+
+    def _work(self, stage, source, handler):
+        while True:
+            job_id, ordinal, payload = source.get()
+            BULK_QUEUE_DEPTH.set(source.qsize(), stage=stage)
+            if self.store.job_status(job_id) != "running":
+                continue
+            try:
+                handler(job_id, ordinal, payload)
+            except Exception as e:
+                logger.error(f"Bulk job {job_id} item {ordinal} failed in {stage}: {e}")
+                try:
+                    self.store.finish_item(job_id, ordinal, FAILED, error=f"{stage}: {e}")
+                except Exception as store_error:
+                    logger.error(f"Could not record bulk item failure: {store_error}")
+
+    def _download(self, job_id, ordinal, record):
+        self.store.update_item(job_id, ordinal, status=DOWNLOADING)
+        started = time.perf_counter()
+        # Warmed by a listing prefetch or an earlier request: nothing to download or extract
+        document = document_for_url(record["pdf_link"]) if record["pdf_link"] else None
+        pdf_data = None
+        if document is None:
+            pdf_data = fetch_arxiv_pdf(record["pdf_link"], record["id"]) if record["pdf_link"] else None
+            if pdf_data is None:
+                raise ValueError("PDF could not be downloaded")
+        self.store.update_item(job_id, ordinal, download_seconds=time.perf_counter() - started)
+        self._put("extract", self._extracts, (job_id, ordinal, (record, pdf_data, document)))
+
+    def _extract(self, job_id, ordinal, payload):
+        record, pdf_data, document = payload
+        self.store.update_item(job_id, ordinal, status=EXTRACTING)
+        started = time.perf_counter()
+        arxiv_id, version = record["arxiv_id"], record["version"]
+        stored_summary, current = stored_full_summary(arxiv_id, version)
+        if current:
+            # Summarized elsewhere since the job was created
+            self.store.finish_item(job_id, ordinal, STORED, summary=stored_summary)
+            return
+        previous = paper_versions.get(arxiv_id)
+        if document is None:
+            document = parse_arxiv_pdf(pdf_data, record["pdf_link"], previous.known_pages() if previous else None)
+            if document is None:
+                raise ValueError("No text could be extracted from the PDF")
+        text = document.text.strip()
+        corpus_index.submit(f"arxiv:{arxiv_id}", text=text, title=record["title"], url=record["pdf_link"], source="arxiv")
+        # Ready for RAG sessions on this paper, without a download
+        chunks = document.chunk_texts
+        upload_store.put_chunks(document.doc_id, chunks, content_hash(chunks), record["title"])
+        upload_store.put_url(record["pdf_link"], document.doc_id)
+        kept = record_version(arxiv_id, version, previous, document, stored_summary)
+        elapsed = time.perf_counter() - started
+        if kept:
+            self.store.finish_item(job_id, ordinal, STORED, summary=kept, extract_seconds=elapsed)
+            return
+        _, duplicate = near_duplicate(f"arxiv:{arxiv_id}", text)
+        if duplicate is not None:
+            logger.info(f"{arxiv_id} is a near-duplicate of {duplicate.key}, reusing its summary")
+            self._save(record, duplicate.summary)
+            self.store.finish_item(job_id, ordinal, STORED, summary=duplicate.summary, extract_seconds=elapsed)
+            return
+        self.store.update_item(job_id, ordinal, status=EXTRACTED, text=text, extract_seconds=elapsed)
+        self._put("summarize", self._summaries, (job_id, ordinal, (record, text)))
+
+    def _summarize(self, job_id, ordinal, payload):
+        record, text = payload
+        self.store.update_item(job_id, ordinal, status=SUMMARIZING)
+        started = time.perf_counter()
+        summary = summarize_text_with_gpt(text, priority=llm_gateway.BACKGROUND, purpose=self._purpose(job_id))
+        elapsed = time.perf_counter() - started
+        if summary.startswith(FALLBACK_PREFIX):
+            self.store.finish_item(job_id, ordinal, FAILED, error="summarize: LLM unavailable", llm_seconds=elapsed)
+            return
+        self._save(record, summary)
+        remember_summary(f"arxiv:{record['arxiv_id']}", text, summary)
+        self.store.finish_item(job_id, ordinal, DONE, summary=summary, llm_seconds=elapsed)
+
+    def _purpose(self, job_id):
+        job = self.store.job(job_id)
+        return PRECOMPUTE_PURPOSE if job and json.loads(job["request"]).get("precompute") else "summary"
+
+    def _save(self, record, summary):
+        try:
+            paper_repository.save_summary({**record, "summary": summary, "summary_tier": FULL_TIER})
+        except Exception as db_error:
+            logger.warning(f"Failed to save bulk summary for {record['arxiv_id']}: {db_error}")
+
+
+def _mean(values):
+    values = [value for value in values if value is not None]
+    return round(sum(values) / len(values), 3) if values else None
+
+
+class BulkJobs:
+    def __init__(self, store=None, pipeline=None):
+        self.store = store or BulkJobStore()
+        self.pipeline = pipeline or BulkPipeline(self.store)
+
+    def create(self, entries, request):
+        """Start a job for Atom entries; papers with a current full summary are answered immediately"""
+        records = [entry_record(entry) for entry in entries[:BULK_MAX_ITEMS]]
+        stored = paper_repository.get_many(record["arxiv_id"] for record in records)
+        with_summaries = []
+        for record in records:
+            summary = None
+            if record["arxiv_id"] in stored:
+                summary, current = stored_full_summary(record["arxiv_id"], record["version"])
+                summary = summary if current else None
+            with_summaries.append((record, summary))
+        job_id = self.store.create(request, with_summaries)
+        BULK_ITEMS.inc(sum(1 for _, summary in with_summaries if summary), result=STORED)
+        if not self.store.close_if_complete(job_id):
+            self.pipeline.submit(job_id)
+        return self.status(job_id)
+
+    def cancel(self, job_id):
+        return self.store.cancel(job_id)
+
+    def resume(self):
+        """Restart jobs interrupted by a restart"""
+        try:
+            job_ids = self.store.running_jobs()
+        except Exception as e:
+            logger.warning(f"Could not read bulk jobs to resume: {e}")
+            return []
+        for job_id in job_ids:
+            logger.info(f"Resuming bulk job {job_id}")
+            self.pipeline.submit(job_id)
+        return job_ids
+
+    def status(self, job_id, include_items=True):
+        job = self.store.job(job_id)
+        if job is None:
+            return None
+        items = self.store.items(job_id)
+        counts = {}
+        for item in items:
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+        elapsed = (job["finished_at"] or time.time()) - job["created_at"]
+        summarized = counts.get(DONE, 0)
+        result = {
+            "job_id": job_id,
+            "status": job["status"],
+            "request": json.loads(job["request"]),
+            "total": len(items),
+            "counts": counts,
+            "elapsed_seconds": round(elapsed, 3),
+            # Papers that went through the whole pipeline (not answered from storage)
+            "papers_per_minute": round(summarized * 60 / elapsed, 2) if elapsed > 0 else None,
+            "stage_seconds": {
+                "download": _mean(item["download_seconds"] for item in items),
+                "extract": _mean(item["extract_seconds"] for item in items),
+                "summarize": _mean(item["llm_seconds"] for item in items),
+            },
+        }
+        if include_items:
+            result["items"] = [
+                {
+                    "ordinal": item["ordinal"],
+                    "arxiv_id": item["arxiv_id"],
+                    "title": json.loads(item["entry"])["title"],
+                    "status": item["status"],
+                    "summary": item["summary"],
+                    "error": item["error"],
+                }
+                for item in items
+            ]
+        return result
+
+
+bulk_jobs = BulkJobs()
@@ -1,51 +1,136 @@
 import os
-import uuid
-import io
-from PyPDF2 import PdfReader
+import json
 from fastapi import APIRouter, UploadFile, File, Form, Body, Request
-from fastapi.responses import JSONResponse
-from service import summarize_text_with_gpt
+from fastapi.responses import JSONResponse, StreamingResponse
+from service import FALLBACK_PREFIX
+import llm_gateway
+from context_builder import build_chat_context
+from json_logging import get_logger
+from metrics import stage_timer, BYTES_DOWNLOADED, CACHE_EVENTS
+from answer_cache import answer_cache, content_hash
+from corpus_index import corpus_index, document_id, ANONYMOUS
+from document import parse_pdf, read_upload, document_for_url
+from upload_store import upload_store
+from admission import authenticated_user
+from circuit_breaker import pdf_breaker, client_error
+from deadline import RequestAborted, check_deadline, capped_timeout
+from executors import io_pool
+from cluster import cluster, CLUSTER_HANDOFFS
+from conversation_memory import conversation_memory, last_question
+from usage_ledger import usage_ledger, BudgetExceeded, DEGRADED, EXHAUSTED
 import requests
 
+logger = get_logger(__name__)
+
 chatbot_router = APIRouter()
 
 # In-memory session store (for demo; use DB in production)
 session_rag_map = {}
+session_hash_map = {}
 progress_map = {}
 
+def download_pdf(pdf_url, session_id):
+    """Stream a PDF into memory, reporting download progress for the session"""
+    breaker = pdf_breaker(pdf_url)
+    with stage_timer("pdf_download"), breaker.call(neutral=client_error), requests.get(pdf_url, stream=True, timeout=capped_timeout(breaker.timeout())) as r:
+        r.raise_for_status()
+        total = int(r.headers.get('content-length', 0))
+        downloaded = 0
+        chunks = []
+        for chunk in r.iter_content(chunk_size=8192):
+            check_deadline()
+            if chunk:
+                chunks.append(chunk)
+                downloaded += len(chunk)
+                BYTES_DOWNLOADED.inc(len(chunk), source="rag_url")
+                if total:
+                    percent = int(downloaded / total * 100)
+                    progress_map[session_id] = f"กำลังดาวน์โหลด PDF ({percent}%) ..."
+    return b"".join(chunks)
+
+async def _restore_session(session_id, doc_id):
+    """Start the session from an earlier upload of the same PDF; None if there was none"""
+    stored = await io_pool.run(upload_store.get_chunks, doc_id)
+    if stored is None:
+        return None
+    chunks, chunk_hash, _ = stored
+    session_rag_map[session_id] = chunks
+    session_hash_map[session_id] = chunk_hash
+    await io_pool.run(upload_store.put_session, session_id, doc_id)
+    progress_map[session_id] = f"Completed: {len(chunks)} chunks"
+    logger.info(f"Reused stored chunks for {doc_id}", extra={"session_id": session_id, "rag_chunks": len(chunks)})
+    return {"session_id": session_id, "rag_chunks": len(chunks), "cached": True}
+
+async def _start_session(session_id, document):
+    chunks = document.chunk_texts
+    chunk_hash = content_hash(chunks)
+    session_rag_map[session_id] = chunks
+    session_hash_map[session_id] = chunk_hash
+    await io_pool.run(upload_store.put_chunks, document.doc_id, chunks, chunk_hash, document.title or "")
+    await io_pool.run(upload_store.put_session, session_id, document.doc_id)
+    return chunks
+
+async def _session_chunks(session_id):
+    """Chunks of a session held here, or restored from the upload store (the ring moved it to this node)"""
+    chunks = session_rag_map.get(session_id)
+    if chunks:
+        return chunks
+    doc_id = await io_pool.run(upload_store.doc_id_for_session, session_id)
+    stored = await io_pool.run(upload_store.get_chunks, doc_id) if doc_id else None
+    if stored is None:
+        return []
+    chunks, chunk_hash, _ = stored
+    session_rag_map[session_id] = chunks
+    session_hash_map[session_id] = chunk_hash
+    logger.info("Restored session from the upload store", extra={"session_id": session_id, "rag_chunks": len(chunks)})
+    return chunks
+
+def _hand_off_sessions():
+    """After the ring changed, move the sessions another node now owns over to it"""
+    for session_id in list(session_rag_map):
+        owner = cluster.owner(session_id)
+        if owner == cluster.self_url:
+            continue
+        payload = {"session_id": session_id, "chunks": session_rag_map.get(session_id, []),
+                   "chunk_hash": session_hash_map.get(session_id), "memory": conversation_memory.export(session_id)}
+        if cluster.hand_off(owner, "/api/internal/sessions", payload):
+            session_rag_map.pop(session_id, None)
+            session_hash_map.pop(session_id, None)
+            # A stale copy here would be served again if the session ever comes back to this node
+            conversation_memory.forget(session_id)
+            CLUSTER_HANDOFFS.inc(result="ok")
+        else:
+            # Keep serving it here if asked; the owner can still restore it from the upload store
+            CLUSTER_HANDOFFS.inc(result="failed")
+
+cluster.on_change(_hand_off_sessions)
+
 @chatbot_router.post("/create_rag_session")
-async def create_rag_session(pdf: UploadFile = File(...)):
-    session_id = str(uuid.uuid4())
+async def create_rag_session(request: Request, pdf: UploadFile = File(...)):
+    session_id = cluster.new_session_id()
     progress_map[session_id] = "Uploading PDF"
-    print(f"[RAG][{session_id}] Uploading PDF")
-    file_content = await pdf.read()
+    logger.info("Uploading PDF", extra={"session_id": session_id})
+    file_content, doc_id = await read_upload(pdf)
+    restored = await _restore_session(session_id, doc_id)
+    if restored is not None:
+        return restored
     progress_map[session_id] = "Extracting and chunking text from PDF"
-    print(f"[RAG][{session_id}] Extracting and chunking text from PDF")
+    logger.info("Extracting and chunking text from PDF", extra={"session_id": session_id})
     try:
-        reader = PdfReader(io.BytesIO(file_content))
-        # Efficient chunking for RAG
-        chunks = []
-        chunk = ""
-        max_chunk_len = 2000  # characters, adjust for efficiency
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if not page_text:
-                continue
-            for paragraph in page_text.split('\n'):
-                if len(chunk) + len(paragraph) > max_chunk_len:
-                    chunks.append(chunk)
-                    chunk = paragraph + "\n"
-                else:
-                    chunk += paragraph + "\n"
-        if chunk:
-            chunks.append(chunk)
-        session_rag_map[session_id] = chunks
+        # parse_pdf blocks until the extract process pool has the text, so it waits on the io pool
+        document = await io_pool.run(parse_pdf, file_content, "rag_upload")
+        chunks = await _start_session(session_id, document)
+        corpus_index.submit(document.doc_id, text=document.text, title=pdf.filename.replace('.pdf', ''),
+                            source="rag_upload", owner=authenticated_user(request.scope) or ANONYMOUS)
         progress_map[session_id] = f"Completed: {len(chunks)} chunks"
-        print(f"[RAG][{session_id}] Completed: {len(chunks)} chunks")
+        logger.info(f"Completed: {len(chunks)} chunks", extra={"session_id": session_id, "rag_chunks": len(chunks)})
         return {"session_id": session_id, "rag_chunks": len(chunks)}
+    except RequestAborted:
+        progress_map[session_id] = "Cancelled"
+        raise
     except Exception as e:
         progress_map[session_id] = f"Failed: {str(e)}"
-        print(f"[RAG][{session_id}] Failed: {str(e)}")
+        logger.error(f"Failed: {str(e)}", extra={"session_id": session_id})
         return JSONResponse(status_code=500, content={"error": f"Failed to create RAG: {str(e)}"})
 
 @chatbot_router.post("/create_rag_session_from_url")
@@ -64,71 +149,260 @@ async def create_rag_session_from_url(request: Request):
             pdf_url = None
     if not pdf_url:
         return {"error": "pdf_url is required"}
-    session_id = str(uuid.uuid4())
+    session_id = cluster.new_session_id()
     progress_map[session_id] = "กำลังดาวน์โหลด PDF (0%) ..."
     try:
-        # Download PDF with progress
-        with requests.get(pdf_url, stream=True) as r:
-            r.raise_for_status()
-            total = int(r.headers.get('content-length', 0))
-            downloaded = 0
-            chunks = []
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    chunks.append(chunk)
-                    downloaded += len(chunk)
-                    if total:
-                        percent = int(downloaded / total * 100)
-                        progress_map[session_id] = f"กำลังดาวน์โหลด PDF ({percent}%) ..."
-        file_content = b"".join(chunks)
-        progress_map[session_id] = "Extracting and chunking text from PDF"
-        reader = PdfReader(io.BytesIO(file_content))
-        chunks = []
-        chunk = ""
-        max_chunk_len = 2000
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if not page_text:
-                continue
-            for paragraph in page_text.split('\n'):
-                if len(chunk) + len(paragraph) > max_chunk_len:
-                    chunks.append(chunk)
-                    chunk = paragraph + "\n"
-                else:
-                    chunk += paragraph + "\n"
-        if chunk:
-            chunks.append(chunk)
-        session_rag_map[session_id] = chunks
+        # Prefetched from a listing (or fetched by an earlier request): skip the download
+        document = document_for_url(pdf_url)
+        if document is None:
+            # Chunks stored for this URL earlier (or precomputed off-peak): no download either
+            doc_id = await io_pool.run(upload_store.doc_id_for_url, pdf_url)
+            restored = await _restore_session(session_id, doc_id) if doc_id else None
+            if restored is not None:
+                return restored
+            # Download PDF with progress
+            file_content = await io_pool.run(download_pdf, pdf_url, session_id)
+            restored = await _restore_session(session_id, await io_pool.run(document_id, file_content))
+            if restored is not None:
+                return restored
+            progress_map[session_id] = "Extracting and chunking text from PDF"
+            document = await io_pool.run(parse_pdf, file_content, "rag_url", None, pdf_url)
+        chunks = await _start_session(session_id, document)
+        await io_pool.run(upload_store.put_url, pdf_url, document.doc_id)
+        corpus_index.submit(document.doc_id, text=document.text, title=document.title or "", url=pdf_url, source="rag_url")
         progress_map[session_id] = f"Completed: {len(chunks)} chunks"
         return {"session_id": session_id, "rag_chunks": len(chunks)}
+    except RequestAborted:
+        progress_map[session_id] = "Cancelled"
+        raise
     except Exception as e:
         progress_map[session_id] = f"Failed: {str(e)}"
         return JSONResponse(status_code=500, content={"error": f"Failed to create RAG: {str(e)}"})
 
+# คำตอบแบบ single-pass: ตอบจาก paper แล้วอธิบายภาษาไทยต่อในคำตอบเดียว คั่นด้วย marker นี้
+EXPLANATION_MARKER = "### คำอธิบาย"
+
+def _relevant_context(chunks, message):
+    # RAG: เลือก chunk ที่เกี่ยวข้องที่สุดให้พอดีกับ token budget
+    context = build_chat_context(chunks, message)
+    logger.info(f"Chat context: {context.tokens} tokens, {context.tokens_saved} saved",
+                extra={"chunks_used": context.sections})
+    return context.text
+
+def _single_pass_messages(context, message, history=()):
+    return [
+        {"role": "system", "content": (
+            "You answer questions about a research paper using only the paper excerpts provided. "
+            "First give the answer grounded in the excerpts. Then write a line containing exactly "
+            f"\"{EXPLANATION_MARKER}\" followed by a simpler explanation or expansion of that answer in Thai."
+        )},
+        # ประวัติการสนทนา (สรุปแบบ rolling + ไม่กี่ turn ล่าสุด) ขนาดคงที่ไม่ว่าคุยยาวแค่ไหน
+        *history,
+        {"role": "user", "content": f"เนื้อหา paper ที่เกี่ยวข้อง:\n{context}\n\nคำถาม: {message}"},
+    ]
+
+def _rag_messages(context, message, history=()):
+    """First two-pass call: the answer grounded in the excerpts"""
+    return [
+        {"role": "system", "content": (
+            "You answer questions about a research paper using only the paper excerpts provided."
+        )},
+        *history,
+        {"role": "user", "content": f"เนื้อหา paper ที่เกี่ยวข้อง:\n{context}\n\nคำถาม: {message}"},
+    ]
+
+def _explain_messages(rag_reply):
+    """Second two-pass call: the answer explained more simply in Thai"""
+    return [
+        {"role": "system", "content": "You explain answers about research papers clearly for newcomers."},
+        {"role": "user", "content": f"นี่คือคำตอบจากระบบ RAG: {rag_reply}\n\nโปรดอธิบายหรือสรุปให้เข้าใจง่ายขึ้น หรือขยายความเพิ่มเติมเป็นภาษาไทย"},
+    ]
+
+def split_single_pass(text):
+    """Split a single-pass answer into (rag_reply, gpt_reply)"""
+    answer, _, explanation = text.partition(EXPLANATION_MARKER)
+    return answer.strip(), explanation.strip()
+
+def _paper_hash(session_id, chunks):
+    paper_hash = session_hash_map.get(session_id)
+    if paper_hash is None:
+        paper_hash = session_hash_map[session_id] = content_hash(chunks)
+    return paper_hash
+
+def _bypass_cache(request, no_cache):
+    return no_cache or "no-cache" in request.headers.get("cache-control", "").lower()
+
+def _cache_lookup(request, no_cache, session_id, chunks, message, mode, history=()):
+    """(paper hash, cached answer or None); the hash is None when the caller asked to bypass the cache"""
+    # A follow-up question means something different in each conversation
+    if _bypass_cache(request, no_cache) or history:
+        CACHE_EVENTS.inc(cache="answer", result="bypass")
+        return None, None
+    paper_hash = _paper_hash(session_id, chunks)
+    return paper_hash, answer_cache.get(paper_hash, message, mode)
+
+# คำตอบแบบไม่ใช้ LLM เมื่อใช้งบประมาณรายวันหมดแล้ว: ข้อความจาก paper ที่เกี่ยวข้องที่สุดภายใน token นี้
+BUDGET_EXCERPT_TOKENS = 400
+BUDGET_NOTICE = "วันนี้ใช้งาน AI ครบงบประมาณแล้ว จึงแสดงเนื้อหาจาก paper ที่เกี่ยวข้องกับคำถามแทนคำตอบ"
+
+def _budget_answer(session_id, chunks, message, previous_question=""):
+    """Answer without an LLM call: a cached answer in either mode (even mid-conversation), else the best excerpts"""
+    paper_hash = _paper_hash(session_id, chunks)
+    for cached_mode in ("single", "two_pass"):
+        cached = answer_cache.get(paper_hash, message, cached_mode)
+        if cached is not None:
+            usage_ledger.degrade("cached_answer")
+            usage_ledger.cache_hit("rag_answer")
+            return {**cached, "cached": True, "degraded": "budget"}
+    usage_ledger.degrade("excerpts")
+    excerpts = build_chat_context(chunks, f"{previous_question} {message}".strip(), BUDGET_EXCERPT_TOKENS).text
+    return {"rag_reply": excerpts, "gpt_reply": BUDGET_NOTICE, "degraded": "budget"}
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @chatbot_router.post("/chat_with_rag")
 async def chat_with_rag(
+    request: Request,
+    session_id: str = Form(...),
+    message: str = Form(...),
+    mode: str = Form("two_pass"),
+    no_cache: bool = Form(False),
+    history: bool = Form(True)
+):
+    owner = cluster.should_forward(request, session_id)
+    if owner is not None:
+        forwarded = await cluster.forward(request, owner, data={"session_id": session_id, "message": message, "mode": mode,
+                                                                "no_cache": str(no_cache).lower(), "history": str(history).lower()})
+        if forwarded is not None:
+            return forwarded
+    chunks = await _session_chunks(session_id)
+    if not chunks:
+        return JSONResponse(status_code=404, content={"error": "Session not found or RAG not created"})
+    if mode not in ("two_pass", "single"):
+        return JSONResponse(status_code=400, content={"error": "mode must be 'two_pass' or 'single'"})
+    past = await io_pool.run(conversation_memory.messages, session_id) if history else []
+    budget = usage_ledger.current_state()
+    if budget == EXHAUSTED:
+        return await io_pool.run(_budget_answer, session_id, chunks, message, last_question(past))
+    if budget == DEGRADED and mode == "two_pass":
+        # สองรอบคือค่าใช้จ่ายสองเท่า: ใกล้หมดงบแล้วตอบรอบเดียว
+        usage_ledger.degrade("single_pass")
+        mode = "single"
+    paper_hash, cached = _cache_lookup(request, no_cache, session_id, chunks, message, mode, past)
+    if cached is not None:
+        usage_ledger.cache_hit("rag_answer")
+        return {**cached, "cached": True}
+    # คำถามต่อเนื่อง ("แล้วข้อจำกัดล่ะ?") ค้น chunk ด้วยคำถามก่อนหน้าด้วย
+    context = _relevant_context(chunks, f"{last_question(past)} {message}".strip())
+    try:
+        if mode == "single":
+            with stage_timer("rag_answer"):
+                completion = await llm_gateway.gateway.acomplete(_single_pass_messages(context, message, past), priority=llm_gateway.INTERACTIVE,
+                                                                 purpose="rag_answer")
+            rag_reply, gpt_reply = split_single_pass(completion.text)
+        else:
+            # ตอบจาก RAG ก่อน (ส่งเป็น chat messages ตรง ๆ ไม่ผ่าน prompt สรุป paper)
+            with stage_timer("rag_answer"):
+                rag_reply = (await llm_gateway.gateway.acomplete(_rag_messages(context, message, past), priority=llm_gateway.INTERACTIVE,
+                                                                 purpose="rag_answer")).text
+            # ส่งคำตอบ rag ไปถาม chatgpt อีกที
+            with stage_timer("rag_explain"):
+                gpt_reply = (await llm_gateway.gateway.acomplete(_explain_messages(rag_reply), priority=llm_gateway.INTERACTIVE,
+                                                                 purpose="rag_explain")).text
+    except RequestAborted:
+        raise
+    except BudgetExceeded:
+        # Spent by other requests since the check above
+        return await io_pool.run(_budget_answer, session_id, chunks, message, last_question(past))
+    except Exception as e:
+        logger.error(f"Chat failed: {e}")
+        return JSONResponse(status_code=502, content={"error": f"Chat failed: {str(e)}"})
+    answer = {"rag_reply": rag_reply, "gpt_reply": gpt_reply}
+    if paper_hash is not None and not any(reply.startswith(FALLBACK_PREFIX) for reply in answer.values()):
+        answer_cache.put(paper_hash, message, answer, mode)
+    if history and not rag_reply.startswith(FALLBACK_PREFIX):
+        await io_pool.run(conversation_memory.record, session_id, message, rag_reply)
+    return answer
+
+@chatbot_router.post("/chat_with_rag/stream")
+async def chat_with_rag_stream(
+    request: Request,
     session_id: str = Form(...),
-    message: str = Form(...)
+    message: str = Form(...),
+    no_cache: bool = Form(False),
+    history: bool = Form(True)
 ):
-    chunks = session_rag_map.get(session_id, [])
+    """Single-pass chat streamed as Server-Sent Events: `token` events, then `done` (or `error`)"""
+    owner = cluster.should_forward(request, session_id)
+    if owner is not None:
+        forwarded = await cluster.forward(request, owner, stream=True,
+                                          data={"session_id": session_id, "message": message,
+                                                "no_cache": str(no_cache).lower(), "history": str(history).lower()})
+        if forwarded is not None:
+            return forwarded
+    chunks = await _session_chunks(session_id)
     if not chunks:
         return JSONResponse(status_code=404, content={"error": "Session not found or RAG not created"})
-    # RAG: ค้นหา chunk ที่เกี่ยวข้องมากที่สุด
-    relevant = []
-    for chunk in chunks:
-        if message.lower() in chunk.lower():
-            relevant.append(chunk)
-    if not relevant:
-        relevant = [chunks[0]]  # fallback: ใช้ chunk แรก
-    context = "\n".join(relevant)
-    # ตอบจาก RAG ก่อน
-    prompt_rag = f"เนื้อหา paper ที่เกี่ยวข้อง:\n{context}\n\nคำถาม: {message}\nตอบ: "
-    rag_reply = summarize_text_with_gpt(prompt_rag)
-    # ส่งคำตอบ rag ไปถาม chatgpt อีกที
-    prompt_gpt = f"นี่คือคำตอบจากระบบ RAG: {rag_reply}\n\nโปรดอธิบายหรือสรุปให้เข้าใจง่ายขึ้น หรือขยายความเพิ่มเติมเป็นภาษาไทย"
-    gpt_reply = summarize_text_with_gpt(prompt_gpt)
-    return {"rag_reply": rag_reply, "gpt_reply": gpt_reply}
+    past = await io_pool.run(conversation_memory.messages, session_id) if history else []
+    if usage_ledger.current_state() == EXHAUSTED:
+        paper_hash, cached = None, await io_pool.run(_budget_answer, session_id, chunks, message, last_question(past))
+    else:
+        paper_hash, cached = _cache_lookup(request, no_cache, session_id, chunks, message, "single", past)
+        if cached is not None:
+            usage_ledger.cache_hit("rag_answer")
+            cached = {**cached, "cached": True}
+    messages = None if cached is not None else _single_pass_messages(
+        _relevant_context(chunks, f"{last_question(past)} {message}".strip()), message, past)
+
+    async def events():
+        if cached is not None:
+            yield _sse("done", cached)
+            return
+        parts = []
+        try:
+            with stage_timer("rag_stream"):
+                async for delta in llm_gateway.gateway.astream(messages, priority=llm_gateway.INTERACTIVE, purpose="rag_answer"):
+                    check_deadline()
+                    parts.append(delta)
+                    yield _sse("token", {"text": delta})
+        except RequestAborted as e:
+            # Headers are already sent, so the deadline can only be reported in-band
+            yield _sse("error", {"error": str(e)})
+            return
+        except Exception as e:
+            logger.error(f"Streamed chat failed: {e}")
+            yield _sse("error", {"error": f"Chat failed: {str(e)}"})
+            return
+        rag_reply, gpt_reply = split_single_pass("".join(parts))
+        answer = {"rag_reply": rag_reply, "gpt_reply": gpt_reply}
+        if paper_hash is not None:
+            answer_cache.put(paper_hash, message, answer, "single")
+        if history:
+            await io_pool.run(conversation_memory.record, session_id, message, rag_reply)
+        yield _sse("done", answer)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @chatbot_router.get("/rag_progress/{session_id}")
-async def rag_progress(session_id: str):
+async def rag_progress(session_id: str, request: Request):
+    owner = cluster.should_forward(request, session_id)
+    if owner is not None:
+        forwarded = await cluster.forward(request, owner)
+        if forwarded is not None:
+            return forwarded
     return {"progress": progress_map.get(session_id, "Not found")}
+
+@chatbot_router.post("/internal/sessions", include_in_schema=False)
+async def receive_session(request: Request):
+    """Hand-off from a peer: a session this node now owns on the hash ring"""
+    if not cluster.is_internal(request.headers):
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    body = await request.json()
+    session_rag_map[body["session_id"]] = body["chunks"]
+    if body.get("chunk_hash"):
+        session_hash_map[body["session_id"]] = body["chunk_hash"]
+    if body.get("memory"):
+        await io_pool.run(conversation_memory.restore, body["session_id"], body["memory"])
+    return {"session_id": body["session_id"], "rag_chunks": len(body["chunks"])}
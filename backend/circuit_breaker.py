@@ -0,0 +1,227 @@
+"""
+Per-upstream circuit breakers with adaptive timeouts and bulkheads.
+
+Each upstream (arXiv API, arXiv PDF host, OpenAI, Supabase) gets one
+breaker:
+
+* closed    - calls go through; ``failure_threshold`` consecutive failures open it
+* open      - calls fail fast with ``CircuitOpenError`` until ``recovery_timeout`` passes
+* half_open - up to ``half_open_max_calls`` probe calls are let through; a success
+              closes the breaker, a failure re-opens it
+
+Timeouts adapt to observed latency: ``timeout()`` returns the configured
+percentile of recent successful calls times a multiplier, clamped to
+``[min_timeout, max_timeout]``. A concurrency cap (bulkhead) makes sure a
+slow upstream can hold at most ``max_concurrency`` worker threads.
+"""
+import os
+import threading
+import time
+import urllib.parse
+from collections import deque
+from contextlib import contextmanager
+
+from deadline import RequestAborted
+from metrics import Counter, Gauge
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = Gauge(
+    "botchana_circuit_state",
+    "Circuit breaker state per upstream (0=closed, 1=half_open, 2=open)",
+    ["upstream"],
+)
+CIRCUIT_REJECTIONS = Counter(
+    "botchana_circuit_rejections_total",
+    "Calls rejected without reaching the upstream",
+    ["upstream", "reason"],
+)
+UPSTREAM_TIMEOUT = Gauge(
+    "botchana_upstream_timeout_seconds",
+    "Current adaptive timeout per upstream",
+    ["upstream"],
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open or saturated."""
+
+
+def client_error(error):
+    """The upstream answered but refused this request (an HTTP 4xx, e.g. a wrong URL): not an outage"""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0, half_open_max_calls=1,
+                 default_timeout=30.0, min_timeout=2.0, max_timeout=30.0, percentile=0.95,
+                 timeout_multiplier=2.0, window=100, min_samples=10, max_concurrency=8,
+                 clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_samples = min_samples
+        self.max_concurrency = max_concurrency
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._half_open_in_flight = 0
+        CIRCUIT_STATE.set(0, upstream=name)
+        UPSTREAM_TIMEOUT.set(default_timeout, upstream=name)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.recovery_timeout:
+            self._set_state(HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state):
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self._clock()
+        if state != HALF_OPEN:
+            self._half_open_in_flight = 0
+        CIRCUIT_STATE.set(_STATE_VALUES[state], upstream=self.name)
+
+    def timeout(self):
+        """Adaptive per-attempt timeout in seconds."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                value = self.default_timeout
+            else:
+                ordered = sorted(self._latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self.percentile))
+                value = ordered[index] * self.timeout_multiplier
+        value = max(self.min_timeout, min(self.max_timeout, value))
+        UPSTREAM_TIMEOUT.set(value, upstream=self.name)
+        return value
+
+    def _before_call(self):
+        with self._lock:
+            state = self._current_state()
+            if state == OPEN:
+                CIRCUIT_REJECTIONS.inc(upstream=self.name, reason="open")
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            if state == HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    CIRCUIT_REJECTIONS.inc(upstream=self.name, reason="half_open")
+                    raise CircuitOpenError(f"{self.name} circuit is half-open, probe in flight")
+                self._half_open_in_flight += 1
+            return state
+
+    def record_success(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._failures = 0
+            if self._state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._set_state(OPEN)
+
+    @contextmanager
+    def call(self, neutral=None):
+        """Guard one upstream call: fail fast when open or saturated, record the outcome otherwise.
+
+        ``neutral(exc)`` marks errors that say nothing about the upstream's health
+        (a 429, a 404): they are re-raised without counting as failure or success.
+        """
+        if not self._slots.acquire(blocking=False):
+            CIRCUIT_REJECTIONS.inc(upstream=self.name, reason="saturated")
+            raise CircuitOpenError(f"{self.name} has {self.max_concurrency} calls in flight")
+        try:
+            state = self._before_call()
+            started = time.perf_counter()
+            try:
+                yield self
+            except RequestAborted:
+                raise  # our caller gave up; says nothing about the upstream
+            except BaseException as e:
+                if neutral is None or not neutral(e):
+                    self.record_failure()
+                raise
+            else:
+                self.record_success(time.perf_counter() - started)
+            finally:
+                if state == HALF_OPEN:
+                    with self._lock:
+                        self._half_open_in_flight = max(0, self._half_open_in_flight - 1)
+        finally:
+            self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state()
+            failures = self._failures
+        return {"state": state, "consecutive_failures": failures, "timeout": round(self.timeout(), 3)}
+
+
+def _from_env(name, prefix, **defaults):
+    def setting(key, cast=float):
+        return cast(os.getenv(f"{prefix}_{key.upper()}", defaults[key]))
+    return CircuitBreaker(
+        name,
+        failure_threshold=setting("failure_threshold", int),
+        recovery_timeout=setting("recovery_timeout"),
+        default_timeout=setting("default_timeout"),
+        min_timeout=setting("min_timeout"),
+        max_timeout=setting("max_timeout"),
+        max_concurrency=setting("max_concurrency", int),
+    )
+
+
+ARXIV_API = _from_env("arxiv_api", "CB_ARXIV_API", failure_threshold=5, recovery_timeout=30,
+                      default_timeout=15, min_timeout=3, max_timeout=30, max_concurrency=8)
+ARXIV_PDF = _from_env("arxiv_pdf", "CB_ARXIV_PDF", failure_threshold=5, recovery_timeout=30,
+                      default_timeout=30, min_timeout=5, max_timeout=30, max_concurrency=8)
+OPENAI = _from_env("openai", "CB_OPENAI", failure_threshold=5, recovery_timeout=20,
+                   default_timeout=60, min_timeout=10, max_timeout=90, max_concurrency=16)
+SUPABASE = _from_env("supabase", "CB_SUPABASE", failure_threshold=3, recovery_timeout=30,
+                     default_timeout=10, min_timeout=1, max_timeout=10, max_concurrency=8)
+
+BREAKERS = {breaker.name: breaker for breaker in (ARXIV_API, ARXIV_PDF, OPENAI, SUPABASE)}
+
+
+_host_breakers = {}
+_host_breakers_lock = threading.Lock()
+MAX_HOST_BREAKERS = 64
+
+
+def pdf_breaker(url):
+    """Breaker for a PDF download: the arXiv one for arXiv hosts, otherwise one per host"""
+    host = (urllib.parse.urlparse(url).hostname or "").lower()
+    if host == "arxiv.org" or host.endswith(".arxiv.org"):
+        return ARXIV_PDF
+    with _host_breakers_lock:
+        breaker = _host_breakers.get(host)
+        if breaker is None:
+            if len(_host_breakers) >= MAX_HOST_BREAKERS:
+                _host_breakers.pop(next(iter(_host_breakers)))
+            breaker = _host_breakers[host] = CircuitBreaker(
+                f"pdf:{host}", default_timeout=ARXIV_PDF.default_timeout,
+                min_timeout=ARXIV_PDF.min_timeout, max_timeout=ARXIV_PDF.max_timeout,
+            )
+        return breaker
+
+
+def breaker_snapshot():
+    return {name: breaker.snapshot() for name, breaker in BREAKERS.items()}
@@ -0,0 +1,74 @@
+"""
+Shared external clients, built lazily on first use.
+
+Importing this module is free: the SSL workaround and client construction
+happen the first time a client is requested. ``main`` loads the backend
+``.env`` before anything else is imported, since most settings are read at
+import time; ``load_dotenv`` here only covers scripts that skip ``main``.
+"""
+import os
+import ssl
+
+from circuit_breaker import SUPABASE
+from json_logging import get_logger
+from lazy import LazyResource, lazy_import
+
+logger = get_logger(__name__)
+
+openai = lazy_import("openai")
+supabase_lib = lazy_import("supabase")
+
+
+def _configure_environment():
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    # Fix SSL context issues for Windows
+    try:
+        ssl._create_default_https_context = ssl._create_unverified_context
+    except:
+        pass
+
+    # Set environment variables to fix SSL issues
+    os.environ['PYTHONHTTPSVERIFY'] = '0'
+    if 'SSL_CERT_FILE' in os.environ:
+        del os.environ['SSL_CERT_FILE']
+    return True
+
+
+environment = LazyResource("environment", _configure_environment)
+
+
+def _build_openai_client():
+    environment.get()
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not openai_api_key:
+        logger.error("OPENAI_API_KEY not found in environment variables")
+        raise ValueError("OPENAI_API_KEY is required")
+    client = openai.OpenAI(
+        api_key=openai_api_key,
+        timeout=60.0,  # Increase timeout
+    )
+    logger.info("OpenAI client initialized successfully")
+    return client
+
+
+def _build_supabase_client():
+    environment.get()
+    from supabase_config import SUPABASE_URL, SUPABASE_KEY
+    options = supabase_lib.ClientOptions(postgrest_client_timeout=SUPABASE.max_timeout)
+    client = supabase_lib.create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+    logger.info("Supabase client initialized successfully")
+    return client
+
+
+openai_client = LazyResource("openai", _build_openai_client)
+supabase_client = LazyResource("supabase", _build_supabase_client)
+
+
+def get_openai_client():
+    return openai_client.get()
+
+
+def get_supabase():
+    return supabase_client.get()
@@ -0,0 +1,320 @@
+"""
+Session affinity across worker processes and nodes.
+
+A RAG session's chunks live in the memory of the process that created it,
+so every chat call for that session should land there. With
+``CLUSTER_NODES`` set to the base URLs of all processes (e.g.
+``http://10.0.0.1:8000,http://10.0.0.2:8000``, or one port per worker on
+a single host) and ``CLUSTER_SELF`` to this process's own URL:
+
+* session ids are placed on a consistent-hash ring (``CLUSTER_VNODES``
+  virtual nodes per member). A node creating a session draws ids until it
+  owns one, so the session is born where it will be served;
+* a chat call that reaches any other node is forwarded to the owner over
+  the internal path (same route, ``X-Cluster-Forwarded`` set, streams
+  relayed as they arrive). Forwarded calls are never forwarded again;
+* members are probed on ``/health`` every ``CLUSTER_HEALTH_INTERVAL``
+  seconds. When a node leaves or joins, the ring is rebuilt and only the
+  sessions whose owner changed move: their old holder hands them to the new
+  owner (``POST /api/internal/sessions``), which can also restore them from
+  the upload store.
+
+``CLUSTER_SECRET`` authenticates internal calls and lets already-admitted
+forwarded requests skip admission control on the owner. With fewer than
+two nodes configured everything is served locally.
+"""
+import bisect
+import hashlib
+import hmac
+import os
+import threading
+import time
+import uuid
+
+import requests
+from fastapi.responses import Response, StreamingResponse
+
+from deadline import current_deadline
+from json_logging import get_logger
+from lazy import lazy_import
+from metrics import Counter, Gauge
+from tracing import current_request_id
+
+httpx = lazy_import("httpx")
+
+logger = get_logger(__name__)
+
+CLUSTER_NODES = os.getenv("CLUSTER_NODES", "")
+CLUSTER_SELF = os.getenv("CLUSTER_SELF", "")
+CLUSTER_SECRET = os.getenv("CLUSTER_SECRET", "")
+CLUSTER_VNODES = int(os.getenv("CLUSTER_VNODES", "128"))
+CLUSTER_HEALTH_INTERVAL = float(os.getenv("CLUSTER_HEALTH_INTERVAL", "5"))
+# Consecutive failed probes before a node is taken off the ring
+CLUSTER_DOWN_AFTER = 2
+CLUSTER_PROBE_TIMEOUT = 2.0
+CLUSTER_FORWARD_TIMEOUT = 120.0
+
+FORWARDED_HEADER = "x-cluster-forwarded"
+SECRET_HEADER = "x-cluster-secret"
+
+CLUSTER_FORWARDS = Counter(
+    "botchana_cluster_forwards_total",
+    "Session calls forwarded to the owning node",
+    ["result"],
+)
+CLUSTER_HANDOFFS = Counter(
+    "botchana_cluster_handoffs_total",
+    "Sessions handed to a new owner after the ring changed",
+    ["result"],
+)
+CLUSTER_MEMBERS = Gauge(
+    "botchana_cluster_members",
+    "Nodes currently on the hash ring",
+)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def _normalize(url):
+    return url.strip().rstrip("/")
+
+
+class HashRing:
+    """Consistent hashing with virtual nodes: adding or removing a node moves ~1/N of the keys"""
+
+    def __init__(self, nodes=(), vnodes=CLUSTER_VNODES):
+        self.vnodes = vnodes
+        self._points = []  # sorted (hash, node)
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.vnodes):
+            bisect.insort(self._points, (_hash(f"{node}#{replica}"), node))
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        self._points = [point for point in self._points if point[1] != node]
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, (_hash(key), "")) % len(self._points)
+        return self._points[index][1]
+
+
+class Cluster:
+    def __init__(self, nodes=CLUSTER_NODES, self_url=CLUSTER_SELF, secret=CLUSTER_SECRET, vnodes=CLUSTER_VNODES,
+                 health_interval=CLUSTER_HEALTH_INTERVAL, probe=None):
+        self.members = list(dict.fromkeys(_normalize(node) for node in nodes.split(",") if node.strip()))
+        self.self_url = _normalize(self_url)
+        self.secret = secret
+        self.health_interval = health_interval
+        self.enabled = len(self.members) > 1 and self.self_url in self.members
+        if len(self.members) > 1 and not self.enabled:
+            logger.warning(f"CLUSTER_SELF {self.self_url!r} is not in CLUSTER_NODES; serving every session locally")
+        if self.enabled and not self.secret:
+            logger.warning("CLUSTER_SECRET is not set: sessions cannot be handed off and forwarded calls are admitted twice")
+        self.ring = HashRing(self.members if self.enabled else [self.self_url], vnodes)
+        self._probe = probe or self._http_probe
+        self._failures = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._changed = threading.Event()  # ring changed outside the health thread; its listeners are due
+        self._thread = None
+        self._client = None
+        CLUSTER_MEMBERS.set(len(self.ring.nodes))
+
+    # -- routing -------------------------------------------------------
+
+    def owner(self, key):
+        with self._lock:
+            return self.ring.node_for(key)
+
+    def is_local(self, key):
+        return not self.enabled or self.owner(key) == self.self_url
+
+    def new_session_id(self):
+        """A fresh session id that hashes to this node (so the session is created where it will be served)"""
+        session_id = str(uuid.uuid4())
+        # Expected tries equal the number of nodes; a node that is off its own ring just takes the last one
+        for _ in range(64 * max(1, len(self.members))):
+            if self.is_local(session_id):
+                break
+            session_id = str(uuid.uuid4())
+        return session_id
+
+    def should_forward(self, request, key):
+        """Owning node for ``key`` if ``request`` has to be served there, else None"""
+        if not self.enabled or request.headers.get(FORWARDED_HEADER):
+            return None
+        owner = self.owner(key)
+        return owner if owner != self.self_url else None
+
+    def is_internal(self, headers):
+        """``headers`` (a name -> value mapping) carry this cluster's secret"""
+        supplied = headers.get(SECRET_HEADER, "")
+        return bool(self.secret) and hmac.compare_digest(supplied.encode(), self.secret.encode())
+
+    def _headers(self, request=None):
+        headers = {FORWARDED_HEADER: self.self_url}
+        if self.secret:
+            headers[SECRET_HEADER] = self.secret
+        request_id = current_request_id()
+        if request_id:
+            headers["X-Request-ID"] = request_id
+        deadline = current_deadline()
+        if deadline is not None:
+            headers["X-Request-Timeout"] = f"{max(0.1, deadline.remaining()):.3f}"
+        if request is not None:
+            for name in ("x-api-key", "authorization", "cache-control"):
+                if request.headers.get(name):
+                    headers[name] = request.headers[name]
+        return headers
+
+    # -- forwarding ----------------------------------------------------
+
+    def _http(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=CLUSTER_FORWARD_TIMEOUT,
+                                             limits=httpx.Limits(max_connections=256, max_keepalive_connections=64))
+        return self._client
+
+    async def forward(self, request, node, data=None, stream=False):
+        """Replay ``request`` (its form fields in ``data``) on ``node``; None when the node is unreachable"""
+        url = node + request.url.path
+        deadline = current_deadline()
+        timeout = CLUSTER_FORWARD_TIMEOUT if deadline is None else max(0.1, deadline.remaining())
+        outgoing = self._http().build_request(request.method, url, data=data, params=dict(request.query_params),
+                                              headers=self._headers(request), timeout=timeout)
+        try:
+            response = await self._http().send(outgoing, stream=stream)
+        except httpx.TransportError as e:
+            CLUSTER_FORWARDS.inc(result="unreachable")
+            logger.warning(f"Forwarding {request.url.path} to {node} failed: {e}")
+            self.mark_down(node)
+            return None
+        CLUSTER_FORWARDS.inc(result="ok")
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() in ("cache-control", "x-accel-buffering", "retry-after")}
+        media_type = response.headers.get("content-type")
+        if not stream:
+            return Response(content=response.content, status_code=response.status_code, media_type=media_type,
+                            headers=headers)
+
+        async def relay():
+            try:
+                async for part in response.aiter_raw():
+                    yield part
+            finally:
+                await response.aclose()
+
+        return StreamingResponse(relay(), status_code=response.status_code, media_type=media_type, headers=headers)
+
+    # -- membership ----------------------------------------------------
+
+    def on_change(self, listener):
+        """Call ``listener()`` after the ring changed (from the health thread)"""
+        self._listeners.append(listener)
+
+    def mark_down(self, node):
+        """Take ``node`` off the ring now; called from the event loop, so the listeners run on the health thread"""
+        if node == self.self_url:
+            return
+        with self._lock:
+            self._failures[node] = CLUSTER_DOWN_AFTER
+            live = [member for member in self.ring.nodes if member != node]
+        if self._set_live(live):
+            self._changed.set()
+
+    def _notify(self):
+        self._changed.clear()
+        for listener in list(self._listeners):
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"Cluster change listener failed: {e}")
+
+    def _set_live(self, live):
+        with self._lock:
+            before = set(self.ring.nodes)
+            after = set(live) | {self.self_url}
+            if before == after:
+                return False
+            for node in before - after:
+                self.ring.remove(node)
+            for node in after - before:
+                self.ring.add(node)
+            CLUSTER_MEMBERS.set(len(after))
+        logger.info(f"Cluster ring changed: joined {sorted(after - before)}, left {sorted(before - after)}")
+        return True
+
+    def _http_probe(self, node):
+        try:
+            return requests.get(node + "/health", timeout=CLUSTER_PROBE_TIMEOUT).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def check_members(self):
+        """Probe every member once, rebuild the ring from the healthy ones and run the listeners if it changed"""
+        healthy = {node: node == self.self_url or self._probe(node) for node in self.members}
+        live = []
+        with self._lock:
+            on_ring = set(self.ring.nodes)
+            for node, ok in healthy.items():
+                self._failures[node] = 0 if ok else self._failures.get(node, 0) + 1
+                if ok or (self._failures[node] < CLUSTER_DOWN_AFTER and node in on_ring):
+                    live.append(node)  # one missed probe is not a departure
+        changed = self._set_live(live)
+        if changed or self._changed.is_set():
+            self._notify()
+        return changed
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="cluster-health", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        next_check = time.monotonic() + self.health_interval
+        while True:
+            # A mark_down wakes the thread early to run the listeners; probes keep their own schedule
+            self._changed.wait(max(0.0, next_check - time.monotonic()))
+            try:
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + self.health_interval
+                    self.check_members()
+                elif self._changed.is_set():
+                    self._notify()
+            except Exception as e:
+                logger.error(f"Cluster health check failed: {e}")
+
+    def hand_off(self, node, path, payload):
+        """POST ``payload`` to an internal path on ``node`` (used to move sessions); True on success"""
+        try:
+            response = requests.post(node + path, json=payload, headers=self._headers(), timeout=CLUSTER_PROBE_TIMEOUT * 5)
+            return response.status_code == 200
+        except requests.RequestException as e:
+            logger.warning(f"Hand-off to {node} failed: {e}")
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            ring = self.ring.nodes
+        return {"enabled": self.enabled, "self": self.self_url, "members": self.members, "ring": ring}
+
+
+cluster = Cluster()
@@ -0,0 +1,298 @@
+"""
+Token-aware prompt context.
+
+Paper text is cleaned (running headers/footers, page numbers, references and
+acknowledgements removed), split into sections and packed into a token
+budget in order of usefulness: abstract, conclusion and introduction first,
+then the body in document order. Chat context is built the same way from
+retrieved chunks ranked by their match with the question.
+
+Tokens are counted with ``tiktoken`` when it and its encoding are available.
+Otherwise a character-based estimate is used (the encoding is downloaded on
+first use, so offline hosts fall back).
+"""
+import math
+import os
+import re
+from collections import Counter as TallyCounter
+from dataclasses import dataclass, field
+
+from json_logging import get_logger
+from lazy import LazyResource
+from metrics import Counter, Histogram
+from tracing import span
+
+logger = get_logger(__name__)
+
+SUMMARY_CONTEXT_TOKENS = int(os.getenv("SUMMARY_CONTEXT_TOKENS", "3000"))
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "2000"))
+# Below this, a partial section is more noise than signal
+MIN_PARTIAL_TOKENS = 150
+
+CONTEXT_TOKENS = Histogram(
+    "botchana_context_tokens",
+    "Tokens of context sent to the LLM per prompt",
+    ["purpose"],
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000, 32000),
+)
+CONTEXT_TOKENS_SAVED = Counter(
+    "botchana_context_tokens_saved_total",
+    "Tokens kept out of prompts, against the full paper (summary) or every matching chunk (chat)",
+    ["purpose"],
+)
+
+
+def _load_encoding():
+    try:
+        import tiktoken
+        model = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # Cached as None so we do not retry the download on every prompt
+        logger.warning(f"tiktoken unavailable, estimating token counts: {e}")
+        return None
+
+
+tokenizer = LazyResource("tokenizer", _load_encoding)
+
+
+def _estimate_tokens(text):
+    # ~4 characters per token for ASCII, about one per character for Thai and other scripts
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = tokenizer.get()
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Longest prefix of ``text`` within ``max_tokens``, cut back to a line or sentence end when possible."""
+    if max_tokens <= 0:
+        return ""
+    encoding = tokenizer.get()
+    if encoding is not None:
+        ids = encoding.encode(text, disallowed_special=())
+        if len(ids) <= max_tokens:
+            return text
+        cut = encoding.decode(ids[:max_tokens])
+    else:
+        if _estimate_tokens(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if _estimate_tokens(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        cut = text[:low]
+    boundary = max(cut.rfind("\n"), cut.rfind(". "))
+    if boundary > len(cut) // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip()
+
+
+# --- cleaning ----------------------------------------------------------------
+
+_PAGE_NUMBER = re.compile(r"^(page\s+)?\d{1,4}(\s+of\s+\d{1,4})?$", re.IGNORECASE)
+
+
+def strip_boilerplate(text):
+    """Drop page numbers and short lines repeated on many pages (running headers/footers)."""
+    lines = [line.strip() for line in text.splitlines()]
+    repeated = TallyCounter(line for line in lines if line and len(line) <= 100)
+    kept = []
+    for line in lines:
+        if line and (_PAGE_NUMBER.match(line) or repeated[line] >= 3):
+            continue
+        kept.append(line)
+    cleaned = "\n".join(kept)
+    cleaned = re.sub(r"[ \t]{2,}", " ", cleaned)
+    return re.sub(r"\n{3,}", "\n\n", cleaned).strip()
+
+
+# --- sections ----------------------------------------------------------------
+
+_SECTION_KINDS = [
+    ("abstract", r"abstract"),
+    ("introduction", r"introduction"),
+    ("background", r"background|related\s+work|preliminaries"),
+    ("method", r"methods?|methodology|approach|model|proposed\s+method"),
+    ("results", r"experiments?|experimental\s+results|results|evaluation"),
+    ("discussion", r"discussion|analysis|limitations"),
+    ("conclusion", r"conclusions?|concluding\s+remarks|summary|future\s+work|conclusions?\s+and\s+future\s+work"),
+    ("acknowledgements", r"acknowledge?ments?"),
+    ("references", r"references|bibliography"),
+    ("appendix", r"appendix|appendices|supplementary\s+material"),
+]
+_NUMBERING = r"(?:(?:\d+(?:\.\d+)*|[IVX]+|[A-Z])\.?\s+)?"
+_KNOWN_HEADING = re.compile(
+    rf"^{_NUMBERING}(?P<title>{'|'.join(f'(?P<{kind}>{pattern})' for kind, pattern in _SECTION_KINDS)})"
+    r"\s*(?:[:.—-]\s*(?P<rest>.*))?$",
+    re.IGNORECASE,
+)
+# "3 Training Setup" / "4.2. Ablations": numbered, short, capitalized, no sentence punctuation
+_NUMBERED_HEADING = re.compile(r"^\d+(?:\.\d+)*\.?\s+[A-Z][^.!?]{2,60}$")
+
+# Lower is packed first; missing kinds rank with the body
+SECTION_PRIORITY = {"abstract": 0, "front": 1, "conclusion": 1, "introduction": 2, "discussion": 3,
+                    "results": 3, "method": 4, "background": 5, "body": 4, "appendix": 7}
+# Title and authors are worth keeping; a long front matter is usually extraction noise
+MAX_FRONT_TOKENS = 200
+DROPPED_KINDS = {"references", "acknowledgements"}
+
+
+@dataclass
+class Section:
+    kind: str
+    title: str
+    text: str
+    order: int
+    # Character span of the section, heading included, in the text that was split
+    start: int = 0
+    end: int = 0
+
+    def render(self):
+        return f"{self.title}\n{self.text}" if self.title else self.text
+
+
+def _heading(line):
+    """(kind, title, text after the title) if ``line`` is a section heading, else None."""
+    match = _KNOWN_HEADING.match(line)
+    if match:
+        kind = next(kind for kind, _ in _SECTION_KINDS if match.group(kind))
+        if not match.group("rest"):
+            return (kind, line, "") if len(line) <= 80 else None
+        if kind == "abstract":  # "Abstract—We propose ..."
+            return kind, match.group("title"), match.group("rest")
+        return None  # "Results: we find ..." is a sentence, not a heading
+    if _NUMBERED_HEADING.match(line):
+        return "body", line, ""
+    return None
+
+
+def split_sections(text):
+    """Split cleaned paper text into sections; text before the first heading is the ``front`` matter."""
+    sections = []
+    kind, title, body, start = "front", "", [], 0
+    after_references = False
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        heading = _heading(line.strip())
+        if heading is not None and after_references and heading[0] == "body":
+            heading = None  # numbered reference entries look like numbered headings
+        if heading is not None:
+            sections.append(Section(kind, title, "\n".join(body).strip(), len(sections), start, offset))
+            kind, title, rest = heading
+            start = offset
+            after_references = after_references or kind == "references"
+            body = [rest] if rest else []
+        else:
+            body.append(line.rstrip("\r\n"))
+        offset += len(line)
+    sections.append(Section(kind, title, "\n".join(body).strip(), len(sections), start, offset))
+    sections = [s for s in sections if s.text]
+    if len(sections) == 1 and sections[0].kind == "front":
+        sections[0].kind = "body"
+    return sections
+
+
+# --- packing -----------------------------------------------------------------
+
+@dataclass
+class BuiltContext:
+    text: str
+    tokens: int
+    source_tokens: int
+    sections: list = field(default_factory=list)
+
+    @property
+    def tokens_saved(self):
+        return max(0, self.source_tokens - self.tokens)
+
+
+def _pack(candidates, budget):
+    """Greedy fill in rank order; the first item that does not fit is truncated if enough room is left."""
+    chosen, used = [], 0
+    for item, text in candidates:
+        cost = count_tokens(text)
+        if used + cost <= budget:
+            chosen.append((item, text))
+            used += cost
+        elif budget - used >= MIN_PARTIAL_TOKENS:
+            partial = truncate_to_tokens(text, budget - used)
+            if partial:
+                chosen.append((item, partial))
+                used += count_tokens(partial)
+    return chosen, used
+
+
+def _report(purpose, built):
+    CONTEXT_TOKENS.observe(built.tokens, purpose=purpose)
+    CONTEXT_TOKENS_SAVED.inc(built.tokens_saved, purpose=purpose)
+
+
+def build_summary_context(text, budget=None):
+    """Best sections of a paper within ``budget`` tokens, rendered in document order."""
+    budget = budget or SUMMARY_CONTEXT_TOKENS
+    with span("context.summary", budget=budget) as record:
+        source_tokens = count_tokens(text)
+        sections = [s for s in split_sections(strip_boilerplate(text)) if s.kind not in DROPPED_KINDS]
+        for section in sections:
+            if section.kind == "front":
+                section.text = truncate_to_tokens(section.text, MAX_FRONT_TOKENS)
+        ranked = sorted(sections, key=lambda s: (SECTION_PRIORITY.get(s.kind, 4), s.order))
+        chosen, _ = _pack([(s, s.render()) for s in ranked], budget)
+        chosen.sort(key=lambda pair: pair[0].order)
+        context = "\n\n".join(rendered for _, rendered in chosen)
+        built = BuiltContext(context, count_tokens(context), source_tokens, [s.kind for s, _ in chosen])
+        _report("summary", built)
+        if record is not None:
+            record["attributes"].update(tokens=built.tokens, tokens_saved=built.tokens_saved, sections=built.sections)
+    return built
+
+
+def _terms(text):
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 2}
+
+
+def score_chunk(chunk, question):
+    """Whole-question match first, then share of question terms found in the chunk."""
+    lowered = chunk.lower()
+    phrase = question.strip().lower()
+    score = 1.0 if phrase and phrase in lowered else 0.0
+    terms = _terms(question)
+    if terms:
+        score += len(terms & _terms(chunk)) / len(terms)
+    return score
+
+
+def build_chat_context(chunks, question, budget=None):
+    """Best-matching chunks within ``budget`` tokens, most relevant first."""
+    budget = budget or CHAT_CONTEXT_TOKENS
+    with span("context.chat", budget=budget, chunks=len(chunks)) as record:
+        cleaned = [strip_boilerplate(chunk) for chunk in chunks]
+        scored = [(score_chunk(chunk, question), index, chunk) for index, chunk in enumerate(cleaned) if chunk]
+        relevant = [item for item in scored if item[0] > 0]
+        if not relevant:
+            relevant = scored[:1]  # fallback: ใช้ chunk แรก
+        relevant.sort(key=lambda item: (-item[0], item[1]))
+        chosen, _ = _pack([(index, chunk) for _, index, chunk in relevant], budget)
+        context = "\n".join(text for _, text in chosen)
+        # Baseline is what the old prompt would have sent: every chunk with a literal match
+        baseline = [chunk for chunk in chunks if question.lower() in chunk.lower()] or chunks[:1]
+        built = BuiltContext(context, count_tokens(context), count_tokens("\n".join(baseline)),
+                             [index for index, _ in chosen])
+        _report("chat", built)
+        if record is not None:
+            record["attributes"].update(tokens=built.tokens, tokens_saved=built.tokens_saved, chunks_used=built.sections)
+    return built
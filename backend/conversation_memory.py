@@ -0,0 +1,190 @@
+"""
+Bounded chat history for RAG sessions.
+
+Follow-up questions need the conversation so far, but resending every turn
+would grow prompts (and latency) without limit. Each session keeps:
+
+* the last ``CHAT_MEMORY_TURNS`` turns verbatim, each side cut to
+  ``CHAT_MEMORY_TURN_TOKENS``;
+* a rolling summary of everything older, at most
+  ``CHAT_MEMORY_SUMMARY_TOKENS``.
+
+When a turn falls out of the verbatim window it is folded into the summary
+by a background LLM call (an extractive digest if that fails), off the
+request path. So the history part of a prompt never exceeds
+``turns * 2 * turn_tokens + summary_tokens`` however long the conversation
+runs. Memory is written through to the upload store next to the session,
+so a restart or another node that takes the session over keeps it.
+"""
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import llm_gateway
+from context_builder import count_tokens, truncate_to_tokens
+from deadline import bind_deadline
+from executors import llm_pool
+from json_logging import get_logger
+from metrics import Counter, Histogram
+from upload_store import upload_store
+
+logger = get_logger(__name__)
+
+CHAT_MEMORY_TURNS = int(os.getenv("CHAT_MEMORY_TURNS", "3"))
+CHAT_MEMORY_TURN_TOKENS = int(os.getenv("CHAT_MEMORY_TURN_TOKENS", "250"))
+CHAT_MEMORY_SUMMARY_TOKENS = int(os.getenv("CHAT_MEMORY_SUMMARY_TOKENS", "300"))
+# Sessions whose memory is kept in process; the rest are read back from the upload store
+CHAT_MEMORY_CACHE_SIZE = 10000
+
+MEMORY_FOLDS = Counter(
+    "botchana_chat_memory_folds_total",
+    "Chat turns folded into a session's rolling summary, by method",
+    ["method"],
+)
+MEMORY_TOKENS = Histogram(
+    "botchana_chat_memory_tokens",
+    "Tokens of conversation history sent with a chat prompt",
+    buckets=(0, 100, 250, 500, 1000, 1500, 2000, 3000),
+)
+
+
+@dataclass
+class Memory:
+    summary: str = ""
+    turns: list = field(default_factory=list)  # [question, answer], oldest first
+    folded: int = 0  # turns already folded into the summary
+    folding: bool = False
+
+    def to_dict(self):
+        return {"summary": self.summary, "turns": self.turns, "folded": self.folded}
+
+
+def last_question(messages):
+    return next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+
+
+class ConversationMemory:
+    def __init__(self, turns=CHAT_MEMORY_TURNS, turn_tokens=CHAT_MEMORY_TURN_TOKENS,
+                 summary_tokens=CHAT_MEMORY_SUMMARY_TOKENS, store=upload_store, executor=llm_pool):
+        self.turns = turns
+        self.turn_tokens = turn_tokens
+        self.summary_tokens = summary_tokens
+        self._store = store
+        self._executor = executor
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, session_id):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is not None:
+                self._sessions.move_to_end(session_id)
+                return memory
+        stored = self._store.get_memory(session_id)
+        memory = Memory(**stored) if stored else Memory()
+        with self._lock:
+            memory = self._sessions.setdefault(session_id, memory)
+            while len(self._sessions) > CHAT_MEMORY_CACHE_SIZE:
+                self._sessions.popitem(last=False)
+        return memory
+
+    def _save(self, session_id, memory):
+        self._store.put_memory(session_id, memory.summary, memory.turns, memory.folded)
+
+    def messages(self, session_id):
+        """History as chat messages: the rolling summary, then the recent turns verbatim"""
+        memory = self._get(session_id)
+        with self._lock:
+            summary, recent = memory.summary, list(memory.turns[-self.turns:])
+        messages = []
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        for question, answer in recent:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        MEMORY_TOKENS.observe(sum(count_tokens(message["content"]) for message in messages))
+        return messages
+
+    def record(self, session_id, question, answer):
+        """Remember a finished turn; older turns are folded into the summary in the background"""
+        memory = self._get(session_id)
+        turn = [truncate_to_tokens(question, self.turn_tokens), truncate_to_tokens(answer, self.turn_tokens)]
+        with self._lock:
+            memory.turns.append(turn)
+            fold = len(memory.turns) > self.turns and not memory.folding
+            if fold:
+                memory.folding = True
+        self._save(session_id, memory)
+        if fold:
+            self._executor.submit(self._fold, session_id, memory)
+
+    def _fold(self, session_id, memory):
+        # Runs after the chat request has answered, so its deadline no longer applies
+        with bind_deadline(None):
+            self._fold_overflow(session_id, memory)
+
+    def _fold_overflow(self, session_id, memory):
+        try:
+            while True:
+                with self._lock:
+                    overflow = list(memory.turns[:-self.turns]) if len(memory.turns) > self.turns else []
+                    summary = memory.summary
+                if not overflow:
+                    return
+                folded, method = self._compress(summary, overflow)
+                with self._lock:
+                    # Only appends happen meanwhile, so the overflow is still at the front
+                    del memory.turns[:len(overflow)]
+                    memory.summary = folded
+                    memory.folded += len(overflow)
+                MEMORY_FOLDS.inc(len(overflow), method=method)
+                self._save(session_id, memory)
+        except Exception as e:
+            logger.error(f"Folding chat memory failed: {e}", extra={"session_id": session_id})
+        finally:
+            with self._lock:
+                memory.folding = False
+
+    def _compress(self, summary, turns):
+        """(new summary within summary_tokens, method)"""
+        dialogue = "\n".join(f"Q: {question}\nA: {answer}" for question, answer in turns)
+        try:
+            completion = llm_gateway.gateway.complete(
+                [
+                    {"role": "system", "content": "You maintain a running summary of a conversation about a research paper. "
+                                                  "Keep the facts, names and open questions a follow-up question might refer to. "
+                                                  "Answer with the updated summary only, in the language of the conversation."},
+                    {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{dialogue}\n\n"
+                                                f"Updated summary in at most {self.summary_tokens} tokens:"},
+                ],
+                priority=llm_gateway.BACKGROUND,
+                max_tokens=self.summary_tokens,
+                temperature=0.2,
+                purpose="chat_memory",
+            )
+            return truncate_to_tokens(completion.text.strip(), self.summary_tokens), "llm"
+        except Exception as e:
+            logger.warning(f"LLM memory compression failed, keeping an extractive digest: {e}")
+        # Newest content wins: keep the first sentence of each answer and drop the oldest text first
+        digest = " ".join([summary] + [f"Q: {question} A: {answer.split('. ')[0]}" for question, answer in turns]).strip()
+        while count_tokens(digest) > self.summary_tokens and " " in digest:
+            digest = digest[len(digest) // 4:].split(" ", 1)[-1]
+        return digest, "extractive"
+
+    def export(self, session_id):
+        return self._get(session_id).to_dict()
+
+    def forget(self, session_id):
+        """Drop the in-process copy (the session moved to another node); the stored copy stays"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def restore(self, session_id, state):
+        memory = Memory(**{key: state[key] for key in ("summary", "turns", "folded") if key in state})
+        with self._lock:
+            self._sessions[session_id] = memory
+        self._save(session_id, memory)
+
+
+conversation_memory = ConversationMemory()
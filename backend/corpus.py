@@ -0,0 +1,99 @@
+from fastapi import APIRouter, Form, Query, Request
+from fastapi.responses import JSONResponse
+
+import llm_gateway
+from admission import authenticated_user
+from context_builder import CHAT_CONTEXT_TOKENS, count_tokens, truncate_to_tokens
+from corpus_index import corpus_index
+from deadline import RequestAborted
+from executors import io_pool, runs_on
+from json_logging import get_logger
+from metrics import stage_timer
+from usage_ledger import usage_ledger, BudgetExceeded, EXHAUSTED
+
+logger = get_logger(__name__)
+
+corpus_router = APIRouter()
+
+# ค้นหาและถามตอบข้าม paper ทั้งหมดที่ระบบเคย index ไว้
+
+def _public_hit(hit):
+    return {key: hit[key] for key in ("paper_id", "title", "url", "source", "ordinal", "score", "text")}
+
+def _sources_context(hits, budget):
+    """Number the retrieved chunks [1], [2], ... and keep as many as fit in ``budget`` tokens"""
+    parts, used = [], 0
+    for number, hit in enumerate(hits, start=1):
+        part = f"[{number}] {hit['title'] or hit['paper_id']}\n{hit['text']}"
+        cost = count_tokens(part)
+        if used + cost > budget:
+            part = truncate_to_tokens(part, budget - used)
+            if part:
+                parts.append(part)
+            break
+        parts.append(part)
+        used += cost
+    return "\n\n".join(parts), len(parts)
+
+def _sources_only(hits):
+    """ใช้งบ LLM ของวันนี้หมดแล้ว: ส่งข้อความที่ค้นเจอให้อ่านเองแทนคำตอบ"""
+    usage_ledger.degrade("sources_only")
+    sources = [{"n": number, **_public_hit(hit)} for number, hit in enumerate(hits, start=1)]
+    return {"answer": "วันนี้ใช้งาน AI ครบงบประมาณแล้ว ด้านล่างคือข้อความจาก paper ที่ตรงกับคำถามมากที่สุด",
+            "sources": sources, "degraded": "budget"}
+
+@corpus_router.get("/search")
+@runs_on(io_pool)
+def search_corpus(
+    request: Request,
+    q: str = Query(..., description="คำค้นหา"),
+    k: int = Query(10, ge=1, le=50),
+    paper_id: list[str] = Query(None, description="จำกัดการค้นหาเฉพาะ paper เหล่านี้")
+):
+    # paper ส่วนตัวของผู้ใช้จะถูกค้นด้วยก็ต่อเมื่อยืนยันตัวตนด้วย API key เท่านั้น
+    with stage_timer("corpus_search"):
+        hits = corpus_index.search(q, k=k, user_id=authenticated_user(request.scope), paper_ids=paper_id)
+    return {"query": q, "total": len(hits), "results": [_public_hit(hit) for hit in hits]}
+
+@corpus_router.post("/chat")
+async def chat_with_corpus(
+    request: Request,
+    message: str = Form(...),
+    k: int = Form(8)
+):
+    """Answer from the most relevant chunks across every indexed paper, citing them as [n]"""
+    k = max(1, min(k, 20))
+    with stage_timer("corpus_search"):
+        hits = await io_pool.run(corpus_index.search, message, k, authenticated_user(request.scope))
+    if not hits:
+        return JSONResponse(status_code=404, content={"error": "No indexed papers match this question"})
+    context, used = _sources_context(hits, CHAT_CONTEXT_TOKENS)
+    if usage_ledger.current_state() == EXHAUSTED:
+        return _sources_only(hits[:used])
+    messages = [
+        {"role": "system", "content": (
+            "You answer questions about research papers using only the numbered excerpts provided. "
+            "Cite the excerpts you use as [n]. If the excerpts do not answer the question, say so."
+        )},
+        {"role": "user", "content": f"Excerpts:\n{context}\n\nQuestion: {message}"},
+    ]
+    try:
+        with stage_timer("corpus_answer"):
+            completion = await llm_gateway.gateway.acomplete(messages, priority=llm_gateway.INTERACTIVE, purpose="corpus_answer")
+    except RequestAborted:
+        raise
+    except BudgetExceeded:
+        # Spent by other requests since the check above
+        return _sources_only(hits[:used])
+    except Exception as e:
+        logger.error(f"Corpus chat failed: {e}")
+        return JSONResponse(status_code=502, content={"error": f"Chat failed: {str(e)}"})
+    sources = [
+        {"n": number, **{key: hit[key] for key in ("paper_id", "title", "url", "ordinal", "score")}}
+        for number, hit in enumerate(hits[:used], start=1)
+    ]
+    return {"answer": completion.text, "sources": sources}
+
+@corpus_router.get("/stats")
+def corpus_stats():
+    return corpus_index.stats()
@@ -0,0 +1,421 @@
+"""
+Persistent retrieval index over every paper the backend has seen.
+
+Papers that are summarized, uploaded or opened in a RAG session are cleaned,
+chunked and appended to a sharded on-disk index, so later questions can
+search across all of them instead of a single session.
+
+* One SQLite file per shard (``CORPUS_INDEX_SHARDS``, by hash of the paper
+  id) under ``CORPUS_INDEX_DIR``. Each shard holds paper metadata, an FTS5
+  full-text index of the chunks and each chunk's sparse embedding.
+* Queries run on every shard in parallel. Each shard returns its best BM25
+  candidates, and the merged candidates are re-ranked by BM25 plus
+  embedding similarity. A shard scores at most ``CORPUS_POSTING_BUDGET``
+  postings per query, so common words cost no more than rare ones.
+* Visibility: arXiv and public-URL papers are public (``owner = ""``).
+  Uploads belong to the uploading client (its admission id, when it sent a
+  known API key), or to ``"anonymous"``, which no search can see.
+* Writes go through a single background writer thread, so ingestion never
+  adds latency to the request that triggered it. Re-adding a paper replaces
+  its chunks.
+"""
+import hashlib
+import heapq
+import os
+import sqlite3
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from context_builder import DROPPED_KINDS, split_sections, strip_boilerplate
+from embeddings import cosine, embed, embed_tokens, tokens
+from json_logging import get_logger
+from metrics import Counter, Gauge, Histogram
+
+logger = get_logger(__name__)
+
+CORPUS_INDEX_DIR = os.getenv("CORPUS_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus_index"))
+CORPUS_INDEX_SHARDS = int(os.getenv("CORPUS_INDEX_SHARDS", "8"))
+PUBLIC = ""
+ANONYMOUS = "anonymous"
+# Features kept per chunk embedding; the tail carries little weight
+VECTOR_FEATURES = 128
+CHUNK_CHARS = 2000
+# Weight of BM25 (vs. embedding similarity) in the final ranking
+BM25_WEIGHT = 0.6
+# Postings a shard may score per query. Query terms are taken rarest first up to
+# this many matching chunks, so a very common word cannot turn a search into a
+# scan of the whole shard. When even the rarest term matches more chunks, only the
+# newest this-many matches are ranked: FTS5 walks the posting lists in rowid order
+# and stops at the LIMIT instead of scoring every match in order to sort them.
+POSTING_BUDGET = int(os.getenv("CORPUS_POSTING_BUDGET", "1000"))
+# Document frequencies only steer the query plan, so they may be a little stale
+FREQUENCY_TTL = 300
+FREQUENCY_CACHE_TERMS = 100000
+# Chunks are ranked without the owner filter (intersecting with the public owner's
+# posting list, i.e. nearly every chunk, is most of the cost of a query) and the
+# owners of this many times the wanted chunks are checked afterwards. Only when too
+# few of them are visible does the shard run the query again with the filter.
+OWNER_OVERFETCH = 2
+
+CORPUS_QUERY_SECONDS = Histogram(
+    "botchana_corpus_query_seconds",
+    "Corpus search latency across all shards",
+)
+CORPUS_CHUNKS_INDEXED = Counter(
+    "botchana_corpus_chunks_indexed_total",
+    "Chunks appended to the corpus index",
+    ["source"],
+)
+CORPUS_CHUNKS_REUSED = Counter(
+    "botchana_corpus_chunks_reused_total",
+    "Unchanged chunks kept (not re-embedded) when a paper was re-indexed",
+    ["source"],
+)
+CORPUS_WRITE_QUEUE = Gauge(
+    "botchana_corpus_write_queue",
+    "Papers waiting for the corpus index writer",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS papers (
+    paper_id TEXT PRIMARY KEY,
+    title TEXT,
+    url TEXT,
+    source TEXT,
+    owner TEXT NOT NULL DEFAULT '',
+    chunk_count INTEGER,
+    added_at REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+    terms, owner, text UNINDEXED, paper_id UNINDEXED, ordinal UNINDEXED,
+    tokenize = 'unicode61'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_vocab USING fts5vocab(chunks, 'row');
+CREATE TABLE IF NOT EXISTS chunk_vectors (
+    chunk_rowid INTEGER PRIMARY KEY,
+    paper_id TEXT NOT NULL,
+    vector BLOB
+);
+CREATE INDEX IF NOT EXISTS chunk_vectors_paper ON chunk_vectors (paper_id);
+"""
+
+
+def document_id(content):
+    """Id for papers without an arXiv id: digest of the PDF bytes (or text)"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return digest_id(hashlib.sha256(content))
+
+
+def digest_id(digest):
+    """``document_id`` from a sha256 object that was fed the content incrementally"""
+    return "doc:" + digest.hexdigest()[:32]
+
+
+def chunk_text(text, max_chunk_len=CHUNK_CHARS):
+    """Clean paper text, drop references/acknowledgements and pack paragraphs into ~max_chunk_len chunks"""
+    sections = [s for s in split_sections(strip_boilerplate(text)) if s.kind not in DROPPED_KINDS]
+    chunks, chunk = [], ""
+    for section in sections:
+        for paragraph in section.render().split("\n"):
+            if chunk and len(chunk) + len(paragraph) > max_chunk_len:
+                chunks.append(chunk.strip())
+                chunk = ""
+            chunk += paragraph + "\n"
+    if chunk.strip():
+        chunks.append(chunk.strip())
+    return chunks
+
+
+def _pack_vector(vector):
+    top = heapq.nlargest(VECTOR_FEATURES, vector.items(), key=lambda item: item[1])
+    return struct.pack(f"{len(top)}I{len(top)}f", *(i for i, _ in top), *(w for _, w in top))
+
+
+def _unpack_vector(blob):
+    n = len(blob) // 8
+    values = struct.unpack(f"{n}I{n}f", blob)
+    return dict(zip(values[:n], values[n:]))
+
+
+def _quote(term):
+    # Quote every term: FTS5 operators and punctuation in user text must not be parsed
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _owner_token(owner):
+    # One opaque token per owner: the filter then runs inside FTS5 instead of reading every
+    # matching row, and "alice" can never match the tokens of "alice.smith"
+    return "owner" + hashlib.md5(owner.encode("utf-8")).hexdigest()[:16]
+
+
+def _match_expressions(terms, frequency):
+    """(FTS5 query, postings it scores) to try in order, built from the rarest terms that fit the posting budget.
+
+    ``frequency(term)`` is the number of chunks containing ``term`` (0 when none do).
+    """
+    frequencies = [(frequency(term), term) for term in terms]
+    frequencies = [(count, term) for count, term in frequencies if count]
+    if not frequencies:
+        return []
+    frequencies.sort()
+    chosen, postings = [], 0
+    for frequency, term in frequencies:
+        if chosen and postings + frequency > POSTING_BUDGET:
+            break
+        chosen.append(term)
+        postings += frequency
+    if postings <= POSTING_BUDGET or len(frequencies) == 1:
+        return [(" OR ".join(_quote(term) for term in chosen), postings)]
+    # Even the rarest term is common here: chunks with every term first, then the rarest term alone
+    return [(" AND ".join(_quote(term) for _, term in frequencies), sum(f for f, _ in frequencies)),
+            (_quote(frequencies[0][1]), frequencies[0][0])]
+
+
+class CorpusIndex:
+    def __init__(self, directory=CORPUS_INDEX_DIR, shards=CORPUS_INDEX_SHARDS):
+        self.directory = directory
+        self.shards = shards
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._writer = None
+        self._readers = None
+        self._frequencies = [{} for _ in range(shards)]  # per shard: term -> (chunks containing it, expires)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    # --- storage ---------------------------------------------------------
+
+    def _path(self, shard):
+        return os.path.join(self.directory, f"shard-{shard:02d}.sqlite")
+
+    def _ensure_initialized(self):
+        if self._initialized:
+            return
+        with self._init_lock:
+            if self._initialized:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            for shard in range(self.shards):
+                conn = sqlite3.connect(self._path(shard))
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+                conn.close()
+            # One reader thread per shard keeps each shard's connection and page cache warm
+            self._readers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"corpus-read-{shard:02d}")
+                             for shard in range(self.shards)]
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="corpus-write")
+            self._initialized = True
+
+    def _conn(self, shard):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(shard)
+        if conn is None:
+            conn = conns[shard] = sqlite3.connect(self._path(shard))
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    def shard_for(self, paper_id):
+        return int(hashlib.md5(paper_id.encode("utf-8")).hexdigest(), 16) % self.shards
+
+    # --- writes ----------------------------------------------------------
+
+    def add_paper(self, paper_id, chunks, title="", url="", source="", owner=PUBLIC):
+        """Index (or re-index) a paper synchronously; returns the number of chunks stored.
+
+        Re-indexing keeps the rows of chunks whose text is unchanged, so a new
+        version of a paper only tokenizes and embeds the chunks that changed.
+        """
+        self._ensure_initialized()
+        chunks = [chunk for chunk in chunks if chunk and chunk.strip()]
+        conn = self._conn(self.shard_for(paper_id))
+        owner_token = _owner_token(owner)
+        embedded = 0
+        with conn:
+            existing = {}
+            for rowid, text, ordinal, stored_owner in conn.execute(
+                "SELECT c.rowid, c.text, c.ordinal, c.owner FROM chunk_vectors v JOIN chunks c ON c.rowid = v.chunk_rowid "
+                "WHERE v.paper_id = ?", (paper_id,)
+            ):
+                existing.setdefault(text, []).append((rowid, ordinal, stored_owner))
+            for ordinal, chunk in enumerate(chunks):
+                if existing.get(chunk):
+                    rowid, old_ordinal, stored_owner = existing[chunk].pop()
+                    if old_ordinal != ordinal or stored_owner != owner_token:
+                        conn.execute("UPDATE chunks SET ordinal = ?, owner = ? WHERE rowid = ?", (ordinal, owner_token, rowid))
+                    continue
+                # Index our own normalized, stemmed terms so queries and the vocabulary agree
+                words = tokens(chunk)
+                cursor = conn.execute(
+                    "INSERT INTO chunks (terms, owner, text, paper_id, ordinal) VALUES (?, ?, ?, ?, ?)",
+                    (" ".join(words), owner_token, chunk, paper_id, ordinal),
+                )
+                conn.execute("INSERT INTO chunk_vectors (chunk_rowid, paper_id, vector) VALUES (?, ?, ?)",
+                             (cursor.lastrowid, paper_id, _pack_vector(embed_tokens(words, char_ngrams=False))))
+                embedded += 1
+            stale = [(rowid,) for rows in existing.values() for rowid, _, _ in rows]
+            conn.executemany("DELETE FROM chunks WHERE rowid = ?", stale)
+            conn.executemany("DELETE FROM chunk_vectors WHERE chunk_rowid = ?", stale)
+            conn.execute(
+                "INSERT OR REPLACE INTO papers (paper_id, title, url, source, owner, chunk_count, added_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (paper_id, title, url, source, owner, len(chunks), time.time()),
+            )
+        CORPUS_CHUNKS_INDEXED.inc(embedded, source=source or "unknown")
+        CORPUS_CHUNKS_REUSED.inc(len(chunks) - embedded, source=source or "unknown")
+        return len(chunks)
+
+    def _delete(self, conn, paper_id):
+        # chunk_vectors is the indexed way to a paper's chunks (FTS5 metadata columns are not indexed)
+        rowids = [row[0] for row in conn.execute("SELECT chunk_rowid FROM chunk_vectors WHERE paper_id = ?", (paper_id,))]
+        if rowids:
+            conn.executemany("DELETE FROM chunks WHERE rowid = ?", [(rowid,) for rowid in rowids])
+            conn.executemany("DELETE FROM chunk_vectors WHERE chunk_rowid = ?", [(rowid,) for rowid in rowids])
+        conn.execute("DELETE FROM papers WHERE paper_id = ?", (paper_id,))
+
+    def remove_paper(self, paper_id):
+        self._ensure_initialized()
+        conn = self._conn(self.shard_for(paper_id))
+        with conn:
+            self._delete(conn, paper_id)
+
+    def submit(self, paper_id, text=None, chunks=None, **metadata):
+        """Queue a paper for indexing in the background; never raises into the caller."""
+        try:
+            self._ensure_initialized()
+            with self._pending_lock:
+                self._pending += 1
+                CORPUS_WRITE_QUEUE.set(self._pending)
+            return self._writer.submit(self._index_quietly, paper_id, text, chunks, metadata)
+        except Exception as e:
+            logger.warning(f"Could not queue {paper_id} for the corpus index: {e}")
+            return None
+
+    def _index_quietly(self, paper_id, text, chunks, metadata):
+        try:
+            if chunks is None:
+                chunks = chunk_text(text or "")
+            count = self.add_paper(paper_id, chunks, **metadata)
+            logger.info(f"Indexed {paper_id} in corpus ({count} chunks)")
+            return count
+        except Exception as e:
+            logger.error(f"Corpus indexing failed for {paper_id}: {e}")
+            return 0
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+                CORPUS_WRITE_QUEUE.set(self._pending)
+
+    # --- reads -----------------------------------------------------------
+
+    def _frequency(self, shard, conn, term):
+        """Chunks in ``shard`` containing ``term``; cached, since fts5vocab reads the whole posting list to count"""
+        cache = self._frequencies[shard]
+        now = time.monotonic()
+        cached = cache.get(term)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        row = conn.execute("SELECT doc FROM chunks_vocab WHERE term = ?", (term,)).fetchone()
+        if len(cache) >= FREQUENCY_CACHE_TERMS:
+            cache.clear()
+        cache[term] = (row[0] if row else 0, now + FREQUENCY_TTL)
+        return cache[term][0]
+
+    def _search_shard(self, shard, terms, owners, paper_ids, limit):
+        conn = self._conn(shard)
+        # The owner column has weight 0, so filtering on it never changes a chunk's score
+        sql = "SELECT rowid, bm25(chunks, 1.0, 0.0) AS score FROM chunks WHERE chunks MATCH ?"
+        owner_tokens = {_owner_token(owner) for owner in owners}
+        visible = "owner : (%s)" % " OR ".join(_quote(token) for token in sorted(owner_tokens))
+        filters = []
+        if paper_ids:
+            sql += " AND paper_id IN (%s)" % ",".join("?" * len(paper_ids))
+            filters.extend(paper_ids)
+
+        def ranked(expression, postings, count):
+            query = sql
+            if postings > POSTING_BUDGET:
+                query += f" ORDER BY rowid DESC LIMIT {POSTING_BUDGET}"
+            return conn.execute(f"SELECT rowid, score FROM ({query}) ORDER BY score LIMIT ?",
+                                [expression, *filters, count]).fetchall()
+
+        def content(candidates):
+            # Only the chunks that made the cut are read from the content table
+            found = {rowid: (paper_id, ordinal, text, owner) for rowid, paper_id, ordinal, text, owner in conn.execute(
+                "SELECT rowid, paper_id, ordinal, text, owner FROM chunks WHERE rowid IN (%s)" % ",".join("?" * len(candidates)),
+                [rowid for rowid, _ in candidates],
+            ).fetchall()}
+            return [(rowid, *found[rowid][:3], score) for rowid, score in candidates
+                    if rowid in found and found[rowid][3] in owner_tokens]
+
+        rows = []
+        for expression, postings in _match_expressions(terms, lambda term: self._frequency(shard, conn, term)):
+            candidates = ranked(expression, postings, limit * OWNER_OVERFETCH)
+            rows = content(candidates)[:limit]
+            if len(rows) < limit and len(candidates) == limit * OWNER_OVERFETCH:
+                # Mostly other users' chunks at the top: let FTS5 skip them
+                rows = content(ranked(f"({expression}) AND {visible}", postings, limit))
+            if rows:
+                break
+        if not rows:
+            return []
+        vectors = dict(conn.execute(
+            "SELECT chunk_rowid, vector FROM chunk_vectors WHERE chunk_rowid IN (%s)" % ",".join("?" * len(rows)),
+            [row[0] for row in rows],
+        ).fetchall())
+        paper_rows = conn.execute(
+            "SELECT paper_id, title, url, source FROM papers WHERE paper_id IN (%s)" % ",".join("?" * len(rows)),
+            [row[1] for row in rows],
+        ).fetchall()
+        papers = {paper_id: (title, url, source) for paper_id, title, url, source in paper_rows}
+        hits = []
+        for rowid, paper_id, ordinal, text, score in rows:
+            title, url, source = papers.get(paper_id, ("", "", ""))
+            hits.append({"paper_id": paper_id, "ordinal": ordinal, "text": text, "bm25": -score,
+                         "vector": vectors.get(rowid), "title": title, "url": url, "source": source})
+        return hits
+
+    def search(self, query, k=10, user_id=None, paper_ids=None, candidates_per_shard=None):
+        """Top-``k`` chunks for ``query`` visible to ``user_id`` (public papers plus the user's own)."""
+        started = time.perf_counter()
+        self._ensure_initialized()
+        terms = sorted(set(tokens(query)))
+        if not terms:
+            return []
+        owners = [PUBLIC]
+        if user_id and user_id != ANONYMOUS:
+            owners.append(user_id)
+        limit = candidates_per_shard or k + 5
+        futures = [self._readers[shard].submit(self._search_shard, shard, terms, owners, paper_ids, limit)
+                   for shard in range(self.shards)]
+        candidates = [hit for future in futures for hit in future.result()]
+        if candidates:
+            query_vector = embed(query, char_ngrams=False)
+            top_bm25 = max(hit["bm25"] for hit in candidates) or 1.0
+            for hit in candidates:
+                vector = hit.pop("vector")
+                similarity = cosine(query_vector, _unpack_vector(vector)) if vector else 0.0
+                hit["similarity"] = round(similarity, 4)
+                hit["score"] = round(BM25_WEIGHT * hit["bm25"] / top_bm25 + (1 - BM25_WEIGHT) * similarity, 4)
+                hit["bm25"] = round(hit["bm25"], 4)
+            candidates.sort(key=lambda hit: -hit["score"])
+        CORPUS_QUERY_SECONDS.observe(time.perf_counter() - started)
+        return candidates[:k]
+
+    def stats(self):
+        self._ensure_initialized()
+        papers = chunks = 0
+        for shard in range(self.shards):
+            conn = self._conn(shard)
+            papers += conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+            chunks += conn.execute("SELECT COALESCE(SUM(chunk_count), 0) FROM papers").fetchone()[0]
+        return {"papers": papers, "chunks": chunks, "shards": self.shards, "pending_writes": self._pending}
+
+
+corpus_index = CorpusIndex()
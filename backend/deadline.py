@@ -0,0 +1,240 @@
+"""
+End-to-end request deadlines with cooperative cancellation.
+
+``DeadlineMiddleware`` gives every HTTP request a total time budget, taken
+from the ``X-Request-Timeout`` header (seconds) or a per-route default. It
+also watches for client disconnects. The active ``Deadline`` lives in a
+context variable, so it reaches threadpool workers. Long-running stages call
+``check_deadline()`` between units of work (pages, download chunks, retry
+attempts) and cap their own timeouts with ``capped_timeout()``.
+
+When the deadline passes or the client goes away, the middleware answers
+504 right away (or nothing, for a disconnect) and cancels the endpoint. The
+next checkpoint in worker threads then raises ``RequestAborted`` and the
+worker is released.
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.responses import JSONResponse
+
+from metrics import Counter
+
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_DEFAULT", "30"))
+MAX_REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT_MAX", "300"))
+
+# Longest-prefix match on the request path
+ROUTE_TIMEOUTS = {
+    "/summarize": 120.0,
+    "/summarize/status/": 10.0,
+    "/upload-pdf": 120.0,
+    "/api/create_rag_session": 120.0,
+    "/api/chat_with_rag": 90.0,
+    "/api/corpus/chat": 90.0,
+    "/api/bulk/": 60.0,
+    "/arxiv/": 45.0,
+    "/papers/": 45.0,
+    "/admin/profile": MAX_REQUEST_TIMEOUT,
+}
+
+REQUESTS_ABORTED = Counter(
+    "botchana_requests_aborted_total",
+    "Requests whose remaining work was cancelled",
+    ["reason"],
+)
+
+_current = ContextVar("deadline", default=None)
+
+
+class RequestAborted(Exception):
+    """The request ran out of time or its client went away; stop working on it."""
+
+
+class DeadlineExceeded(RequestAborted):
+    pass
+
+
+class ClientDisconnected(RequestAborted):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds, clock=time.monotonic):
+        self._clock = clock
+        self.seconds = seconds
+        self.expires_at = clock() + seconds
+        self._cancelled = threading.Event()
+        self.reason = None
+
+    def remaining(self):
+        return self.expires_at - self._clock()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def cancel(self, reason):
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            if self.reason == "client_disconnected":
+                raise ClientDisconnected("Client disconnected")
+            raise DeadlineExceeded(f"Request cancelled: {self.reason}")
+        if self.expired:
+            self.cancel("deadline_exceeded")
+            raise DeadlineExceeded(f"Request deadline of {self.seconds:g}s exceeded")
+
+
+def current_deadline():
+    return _current.get()
+
+
+@contextmanager
+def bind_deadline(deadline):
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def check_deadline():
+    """Raise RequestAborted if the current request has been cancelled or timed out."""
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check()
+
+
+def capped_timeout(timeout):
+    """``timeout`` limited to the time left in the current request (unchanged outside a request)."""
+    deadline = _current.get()
+    if deadline is None:
+        return timeout
+    deadline.check()
+    return max(0.001, min(timeout, deadline.remaining()))
+
+
+def sleep(seconds):
+    """time.sleep that wakes up early, raising RequestAborted, if the request is cancelled."""
+    deadline = _current.get()
+    if deadline is None:
+        time.sleep(seconds)
+        return
+    deadline._cancelled.wait(max(0.0, min(seconds, deadline.remaining())))
+    deadline.check()
+
+
+def timeout_for_path(path):
+    best, best_len = DEFAULT_REQUEST_TIMEOUT, -1
+    for prefix, seconds in ROUTE_TIMEOUTS.items():
+        if path.startswith(prefix) and len(prefix) > best_len:
+            best, best_len = seconds, len(prefix)
+    return best
+
+
+def _requested_timeout(scope):
+    for name, value in scope.get("headers", []):
+        if name == b"x-request-timeout":
+            try:
+                seconds = float(value.decode())
+            except ValueError:
+                return None
+            if seconds > 0:
+                return min(seconds, MAX_REQUEST_TIMEOUT)
+    return None
+
+
+class DeadlineMiddleware:
+    """Pure ASGI middleware: it has to own ``receive`` to notice disconnects while the endpoint runs."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        deadline = Deadline(_requested_timeout(scope) or timeout_for_path(scope["path"]))
+        # One message of read-ahead: enough to see a disconnect once the body has been read, while a
+        # slow reader still holds the client back instead of having its upload buffered here
+        inbox = asyncio.Queue(maxsize=1)
+        disconnected = asyncio.Event()
+        response_started = False
+        response_finished = False
+
+        async def pump_receive():
+            # Read ahead of the app so a disconnect is seen even while it is busy
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    # Signal first: the app may not be reading, so the put below can wait for good
+                    deadline.cancel("client_disconnected")
+                    disconnected.set()
+                    await inbox.put(message)
+                    return
+                await inbox.put(message)
+
+        async def app_receive():
+            return await inbox.get()
+
+        async def app_send(message):
+            nonlocal response_started, response_finished
+            if response_finished:
+                return  # we already answered on the app's behalf
+            if message["type"] == "http.response.start":
+                response_started = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_finished = True
+            await send(message)
+
+        with bind_deadline(deadline):
+            app_task = asyncio.create_task(self.app(scope, app_receive, app_send))
+        pump_task = asyncio.create_task(pump_receive())
+        disconnect_task = asyncio.create_task(disconnected.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, disconnect_task},
+                timeout=max(0.0, deadline.remaining()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if app_task in done:
+                try:
+                    app_task.result()
+                except RequestAborted as e:
+                    response_finished = True
+                    await self._abort(scope, deadline, send, response_started, str(e))
+                return
+
+            reason = "client_disconnected" if disconnected.is_set() else "deadline_exceeded"
+            if response_started and reason == "deadline_exceeded":
+                # The answer is already on its way out; finishing it beats truncating it
+                await app_task
+                return
+            deadline.cancel(reason)
+            # Async code stops at its next await; threadpool work stops at its next
+            # check_deadline(). We do not wait for it: the worker frees itself.
+            app_task.cancel()
+            app_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            response_finished = True
+            await self._abort(scope, deadline, send, response_started, f"Request deadline of {deadline.seconds:g}s exceeded")
+        finally:
+            pump_task.cancel()
+            disconnect_task.cancel()
+
+    async def _abort(self, scope, deadline, send, response_started, detail):
+        REQUESTS_ABORTED.inc(reason=deadline.reason or "deadline_exceeded")
+        if response_started or deadline.reason == "client_disconnected":
+            return
+        await JSONResponse(status_code=504, content={"detail": detail})(scope, None, send)
@@ -0,0 +1,242 @@
+"""
+Parse-once document model for PDFs.
+
+A PDF is read with PyPDF2 once per content hash, in the ``extract`` process
+pool (``pdf_extract``) so that extraction does not hold this process's GIL.
+The resulting ``ParsedDocument`` holds the page texts, detected sections,
+title candidates, abstract, the span of the references and the chunk
+boundaries, and is kept in a small LRU cache. The summary, title, corpus
+and RAG paths all take what they need from it instead of extracting and
+chunking the PDF again.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from context_builder import split_sections
+from corpus_index import digest_id, document_id
+from deadline import DeadlineExceeded, check_deadline, current_deadline
+from executors import extract_pool
+from json_logging import get_logger
+from lazy import lazy_import
+from metrics import stage_timer, CACHE_EVENTS, PAGES_EXTRACTED
+
+pdf_extract = lazy_import("pdf_extract")
+
+logger = get_logger(__name__)
+
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "32"))
+CHUNK_CHARS = 2000
+UPLOAD_READ_CHUNK = 64 * 1024
+
+_TITLED_AS = re.compile(r'the research paper titled ["\']([^"\']{10,})["\']', re.IGNORECASE)
+
+
+@dataclass
+class Chunk:
+    """``text == document.text[start:end]``; ``page`` is where the chunk starts"""
+    text: str
+    start: int
+    end: int
+    page: int
+
+
+@dataclass
+class ParsedDocument:
+    doc_id: str
+    pages: list
+    text: str
+    page_offsets: list = field(default_factory=list)
+    sections: list = field(default_factory=list)
+    title_candidates: list = field(default_factory=list)
+    abstract: str = ""
+    references_span: tuple = None
+    chunks: list = field(default_factory=list)
+    # Hash of each page's content stream, so a new version of the PDF can reuse unchanged pages
+    page_fingerprints: list = field(default_factory=list)
+    reused_pages: int = 0
+
+    @property
+    def page_count(self):
+        return len(self.pages)
+
+    @property
+    def title(self):
+        return self.title_candidates[0] if self.title_candidates else None
+
+    @property
+    def chunk_texts(self):
+        return [chunk.text for chunk in self.chunks]
+
+
+def title_candidates(first_page, metadata_title=None):
+    """Likely titles, best first: PDF metadata, then heuristics over the first page's lines"""
+    candidates = [metadata_title] if metadata_title else []
+    lines = [line.strip() for line in (first_page or "").split("\n") if line.strip()]
+    # 'The research paper titled "..."'
+    for line in lines:
+        match = _TITLED_AS.search(line) if line.lower().startswith("the research paper titled") else None
+        if match:
+            candidates.append(match.group(1))
+    # A line in quotes
+    for line in lines:
+        if (line.startswith('"') and line.endswith('"') or line.startswith("'") and line.endswith("'")) and len(line) > 10:
+            candidates.append(line.strip('"').strip("'"))
+    # Title Case, more than one capitalized word
+    for line in lines:
+        if len(line) > 10 and sum(1 for w in line.split() if w.istitle()) > 1:
+            candidates.append(line)
+            break
+    # First substantial line
+    for line in lines:
+        if len(line) > 8 and not line.lower().startswith("arxiv"):
+            candidates.append(line)
+            break
+    return list(dict.fromkeys(candidates))
+
+
+def chunk_pages(text, pages, page_offsets, max_chunk_len=CHUNK_CHARS):
+    """Pack whole lines into ~max_chunk_len character chunks of ``text``, the joined non-empty pages"""
+    chunks = []
+    start = end = None
+    start_page = 0
+    for page_num, (page, offset) in enumerate(zip(pages, page_offsets)):
+        if offset is None:
+            continue
+        position = offset
+        for line in page.split("\n"):
+            line_end = position + len(line) + 1
+            if start is not None and end - start + len(line) > max_chunk_len:
+                chunks.append(Chunk(text[start:end], start, end, start_page))
+                start = None
+            if start is None:
+                start, start_page = position, page_num
+            end = line_end
+            position = line_end
+    if start is not None:
+        chunks.append(Chunk(text[start:end], start, end, start_page))
+    return chunks
+
+
+def _build(doc_id, pages, metadata_title=None):
+    page_offsets, offset = [], 0
+    for page in pages:
+        if page.strip():
+            page_offsets.append(offset)
+            offset += len(page) + 1
+        else:
+            page_offsets.append(None)
+    text = "".join(page + "\n" for page, start in zip(pages, page_offsets) if start is not None)
+    sections = split_sections(text)
+    abstract = next((s.text for s in sections if s.kind == "abstract"), "")
+    references = [s for s in sections if s.kind == "references"]
+    references_span = (references[0].start, references[-1].end) if references else None
+    first_page = next((page for page in pages if page.strip()), "")
+    return ParsedDocument(
+        doc_id=doc_id,
+        pages=pages,
+        text=text,
+        page_offsets=page_offsets,
+        sections=sections,
+        title_candidates=title_candidates(first_page, metadata_title),
+        abstract=abstract,
+        references_span=references_span,
+        chunks=chunk_pages(text, pages, page_offsets),
+    )
+
+
+_cache = OrderedDict()
+# Source URL -> document id, so a PDF fetched once (or prefetched) is not downloaded again
+_urls = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def url_key(url):
+    url = url.strip()
+    if url.startswith("http://"):
+        url = "https://" + url[len("http://"):]
+    return url[:-len(".pdf")] if url.endswith(".pdf") else url
+
+
+def document_for_url(url):
+    """Parsed document last fetched from ``url``, if it is still cached"""
+    if not url:
+        return None
+    with _cache_lock:
+        doc_id = _urls.get(url_key(url))
+        document = _cache.get(doc_id) if doc_id else None
+        if document is not None:
+            _cache.move_to_end(doc_id)
+    CACHE_EVENTS.inc(cache="document_url", result="hit" if document is not None else "miss")
+    return document
+
+
+def parse_pdf(pdf_data, source, known_pages=None, url=None):
+    """Structured document for PDF bytes, extracted once and then served from the cache.
+
+    ``known_pages`` (``{fingerprint: text}`` from an earlier version of the
+    same paper) skips text extraction for pages whose content is unchanged.
+    ``url`` records where the bytes came from, for ``document_for_url``.
+    """
+    doc_id = document_id(pdf_data)
+    with _cache_lock:
+        document = _cache.get(doc_id)
+        if document is not None:
+            _cache.move_to_end(doc_id)
+            if url:
+                _remember_url(url, doc_id)
+    if document is not None:
+        CACHE_EVENTS.inc(cache="document", result="hit")
+        return document
+    CACHE_EVENTS.inc(cache="document", result="miss")
+
+    check_deadline()
+    deadline = current_deadline()
+    stop_at = time.time() + deadline.remaining() if deadline is not None else None
+    with stage_timer("pdf_extract"):
+        if extract_pool is None:
+            extracted = pdf_extract.extract_pages(pdf_data, known_pages, stop_at)
+        else:
+            extracted = extract_pool.call(pdf_extract.extract_pages, pdf_data, known_pages, stop_at)
+    if extracted["aborted"]:
+        check_deadline()
+        raise DeadlineExceeded("Request deadline exceeded during PDF extraction")
+    PAGES_EXTRACTED.inc(extracted["extracted"], source=source)
+    document = _build(doc_id, extracted["pages"], extracted["metadata_title"])
+    document.page_fingerprints = extracted["fingerprints"]
+    document.reused_pages = extracted["reused"]
+
+    with _cache_lock:
+        _cache[doc_id] = document
+        _cache.move_to_end(doc_id)
+        while len(_cache) > DOCUMENT_CACHE_SIZE:
+            _cache.popitem(last=False)
+        if url:
+            _remember_url(url, doc_id)
+    return document
+
+
+def _remember_url(url, doc_id):
+    # Caller holds _cache_lock
+    key = url_key(url)
+    _urls[key] = doc_id
+    _urls.move_to_end(key)
+    while len(_urls) > DOCUMENT_CACHE_SIZE * 4:
+        _urls.popitem(last=False)
+
+
+async def read_upload(upload):
+    """Read an ``UploadFile`` in chunks, hashing it on the way; returns (bytes, document id)"""
+    digest = hashlib.sha256()
+    parts = []
+    while True:
+        part = await upload.read(UPLOAD_READ_CHUNK)
+        if not part:
+            break
+        digest.update(part)
+        parts.append(part)
+    return b"".join(parts), digest_id(digest)
@@ -0,0 +1,98 @@
+"""
+Local text embeddings for similarity lookups.
+
+Texts become sparse, L2-normalized vectors of hashed features: content
+words, word bigrams and (down-weighted) character trigrams. The trigrams
+catch typos and Thai text, which has no spaces between words. Nothing
+leaves the process, so an embedding costs microseconds rather than an API
+round trip.
+
+Question words (what/why/how ...) are kept as features on purpose: "why
+does X work" and "what is X" must not look alike.
+"""
+import math
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+from functools import lru_cache
+
+DIMENSIONS = 1 << 20
+
+STOPWORDS = frozenset("""
+a an the of to in on for and or but is are was were be been being do does did this that these those it its
+with by from at as into about than then there their they them we our you your i me my he she his her
+can could would should will shall may might must please paper papers study article
+""".split())
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(_WORD.findall(text))
+
+
+@lru_cache(maxsize=1 << 16)
+def _stem(word):
+    # Light English suffix stripping so "datasets"/"dataset" and "trained"/"training" meet
+    if not word.isascii() or len(word) <= 4:
+        return word
+    for suffix in ("ing", "ies", "es", "ed", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + ("y" if suffix == "ies" else "")
+    return word
+
+
+def tokens(text):
+    """Content words of ``text`` (normalized, stemmed, stopwords and single letters removed).
+
+    Single digits stay: "table 2" and "table 3" are different questions.
+    """
+    return [_stem(word) for word in normalize(text).split()
+            if (len(word) > 1 or word.isdigit()) and word not in STOPWORDS]
+
+
+def numbers(text):
+    """Numbers mentioned in ``text`` (table, figure, section, equation references ...)."""
+    return frozenset(word for word in normalize(text).split() if any(char.isdigit() for char in word))
+
+
+# Vocabulary repeats heavily across papers, so hashing is worth caching
+@lru_cache(maxsize=1 << 18)
+def _index(feature):
+    return zlib.crc32(feature.encode("utf-8")) % DIMENSIONS
+
+
+def embed(text, char_ngrams=True):
+    """Sparse unit vector ``{dimension: weight}`` for ``text`` (empty for text without content words).
+
+    Long passages can skip ``char_ngrams``: they cost most of the time and
+    matter mainly for short, typo-prone questions. Only compare vectors
+    built with the same setting.
+    """
+    return embed_tokens(tokens(text), char_ngrams)
+
+
+def embed_tokens(words, char_ngrams=True):
+    """``embed`` for text already split with ``tokens``."""
+    vector = defaultdict(float)
+    for word in words:
+        vector[_index("w:" + word)] += 1.0
+        if char_ngrams:
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                vector[_index("c:" + padded[i:i + 3])] += 0.25
+    for first, second in zip(words, words[1:]):
+        vector[_index(f"b:{first} {second}")] += 1.0
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    if not norm:
+        return {}
+    return {index: weight / norm for index, weight in vector.items()}
+
+
+def cosine(a, b):
+    """Cosine similarity of two vectors from ``embed`` (both already unit length)."""
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(index, 0.0) for index, weight in a.items())
@@ -0,0 +1,180 @@
+"""
+Named executors, so different kinds of work do not compete for one pool.
+
+Sync FastAPI endpoints all run on anyio's single default threadpool, where a
+burst of PDF extractions (CPU, holding the GIL) or OpenAI waits can use up
+the slots that cheap listing calls need. Instead, each kind of work has its
+own pool, sized on its own:
+
+* ``extract_pool``: a process pool for PDF text extraction
+  (``EXTRACT_PROCESSES``, default: CPU count; ``0`` extracts in the calling
+  thread);
+* ``io_pool``: threads for arXiv, PDF downloads and storage
+  (``IO_POOL_WORKERS``, default 32);
+* ``llm_pool``: threads for requests that spend most of their time waiting
+  on OpenAI (``LLM_POOL_WORKERS``, default 16).
+
+Routes say where they run with ``@runs_on(pool)``, and async code offloads
+with ``await pool.run(fn, ...)``. Each pool exports its queue depth and
+saturation (busy workers / workers) as ``botchana_executor_*{pool}`` gauges.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+import time
+
+from deadline import check_deadline
+from json_logging import get_logger
+from metrics import Counter, Gauge, Histogram
+
+logger = get_logger(__name__)
+
+EXTRACT_PROCESSES = int(os.getenv("EXTRACT_PROCESSES", str(os.cpu_count() or 1)))
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", "32"))
+LLM_POOL_WORKERS = int(os.getenv("LLM_POOL_WORKERS", "16"))
+# How often a thread blocked on a process checks its request deadline
+DEADLINE_POLL_SECONDS = 0.1
+
+EXECUTOR_QUEUE_DEPTH = Gauge(
+    "botchana_executor_queue_depth",
+    "Tasks submitted to a pool and waiting for a worker",
+    ["pool"],
+)
+EXECUTOR_SATURATION = Gauge(
+    "botchana_executor_saturation",
+    "Busy workers of a pool as a fraction of its size",
+    ["pool"],
+)
+EXECUTOR_TASKS = Counter(
+    "botchana_executor_tasks_total",
+    "Tasks run per pool",
+    ["pool"],
+)
+EXECUTOR_TASK_DURATION = Histogram(
+    "botchana_executor_task_seconds",
+    "Time from submitting a task to its result, queueing included",
+    ["pool"],
+)
+
+
+def _process_context():
+    # Forking a process with running threads can copy held locks; the
+    # forkserver starts workers from a clean single-threaded process
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class NamedExecutor:
+    """A lazily started thread or process pool that reports how busy it is"""
+
+    def __init__(self, name, workers, processes=False):
+        self.name = name
+        self.workers = max(1, workers)
+        self.processes = processes
+        self._executor = None
+        self._outstanding = 0
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                if self.processes:
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=_process_context())
+                else:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix=self.name)
+                logger.info(f"Started executor {self.name} with {self.workers} "
+                            f"{'processes' if self.processes else 'threads'}")
+            return self._executor
+
+    def _publish(self):
+        # Pools start a worker per task up to their size, so anything beyond it is queued
+        busy = min(self._outstanding, self.workers)
+        EXECUTOR_QUEUE_DEPTH.set(self._outstanding - busy, pool=self.name)
+        EXECUTOR_SATURATION.set(busy / self.workers, pool=self.name)
+
+    def submit(self, fn, *args, **kwargs):
+        """``concurrent.futures.Future`` for ``fn(*args, **kwargs)``; thread tasks keep the caller's context"""
+        if not self.processes:
+            fn = functools.partial(contextvars.copy_context().run, fn)
+        started = time.perf_counter()
+        with self._lock:
+            self._outstanding += 1
+            self._publish()
+        try:
+            future = self._pool().submit(fn, *args, **kwargs)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._finished(started)
+            self._restart()
+            raise
+        except BaseException:
+            self._finished(started)
+            raise
+        future.add_done_callback(lambda _: self._finished(started))
+        return future
+
+    def _finished(self, started):
+        with self._lock:
+            self._outstanding -= 1
+            self._publish()
+        EXECUTOR_TASKS.inc(pool=self.name)
+        EXECUTOR_TASK_DURATION.observe(time.perf_counter() - started, pool=self.name)
+
+    def _restart(self):
+        with self._lock:
+            broken, self._executor = self._executor, None
+        if broken is not None:
+            logger.warning(f"Executor {self.name} broke, starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+
+    def call(self, fn, *args, **kwargs):
+        """Run ``fn`` on this pool and block for the result, giving up when the request deadline runs out"""
+        future = self.submit(fn, *args, **kwargs)
+        while True:
+            try:
+                return future.result(timeout=DEADLINE_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                try:
+                    check_deadline()
+                except BaseException:
+                    future.cancel()  # only stops it if no worker has picked it up yet
+                    raise
+            except concurrent.futures.process.BrokenProcessPool:
+                self._restart()
+                raise
+
+    async def run(self, fn, *args, **kwargs):
+        """Await ``fn(*args, **kwargs)`` on this pool"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def snapshot(self):
+        with self._lock:
+            busy = min(self._outstanding, self.workers)
+            return {"workers": self.workers, "busy": busy, "queued": self._outstanding - busy,
+                    "kind": "process" if self.processes else "thread"}
+
+
+extract_pool = NamedExecutor("extract", EXTRACT_PROCESSES, processes=True) if EXTRACT_PROCESSES > 0 else None
+io_pool = NamedExecutor("io", IO_POOL_WORKERS)
+llm_pool = NamedExecutor("llm", LLM_POOL_WORKERS)
+
+
+def runs_on(pool):
+    """Decorator for a sync endpoint: run it on ``pool`` instead of anyio's default threadpool"""
+    def decorate(fn):
+        @functools.wraps(fn)  # FastAPI reads the parameters through __wrapped__
+        async def endpoint(*args, **kwargs):
+            return await pool.run(fn, *args, **kwargs)
+        endpoint.executor = pool.name
+        return endpoint
+    return decorate
+
+
+def executor_snapshot():
+    pools = [pool for pool in (extract_pool, io_pool, llm_pool) if pool is not None]
+    return {pool.name: pool.snapshot() for pool in pools}
@@ -0,0 +1,134 @@
+"""
+Cheap responses for read endpoints: fast JSON, ETags and compression.
+
+* ``FastJSONResponse`` serializes with ``orjson`` (falls back to the standard
+  encoder if it is not installed).
+* ``json_response(request, content, max_age)`` is what listing routes
+  return. It serializes once, sets an ETag and ``Cache-Control``, answers
+  ``304`` when ``If-None-Match`` matches, and compresses large bodies with
+  brotli (when the ``brotli`` package is installed) or gzip, as the client
+  accepts. Returning a ``Response`` also skips FastAPI's validation of
+  untyped ``list``/``dict`` fields.
+* ``StaticJSON`` does all of that once, at import time, for bodies that
+  never change (``/arxiv/categories``).
+"""
+import gzip
+import hashlib
+import os
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+from json_logging import get_logger
+from metrics import Counter
+
+logger = get_logger(__name__)
+
+try:
+    import orjson
+except ImportError:  # optional: standard json is slower but works
+    orjson = None
+    logger.warning("orjson not installed, read endpoints fall back to the standard JSON encoder")
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+# Smaller bodies are not worth the CPU or the Content-Encoding header
+COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "5"))
+# Listings change when arXiv publishes or a summary lands; a few minutes of staleness is fine
+LISTING_MAX_AGE = int(os.getenv("HTTP_LISTING_MAX_AGE", "300"))
+STATIC_MAX_AGE = 86400
+
+HTTP_BODY_BYTES = Counter(
+    "botchana_http_body_bytes_total",
+    "JSON body bytes of cacheable responses before and after compression",
+    ["stage"],
+)
+HTTP_NOT_MODIFIED = Counter(
+    "botchana_http_not_modified_total",
+    "Responses answered 304 Not Modified from the ETag",
+)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        if orjson is None:
+            return super().render(jsonable_encoder(content))
+        # Types orjson does not know (sets, models) take FastAPI's usual encoding
+        return orjson.dumps(content, default=jsonable_encoder, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def dumps(content):
+    return FastJSONResponse(content).body
+
+
+def _etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+
+def _accepts(request, encoding):
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() == encoding:
+            return params.replace(" ", "") not in ("q=0", "q=0.0")
+    return False
+
+
+def _not_modified(request, etag):
+    candidates = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    return etag in candidates or f"W/{etag}" in candidates or "*" in candidates
+
+
+def _encode(body, encoding, static=False):
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if static else BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if static else GZIP_LEVEL, mtime=0)
+
+
+def _choose_encoding(request, size):
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    if brotli is not None and _accepts(request, "br"):
+        return "br"
+    if _accepts(request, "gzip"):
+        return "gzip"
+    return None
+
+
+def _respond(request, body, etag, max_age, encoded=None):
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}", "Vary": "Accept-Encoding"}
+    if _not_modified(request, etag):
+        HTTP_NOT_MODIFIED.inc()
+        return Response(status_code=304, headers=headers)
+    encoding = _choose_encoding(request, len(body))
+    HTTP_BODY_BYTES.inc(len(body), stage="raw")
+    if encoding is not None:
+        body = (encoded or {}).get(encoding) or _encode(body, encoding)
+        headers["Content-Encoding"] = encoding
+    HTTP_BODY_BYTES.inc(len(body), stage="sent")
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def json_response(request, content, max_age=LISTING_MAX_AGE):
+    """Serialized, ETagged and (when worth it) compressed response for ``content``"""
+    body = dumps(content)
+    return _respond(request, body, _etag(body), max_age)
+
+
+class StaticJSON:
+    """A JSON body that never changes: serialized, hashed and compressed once"""
+
+    def __init__(self, content, max_age=STATIC_MAX_AGE):
+        self.body = dumps(content)
+        self.etag = _etag(self.body)
+        self.max_age = max_age
+        self.encoded = {"gzip": _encode(self.body, "gzip", static=True)}
+        if brotli is not None:
+            self.encoded["br"] = _encode(self.body, "br", static=True)
+
+    def response(self, request):
+        return _respond(request, self.body, self.etag, self.max_age, self.encoded)
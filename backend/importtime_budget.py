@@ -0,0 +1,68 @@
+"""
+Measure backend startup import cost with ``python -X importtime``.
+
+Usage (from the backend folder):
+    python importtime_budget.py                 # import main, budget from IMPORT_TIME_BUDGET_MS
+    python importtime_budget.py --budget-ms 900 --top 15
+
+Exits with status 1 when the cumulative import time of the target module
+exceeds the budget, so it can run as a CI/startup check.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1000"))
+
+
+def measure(module="main"):
+    """Return [(cumulative_us, self_us, name)] for every module imported while importing ``module``."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    rows = measure(args.module)
+    total_ms, direct = None, []
+    children = []
+    # importtime prints children before their parent and indents two spaces per level
+    for cumulative_us, self_us, name in rows:
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((cumulative_us, self_us, name))
+        elif depth == 0:
+            if name.strip() == args.module:
+                total_ms, direct = cumulative_us / 1000, children
+            children = []
+    print(f"import {args.module}: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    print(f"Slowest direct imports of {args.module} (cumulative):")
+    for cumulative_us, _, name in sorted(direct, reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name.strip()}")
+    if total_ms > args.budget_ms:
+        print("FAIL: import time over budget")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
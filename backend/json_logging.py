@@ -0,0 +1,59 @@
+"""
+Structured JSON logging for the backend.
+
+Every record is emitted as a single JSON object on stdout. Extra fields
+passed through ``logger.info(..., extra={...})`` are included as-is.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime, timezone
+
+from tracing import current_request_id, current_span_id
+
+# Attributes present on every LogRecord; anything else came from ``extra``.
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        request_id = current_request_id()
+        if request_id:
+            payload["request_id"] = request_id
+            payload["span_id"] = current_span_id()
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def configure_logging():
+    """Install the JSON handler on the root logger once per process."""
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter())
+        root = logging.getLogger()
+        root.handlers[:] = [handler]
+        root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+        _configured = True
+
+
+def get_logger(name):
+    configure_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,102 @@
+"""
+Lazy, thread-safe initialization for external clients and heavy modules.
+
+Nothing here does work at import time. A ``LazyResource`` runs its factory
+on first ``get()`` (double-checked under a lock, so concurrent first calls
+build it once) and remembers how long that took. A failed factory is not
+cached, so the next call retries instead of leaving the process broken.
+"""
+import importlib
+import threading
+import time
+
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+class LazyResource:
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._ready = False
+        self.init_seconds = None
+        self.last_error = None
+        with _resources_lock:
+            _resources[name] = self
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def get(self):
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    raise
+                self.init_seconds = time.perf_counter() - started
+                self.last_error = None
+                self._ready = True
+        return self._value
+
+    def reset(self):
+        with self._lock:
+            self._value = None
+            self._ready = False
+
+
+class LazyModule:
+    """Module proxy: ``feedparser = lazy_import("feedparser")`` imports on first attribute access."""
+
+    def __init__(self, module_name):
+        self._resource = LazyResource(f"module:{module_name}", lambda: importlib.import_module(module_name))
+
+    def __getattr__(self, attr):
+        return getattr(self._resource.get(), attr)
+
+
+_modules = {}
+
+
+def lazy_import(module_name):
+    with _resources_lock:
+        module = _modules.get(module_name)
+    if module is None:
+        module = LazyModule(module_name)
+        with _resources_lock:
+            module = _modules.setdefault(module_name, module)
+    return module
+
+
+def readiness():
+    """Warm-up state of every registered resource."""
+    with _resources_lock:
+        resources = list(_resources.values())
+    return {
+        resource.name: {
+            "ready": resource.ready,
+            "init_seconds": round(resource.init_seconds, 4) if resource.init_seconds is not None else None,
+            "error": resource.last_error,
+        }
+        for resource in resources
+    }
+
+
+def warm(names=None):
+    """Initialize the named resources (all when ``names`` is None); returns the names that failed."""
+    with _resources_lock:
+        resources = [r for r in _resources.values() if names is None or r.name in names]
+    failed = []
+    for resource in resources:
+        try:
+            resource.get()
+        except Exception:
+            failed.append(resource.name)
+    return failed
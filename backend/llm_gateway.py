@@ -0,0 +1,421 @@
+"""
+Async LLM gateway shared by every OpenAI call in the process.
+
+The gateway runs its own event loop on a background thread and holds one
+``AsyncOpenAI`` client, so:
+
+* async endpoints ``await gateway.acomplete(...)`` without blocking the
+  server's event loop;
+* sync code (threadpool endpoints, background jobs) calls
+  ``gateway.complete(...)``, which waits on the gateway loop and stays
+  cancellable by the request deadline;
+* streaming endpoints iterate ``gateway.astream(...)`` and get text deltas
+  as the model produces them.
+
+Requests are dispatched from a priority queue (``INTERACTIVE`` chat ahead of
+``BACKGROUND`` summarization) through a token-bucket limiter sized to the
+account's requests-per-minute and tokens-per-minute quota. A 429 pauses the
+whole limiter for the server's ``Retry-After`` (or exponential backoff) and
+puts the request back at the front of its priority class.
+
+Every call is billed to the endpoint and user of the calling context, and
+tagged with a ``purpose``, in the ``usage_ledger``. A caller whose daily
+budget is spent gets ``BudgetExceeded`` before anything is queued.
+"""
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+from circuit_breaker import OPENAI
+from clients import environment
+from deadline import RequestAborted, capped_timeout, current_deadline
+from json_logging import get_logger
+from lazy import LazyResource, lazy_import
+from metrics import Counter, Gauge, Histogram, LLM_TOKENS
+from usage_ledger import usage_ledger, current_usage
+
+logger = get_logger(__name__)
+
+openai = lazy_import("openai")
+
+INTERACTIVE = 0
+BACKGROUND = 10
+_PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+
+LLM_QUEUE_DEPTH = Gauge(
+    "botchana_llm_queue_depth",
+    "LLM requests waiting for a dispatch slot",
+    ["priority"],
+)
+LLM_QUEUE_WAIT = Histogram(
+    "botchana_llm_queue_wait_seconds",
+    "Time from submission to dispatch",
+    ["priority"],
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "botchana_llm_time_to_first_token_seconds",
+    "Time from submission to the first streamed token",
+    ["priority"],
+)
+LLM_RATE_LIMITED = Counter(
+    "botchana_llm_rate_limited_total",
+    "429 responses from the LLM provider",
+)
+
+
+def _priority_name(priority):
+    return _PRIORITY_NAMES.get(priority, str(priority))
+
+
+def estimate_tokens(messages, max_tokens):
+    """Rough pre-flight token estimate (~4 characters per token) used to reserve TPM quota"""
+    chars = sum(len(m.get("content") or "") for m in messages)
+    return chars // 4 + max_tokens
+
+
+class TokenBucketLimiter:
+    """Requests-per-minute and tokens-per-minute buckets plus a global pause after a 429."""
+
+    def __init__(self, rpm, tpm, clock=time.monotonic):
+        self._clock = clock
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def delay(self, tokens):
+        """Seconds until a request of ``tokens`` may be sent (0 if it may go now)."""
+        self._refill()
+        tokens = min(tokens, self.tpm)
+        waits = [self._paused_until - self._clock()]
+        if self._requests < 1:
+            waits.append((1 - self._requests) * 60 / self.rpm)
+        if self._tokens < tokens:
+            waits.append((tokens - self._tokens) * 60 / self.tpm)
+        return max(0.0, *waits)
+
+    def consume(self, tokens):
+        self._refill()
+        self._requests -= 1
+        self._tokens -= min(tokens, self.tpm)
+
+    def adjust(self, reserved, actual):
+        """Settle a reservation once the provider reports real usage."""
+        self._tokens = min(self.tpm, self._tokens + reserved - actual)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+@dataclass
+class Completion:
+    text: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+@dataclass(order=True)
+class _Request:
+    priority: int
+    seq: int
+    messages: list = field(compare=False)
+    options: dict = field(compare=False)
+    reserved_tokens: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+    task: asyncio.Task = field(default=None, compare=False)
+    on_delta: object = field(default=None, compare=False)
+    usage: dict = field(default=None, compare=False)  # usage_ledger tags: endpoint, user, purpose
+
+
+def _is_rate_limited(error):
+    return getattr(error, "status_code", None) == 429
+
+
+def _breaker_neutral(error):
+    # A 429 is our own quota, handled by the limiter; a cancelled task is the caller giving up
+    return _is_rate_limited(error) or isinstance(error, asyncio.CancelledError)
+
+
+def _retry_after(error, attempt):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return min(60.0, 2 ** attempt) + random.uniform(0, 0.5)
+
+
+def _build_async_client():
+    environment.get()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY is required")
+    # The SDK's own retries would hide 429s from the shared limiter
+    return openai.AsyncOpenAI(api_key=api_key, timeout=60.0, max_retries=0)
+
+
+class LLMGateway:
+    def __init__(self, client_factory=_build_async_client, rpm=None, tpm=None,
+                 max_concurrency=None, max_retries=None):
+        self._client = LazyResource("openai_async", client_factory)
+        self._limiter = TokenBucketLimiter(
+            rpm or int(os.getenv("OPENAI_RPM", "500")),
+            tpm or int(os.getenv("OPENAI_TPM", "200000")),
+        )
+        self.max_concurrency = max_concurrency or int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+        self._seq = itertools.count()
+        self._queue = []
+        self._in_flight = 0
+        self._loop = None
+        self._wakeup = None
+        self._start_lock = threading.Lock()
+
+    # --- loop management -------------------------------------------------
+
+    def _ensure_started(self):
+        if self._loop is not None:
+            return self._loop
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self._wakeup = asyncio.Event()
+                    loop.create_task(self._dispatch_forever())
+                    ready.set()
+                    loop.run_forever()
+
+                threading.Thread(target=run, name="llm-gateway", daemon=True).start()
+                ready.wait()
+                self._loop = loop
+        return self._loop
+
+    def queue_depth(self):
+        return len(self._queue)
+
+    # --- public API -------------------------------------------------------
+
+    async def acomplete(self, messages, priority=BACKGROUND, model=DEFAULT_MODEL, max_tokens=1000,
+                        temperature=0.3, timeout=None, purpose=None):
+        """Complete ``messages`` from async code without blocking the caller's event loop."""
+        options = self._options(model, max_tokens, temperature, timeout)
+        usage = self._usage(purpose)
+        future = asyncio.run_coroutine_threadsafe(self._submit(messages, priority, options, usage=usage),
+                                                  self._ensure_started())
+        return await asyncio.wrap_future(future)
+
+    async def astream(self, messages, priority=INTERACTIVE, model=DEFAULT_MODEL, max_tokens=1000,
+                      temperature=0.3, timeout=None, purpose=None):
+        """Async generator of text deltas; the request is queued and rate limited like any other."""
+        options = self._options(model, max_tokens, temperature, timeout)
+        usage = self._usage(purpose)
+        options["stream"] = True
+        options["stream_options"] = {"include_usage": True}
+        loop = asyncio.get_running_loop()
+        deltas = asyncio.Queue()
+
+        def on_delta(text):
+            # Called on the gateway loop; hand the delta over to the caller's loop
+            loop.call_soon_threadsafe(deltas.put_nowait, text)
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._submit(messages, priority, options, on_delta, usage), self._ensure_started())
+        finished = asyncio.wrap_future(future)
+        try:
+            while True:
+                next_delta = asyncio.ensure_future(deltas.get())
+                await asyncio.wait({next_delta, finished}, return_when=asyncio.FIRST_COMPLETED)
+                if next_delta.done():
+                    yield next_delta.result()
+                    continue
+                next_delta.cancel()
+                while not deltas.empty():
+                    yield deltas.get_nowait()
+                finished.result()  # re-raise the gateway's error, if any
+                return
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def complete(self, messages, priority=BACKGROUND, model=DEFAULT_MODEL, max_tokens=1000,
+                 temperature=0.3, timeout=None, purpose=None):
+        """Blocking variant for threadpool code; gives up as soon as the request deadline is cancelled."""
+        options = self._options(model, max_tokens, temperature, timeout)
+        usage = self._usage(purpose)
+        future = asyncio.run_coroutine_threadsafe(self._submit(messages, priority, options, usage=usage),
+                                                  self._ensure_started())
+        deadline = current_deadline()
+        while True:
+            try:
+                return future.result(timeout=0.1 if deadline else None)
+            except concurrent.futures.TimeoutError:
+                try:
+                    deadline.check()
+                except RequestAborted:
+                    future.cancel()
+                    raise
+
+    def _options(self, model, max_tokens, temperature, timeout):
+        # Resolved on the caller's thread: the request deadline is not visible on the gateway loop
+        timeout = capped_timeout(timeout if timeout is not None else OPENAI.timeout())
+        return {"model": model, "max_tokens": max_tokens, "temperature": temperature, "timeout": timeout}
+
+    def _usage(self, purpose):
+        # Also resolved on the caller's thread, where the endpoint and user are bound
+        endpoint, user = current_usage()
+        usage_ledger.check(user)
+        return {"endpoint": endpoint, "user": user, "purpose": purpose}
+
+    # --- gateway loop -----------------------------------------------------
+
+    async def _submit(self, messages, priority, options, on_delta=None, usage=None):
+        request = _Request(
+            priority=priority,
+            seq=next(self._seq),
+            messages=messages,
+            options=options,
+            reserved_tokens=estimate_tokens(messages, options["max_tokens"]),
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=time.perf_counter(),
+            on_delta=on_delta,
+            usage=usage,
+        )
+        self._enqueue(request)
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            request.future.cancel()
+            if request.task is not None:
+                request.task.cancel()
+            raise
+
+    def _enqueue(self, request):
+        heapq.heappush(self._queue, request)
+        LLM_QUEUE_DEPTH.inc(priority=_priority_name(request.priority))
+        self._wakeup.set()
+
+    def _pop(self):
+        request = heapq.heappop(self._queue)
+        LLM_QUEUE_DEPTH.dec(priority=_priority_name(request.priority))
+        return request
+
+    async def _dispatch_forever(self):
+        while True:
+            if not self._queue or self._in_flight >= self.max_concurrency:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            head = self._queue[0]
+            if head.future.done():  # caller gave up while queued
+                self._pop()
+                continue
+            delay = self._limiter.delay(head.reserved_tokens)
+            if delay > 0:
+                # Re-check early if something more urgent arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            request = self._pop()
+            LLM_QUEUE_WAIT.observe(time.perf_counter() - request.enqueued_at, priority=_priority_name(request.priority))
+            self._limiter.consume(request.reserved_tokens)
+            self._in_flight += 1
+            request.task = asyncio.get_running_loop().create_task(self._run(request))
+
+    async def _run(self, request):
+        requeued = False
+        try:
+            client = self._client.get()
+            with OPENAI.call(neutral=_breaker_neutral):
+                response = await client.chat.completions.create(messages=request.messages, **request.options)
+                if request.on_delta is not None:
+                    response = await self._consume_stream(request, response)
+            usage = getattr(response, "usage", None)
+            completion = Completion(
+                text=(response.choices[0].message.content or "").strip(),
+                model=getattr(response, "model", None) or request.options["model"],
+                prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            )
+            if usage is not None:
+                self._limiter.adjust(request.reserved_tokens, completion.prompt_tokens + completion.completion_tokens)
+                LLM_TOKENS.inc(completion.prompt_tokens, model=completion.model, kind="prompt")
+                LLM_TOKENS.inc(completion.completion_tokens, model=completion.model, kind="completion")
+            else:
+                # Budgets still need a figure when the provider reports none
+                completion.prompt_tokens = estimate_tokens(request.messages, 0)
+                completion.completion_tokens = len(completion.text) // 4
+            usage_ledger.record(completion.model, completion.prompt_tokens, completion.completion_tokens,
+                                **(request.usage or {}))
+            if not request.future.done():
+                request.future.set_result(completion)
+        except asyncio.CancelledError:
+            if not request.future.done():
+                request.future.cancel()
+        except Exception as e:
+            if _is_rate_limited(e) and request.attempts < self.max_retries and not request.future.done():
+                LLM_RATE_LIMITED.inc()
+                wait = _retry_after(e, request.attempts)
+                logger.warning(f"LLM rate limited, pausing {wait:.1f}s", extra={"attempt": request.attempts + 1})
+                self._limiter.pause(wait)
+                request.attempts += 1
+                request.task = None
+                requeued = True
+                self._enqueue(request)  # keeps its original seq, so it stays ahead of newer work
+            elif not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self._in_flight -= 1
+            if not requeued:
+                request.task = None
+            self._wakeup.set()
+
+    async def _consume_stream(self, request, stream):
+        """Forward deltas as they arrive; returns a response-shaped object for the bookkeeping in ``_run``."""
+        parts, model, usage = [], None, None
+        async for chunk in stream:
+            model = getattr(chunk, "model", None) or model
+            usage = getattr(chunk, "usage", None) or usage
+            for choice in getattr(chunk, "choices", None) or []:
+                text = getattr(choice.delta, "content", None)
+                if text:
+                    if not parts:
+                        LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - request.enqueued_at,
+                                                        priority=_priority_name(request.priority))
+                    parts.append(text)
+                    request.on_delta(text)
+        message = SimpleNamespace(content="".join(parts))
+        return SimpleNamespace(model=model, usage=usage, choices=[SimpleNamespace(message=message)])
+
+
+gateway = LLMGateway()
@@ -1,15 +1,91 @@
-from fastapi import FastAPI, Query, File, UploadFile, HTTPException
+import os
+# Most settings are read by os.getenv when their module is imported, so the .env has to be loaded first
+from dotenv import load_dotenv
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env"))
+
+import threading
+import time
+from fastapi import FastAPI, Query, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, JSONResponse
 from pydantic import BaseModel
-from service import fetch_and_summarize, process_uploaded_pdf, fetch_all_arxiv_papers, fetch_papers_by_category
-from supabase import create_client
-from supabase_config import SUPABASE_URL, SUPABASE_KEY
+from typing import Optional
+from service import (
+    fetch_and_summarize, process_uploaded_pdf, fetch_all_arxiv_articles, fetch_all_arxiv_papers,
+    fetch_papers_by_category, summary_status, FALLBACK_PREFIX, FULL_TIER
+)
 import io
 from chatbot_rag import chatbot_router
+from admin import admin_router
+from corpus import corpus_router
+from bulk import bulk_router
+from bulk_jobs import bulk_jobs
+from precompute import precomputer, PRECOMPUTE_ENABLED
+from document import read_upload
+from upload_store import upload_store
+from paper_repository import paper_repository
+from prefetch import prefetcher
+from json_logging import get_logger
+from metrics import stage_timer, render_prometheus, HTTP_IN_FLIGHT, HTTP_REQUEST_DURATION, PROMETHEUS_CONTENT_TYPE
+from tracing import bind_request_id, new_request_id, span
+from circuit_breaker import breaker_snapshot
+from lazy import readiness, warm
+from deadline import DeadlineMiddleware, RequestAborted
+from admission import AdmissionMiddleware, admission_controller, authenticated_user
+from http_cache import StaticJSON, json_response
+from executors import executor_snapshot, io_pool, llm_pool, runs_on
+from cluster import cluster
+from usage_ledger import UsageMiddleware, usage_ledger
+
+logger = get_logger(__name__)
 
 app = FastAPI()
 
-# Add CORS middleware
+# Bill LLM calls to the endpoint and client that made them (daily budgets per client)
+app.add_middleware(UsageMiddleware)
+
+# Per-client quotas and a bounded queue in front of expensive endpoints (inside the deadline, so waiting counts)
+app.add_middleware(AdmissionMiddleware)
+
+# Total time budget per request (X-Request-Timeout header or per-route default); cancels work on disconnect
+app.add_middleware(DeadlineMiddleware)
+
+@app.exception_handler(RequestAborted)
+async def request_aborted_handler(request: Request, exc: RequestAborted):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Record end-to-end latency per route template (not raw path) to keep label cardinality bounded"""
+    started = time.perf_counter()
+    status = 500
+    HTTP_IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_IN_FLIGHT.dec()
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            method=request.method, route=route_path, status=str(status),
+        )
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Bind a request id (client-supplied X-Request-ID or a new one) for logs and spans"""
+    request_id = request.headers.get("x-request-id") or new_request_id()
+    with bind_request_id(request_id):
+        with span("http.request", method=request.method, path=request.url.path) as root:
+            response = await call_next(request)
+            root["attributes"]["status"] = response.status_code
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# CORS is added last so it is the outermost layer: admission 429/503 and deadline 504 answers need the
+# CORS headers too, or the browser only sees an opaque failure and cannot read Retry-After
 try:
     app.add_middleware(
         CORSMiddleware,
@@ -17,13 +93,16 @@ try:
         allow_credentials=False,  # Must be False when using "*" for origins
         allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         allow_headers=["*"],
+        expose_headers=["Retry-After", "X-Request-ID"],
     )
-    print("[INFO] CORS middleware added successfully")
+    logger.info("CORS middleware added successfully")
 except ImportError:
-    print("[WARNING] CORS middleware not available - frontend connections may be restricted")
+    logger.warning("CORS middleware not available - frontend connections may be restricted")
 
-# Initialize Supabase client
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 @app.get("/")
 def read_root():
@@ -35,6 +114,52 @@ def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": "2025-06-24"}
 
+@app.on_event("startup")
+def warm_dependencies_in_background():
+    """Optionally warm clients off the request path (WARM_ON_STARTUP=1) so the first request is not slow"""
+    if os.getenv("WARM_ON_STARTUP", "0") == "1":
+        threading.Thread(target=warm, name="dependency-warmup", daemon=True).start()
+
+@app.on_event("startup")
+def resume_bulk_jobs():
+    """Continue bulk jobs that were running when the process stopped (BULK_RESUME_ON_STARTUP=0 to skip)"""
+    if os.getenv("BULK_RESUME_ON_STARTUP", "1") == "1":
+        bulk_jobs.resume()
+
+@app.on_event("startup")
+def start_cluster_health_checks():
+    """Track which CLUSTER_NODES are up, so RAG sessions are routed to live nodes (no-op on a single node)"""
+    cluster.start()
+
+@app.on_event("startup")
+def start_precompute_scheduler():
+    """Summarize new papers of busy categories during off-peak hours (PRECOMPUTE_ENABLED=1)"""
+    if PRECOMPUTE_ENABLED:
+        precomputer.start()
+
+@app.on_event("shutdown")
+def flush_llm_usage():
+    """Write the LLM usage recorded since the last periodic flush"""
+    usage_ledger.flush()
+
+@app.get("/ready")
+def ready_check(
+    require: str = Query(default="", description="Comma-separated dependencies that must be warm, e.g. openai,supabase"),
+    warm_up: bool = Query(default=False, description="Initialize every dependency before answering"),
+):
+    """Readiness endpoint: reports which lazily-initialized dependencies are warmed"""
+    if warm_up:
+        warm()
+    state = readiness()
+    required = [name.strip() for name in require.split(",") if name.strip()]
+    missing = [name for name in required if not state.get(name, {}).get("ready")]
+    body = {"ready": not missing, "missing": missing, "dependencies": state, "upstreams": breaker_snapshot(),
+            "admission": admission_controller.snapshot(), "executors": executor_snapshot(), "cluster": cluster.snapshot(),
+            "llm_usage": usage_ledger.snapshot()}
+    if missing:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
 @app.options("/{path:path}")
 def options_handler(path: str):
     """Handle CORS preflight requests"""
@@ -47,6 +172,8 @@ class PaperResponse(BaseModel):
     pdf_link: str
     bibtex: str
     summary: str
+    summary_tier: str = FULL_TIER
+    status_url: Optional[str] = None
 
 class FileUploadResponse(BaseModel):
     filename: str
@@ -77,54 +204,78 @@ class CategoryPapersResponse(BaseModel):
     categories: list
 
 @app.get("/summarize", response_model=PaperResponse)
-def summarize(query: str = Query(..., description="เช่น ai image processing")):
-    result = fetch_and_summarize(query)
+@runs_on(llm_pool)
+def summarize(
+    query: str = Query(..., description="เช่น ai image processing"),
+    progressive: bool = Query(default=False, description="ตอบทันทีจาก abstract แล้วสรุปทั้ง paper ต่อเบื้องหลัง (ดูผลที่ status_url)"),
+):
+    result = fetch_and_summarize(query, progressive=progressive)
     if "error" in result:
         raise HTTPException(status_code=404, detail=result["error"])
     
-    # Save result to Supabase
+    # Save result to Supabase (keyed by arXiv id, so other instances can reuse the summary)
+    # Abstract-based summaries are stored by the upgrade itself, before it starts
     try:
-        supabase.table("papers").insert({
-            "title": result["title"],
-            "authors": result["authors"],
-            "published": result["published"],
-            "pdf_link": result["pdf_link"],
-            "bibtex": result["bibtex"],
-            "summary": result["summary"]
-        }).execute()
+        if result.get("summary_tier", FULL_TIER) == FULL_TIER and not result["summary"].startswith(FALLBACK_PREFIX):
+            paper_repository.save_summary(result)
     except Exception as db_error:
-        print(f"[WARNING] Failed to save to database: {db_error}")
+        logger.warning(f"Failed to save to database: {db_error}")
         # Continue without database save
     
     return result
 
+@app.get("/summarize/status/{arxiv_id:path}")
+def summarize_status(arxiv_id: str):
+    """สถานะการอัปเกรด summary จาก abstract เป็นแบบทั้ง paper (poll จนกว่า summary_tier เป็น full)"""
+    status = summary_status(arxiv_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="No summary known for this paper")
+    return status
+
 @app.post("/upload-pdf", response_model=FileUploadResponse)
-async def upload_pdf(file: UploadFile = File(...)):
+async def upload_pdf(request: Request, file: UploadFile = File(...)):
     try:
         # Check if the uploaded file is a PDF
         if not file.filename.endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are supported")
         
-        # Read file content
-        file_content = await file.read()
+        # Read file content, hashing it as it is read
+        file_content, doc_id = await read_upload(file)
+
+        # The same PDF was summarized before: no extraction and no GPT call
+        summary = await io_pool.run(upload_store.get_summary, doc_id)
+        if summary is not None:
+            logger.info(f"Serving stored summary for {file.filename}", extra={"doc_id": doc_id})
+            usage_ledger.cache_hit("summary")
+            return {"filename": file.filename, "title": file.filename.replace('.pdf', ''), "summary": summary}
         
-        # Process the PDF
-        result = process_uploaded_pdf(file_content, file.filename)
+        # Process the PDF off the event loop so the request deadline can cancel it;
+        # the thread mostly waits on the extract pool and then on GPT
+        # Only an API-key client owns its upload; anyone else's stays out of search
+        result = await llm_pool.run(process_uploaded_pdf, file_content, file.filename, authenticated_user(request.scope))
         
         # Check for errors
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
+
+        # Fallback excerpts are not worth keeping; the next upload should try GPT again
+        if not result["summary"].startswith(FALLBACK_PREFIX):
+            await io_pool.run(upload_store.put_summary, doc_id, result["summary"])
         
         # Skip database operations to avoid potential Supabase errors
-        print(f"[INFO] Successfully processed file: {result['filename']}")
+        logger.info(f"Successfully processed file: {result['filename']}")
         
         return result
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Upload processing error: {str(e)}")
+        logger.error(f"Upload processing error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing upload: {str(e)}")
 
 @app.get("/arxiv/all", response_model=AllArticlesResponse)
+@runs_on(io_pool)
 def get_all_arxiv_articles(
+    request: Request,
     category: str = Query(..., description="หมวดหมู่ของบทความ เช่น cs.AI, cs.CV, math.ST"),
     max_results: int = Query(default=20, description="จำนวนบทความสูงสุดที่ต้องการ"),
     start: int = Query(default=0, description="ตำแหน่งเริ่มต้นสำหรับการแบ่งหน้า")
@@ -133,38 +284,38 @@ def get_all_arxiv_articles(
     ดึงบทความจาก arXiv ตามหมวดหมู่ที่กำหนด (ไม่รวม all category)
     """
     try:
-        result = fetch_all_arxiv_papers(category=category, max_results=max_results, start=start)
+        result = fetch_all_arxiv_articles(category=category, max_results=max_results, start=start)
         
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
+
+        # Summaries we already paid for, in one batched lookup
+        paper_repository.attach_summaries(result["articles"])
         
         # Save articles to Supabase (optional - can be disabled for performance)
         try:
-            for article in result["articles"]:
-                supabase.table("papers").upsert({
-                    "title": article["title"],
-                    "authors": article["authors"],
-                    "published": article["published"],
-                    "pdf_link": article["pdf_link"],
-                    "bibtex": article["bibtex"],
-                    "summary": article["summary"],
-                    "arxiv_id": article["id"],
-                    "categories": article["categories"]
-                }, on_conflict="arxiv_id").execute()
+            paper_repository.save_listing(result["articles"])
         except Exception as db_error:
-            print(f"[WARNING] Failed to save to database: {db_error}")
+            logger.warning(f"Failed to save to database: {db_error}")
             # Continue without database save
+
+        # ผู้ใช้มักเปิดบทความแรก ๆ ต่อ: warm PDF ไว้ล่วงหน้าเมื่อเครื่องว่าง
+        prefetcher.offer(result["articles"])
         
-        return result
+        return json_response(request, result)
         
     except HTTPException:
         raise
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected error in get_all_arxiv_articles: {e}")
+        logger.error(f"Unexpected error in get_all_arxiv_articles: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.get("/arxiv/subjects", response_model=SubjectArticlesResponse)
+@runs_on(io_pool)
 def get_arxiv_articles_by_subjects(
+    request: Request,
     subjects: str = Query(default="cs.AI,cs.CV,cs.LG,cs.CL", description="รายการหมวดหมู่ที่คั่นด้วยจุลภาค เช่น cs.AI,cs.CV,math.ST"),
     max_results_per_subject: int = Query(default=10, description="จำนวนบทความสูงสุดต่อหมวดหมู่")
 ):
@@ -177,145 +328,156 @@ def get_arxiv_articles_by_subjects(
         if not subject_list:
             raise HTTPException(status_code=400, detail="กรุณาระบุหมวดหมู่อย่างน้อย 1 หมวดหมู่")
         
-        result = fetch_papers_by_category(
-            subject_areas=subject_list, 
-            max_results=max_results_per_subject
-        )
-        
-        return result
+        result = fetch_papers_by_category(subject_list, max_results_per_subject)
+        # A cross-listed paper shows up under each requested subject it belongs to
+        by_subject = {subject: [paper for paper in result["papers"] if subject in paper["categories"]]
+                      for subject in subject_list}
+
+        return json_response(request, {
+            "total_subjects": len(subject_list),
+            "total_articles": result["total"],
+            "results_by_subject": by_subject,
+        })
         
     except HTTPException:
         raise
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected error in get_arxiv_articles_by_subjects: {e}")
+        logger.error(f"Unexpected error in get_arxiv_articles_by_subjects: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+# เนื้อหาไม่เปลี่ยน: serialize, ทำ ETag และบีบอัดไว้ครั้งเดียวตอน import
+ARXIV_CATEGORIES = {
+    "Computer Science": {
+        "cs.AI": "Artificial Intelligence",
+        "cs.AR": "Hardware Architecture", 
+        "cs.CC": "Computational Complexity",
+        "cs.CE": "Computational Engineering, Finance, and Science",
+        "cs.CG": "Computational Geometry",
+        "cs.CL": "Computation and Language",
+        "cs.CR": "Cryptography and Security",
+        "cs.CV": "Computer Vision and Pattern Recognition",
+        "cs.CY": "Computers and Society",
+        "cs.DB": "Databases",
+        "cs.DC": "Distributed, Parallel, and Cluster Computing",
+        "cs.DL": "Digital Libraries",
+        "cs.DM": "Discrete Mathematics",
+        "cs.DS": "Data Structures and Algorithmst",
+        "cs.ET": "Emerging Technologies",
+        "cs.FL": "Formal Languages and Automata Theory",
+        "cs.GL": "General Literature",
+        "cs.GR": "Graphics",
+        "cs.GT": "Computer Science and Game Theory",
+        "cs.HC": "Human-Computer Interaction",
+        "cs.IR": "Information Retrieval",
+        "cs.IT": "Information Theory",
+        "cs.LG": "Machine Learning",
+        "cs.LO": "Logic in Computer Science",
+        "cs.MA": "Multiagent Systems",
+        "cs.MM": "Multimedia",
+        "cs.MS": "Mathematical Software",
+        "cs.NA": "Numerical Analysis",
+        "cs.NE": "Neural and Evolutionary Computing",
+        "cs.NI": "Networking and Internet Architecture",
+        "cs.OH": "Other Computer Science",
+        "cs.OS": "Operating Systems",
+        "cs.PF": "Performance",
+        "cs.PL": "Programming Languages",
+        "cs.RO": "Robotics",
+        "cs.SC": "Symbolic Computation",
+        "cs.SD": "Sound",
+        "cs.SE": "Software Engineering",
+        "cs.SI": "Social and Information Networks",
+        "cs.SY": "Systems and Control"
+    },
+    "Mathematics": {
+        "math.AC": "Commutative Algebra",
+        "math.AG": "Algebraic Geometry",
+        "math.AP": "Analysis of PDEs", 
+        "math.AT": "Algebraic Topology",
+        "math.CA": "Classical Analysis and ODEs",
+        "math.CO": "Combinatorics",
+        "math.CT": "Category Theory",
+        "math.CV": "Complex Variables",
+        "math.DG": "Differential Geometry",
+        "math.DS": "Dynamical Systems",
+        "math.FA": "Functional Analysis",
+        "math.GM": "General Mathematics",
+        "math.GN": "General Topology",
+        "math.GR": "Group Theory",
+        "math.GT": "Geometric Topology",
+        "math.HO": "History and Overview",
+        "math.IT": "Information Theory",
+        "math.KT": "K-Theory and Homology",
+        "math.LO": "Logic",
+        "math.MG": "Metric Geometry",
+        "math.MP": "Mathematical Physics",
+        "math.NA": "Numerical Analysis",
+        "math.NT": "Number Theory",
+        "math.OA": "Operator Algebras",
+        "math.OC": "Optimization and Control",
+        "math.PR": "Probability",
+        "math.QA": "Quantum Algebra",
+        "math.RA": "Rings and Algebras",
+        "math.RT": "Representation Theory",
+        "math.SG": "Symplectic Geometry",
+        "math.SP": "Spectral Theory",
+        "math.ST": "Statistics Theory"
+    },
+    "Statistics": {
+        "stat.AP": "Applications",
+        "stat.CO": "Computation",
+        "stat.ME": "Methodology",
+        "stat.ML": "Machine Learning",
+        "stat.OT": "Other Statistics",
+        "stat.TH": "Theory"
+    },
+    "Physics": {
+        "physics.acc-ph": "Accelerator Physics",
+        "physics.ao-ph": "Atmospheric and Oceanic Physics",
+        "physics.atom-ph": "Atomic Physics",
+        "physics.atm-clus": "Atomic and Molecular Clusters",
+        "physics.bio-ph": "Biological Physics",
+        "physics.chem-ph": "Chemical Physics",
+        "physics.class-ph": "Classical Physics",
+        "physics.comp-ph": "Computational Physics",
+        "physics.data-an": "Data Analysis, Statistics and Probability",
+        "physics.ed-ph": "Physics Education",
+        "physics.flu-dyn": "Fluid Dynamics",
+        "physics.gen-ph": "General Physics",
+        "physics.geo-ph": "Geophysics",
+        "physics.hist-ph": "History and Philosophy of Physics",
+        "physics.ins-det": "Instrumentation and Detectors",
+        "physics.med-ph": "Medical Physics",
+        "physics.optics": "Optics",
+        "physics.plasm-ph": "Plasma Physics",
+        "physics.pop-ph": "Popular Physics",
+        "physics.soc-ph": "Physics and Society",
+        "physics.space-ph": "Space Physics"
+    }
+}
+
+CATEGORIES_BODY = StaticJSON({
+    "message": "รายการหมวดหมู่ที่ใช้ได้ใน arXiv API",
+    "categories": ARXIV_CATEGORIES,
+    "usage_examples": [
+        "/arxiv/all?category=cs.AI&max_results=10",            "/arxiv/subjects?subjects=cs.AI,cs.CV,cs.LG&max_results_per_subject=5",
+        "/arxiv/papers?category=cs.AI&max_results=50&start=0"
+    ]
+})
+
 @app.get("/arxiv/categories")
-def get_available_categories():
+def get_available_categories(request: Request):
     """
     รายการหมวดหมู่ที่ใช้ได้ใน arXiv
     """
-    categories = {
-        "Computer Science": {
-            "cs.AI": "Artificial Intelligence",
-            "cs.AR": "Hardware Architecture", 
-            "cs.CC": "Computational Complexity",
-            "cs.CE": "Computational Engineering, Finance, and Science",
-            "cs.CG": "Computational Geometry",
-            "cs.CL": "Computation and Language",
-            "cs.CR": "Cryptography and Security",
-            "cs.CV": "Computer Vision and Pattern Recognition",
-            "cs.CY": "Computers and Society",
-            "cs.DB": "Databases",
-            "cs.DC": "Distributed, Parallel, and Cluster Computing",
-            "cs.DL": "Digital Libraries",
-            "cs.DM": "Discrete Mathematics",
-            "cs.DS": "Data Structures and Algorithmst",
-            "cs.ET": "Emerging Technologies",
-            "cs.FL": "Formal Languages and Automata Theory",
-            "cs.GL": "General Literature",
-            "cs.GR": "Graphics",
-            "cs.GT": "Computer Science and Game Theory",
-            "cs.HC": "Human-Computer Interaction",
-            "cs.IR": "Information Retrieval",
-            "cs.IT": "Information Theory",
-            "cs.LG": "Machine Learning",
-            "cs.LO": "Logic in Computer Science",
-            "cs.MA": "Multiagent Systems",
-            "cs.MM": "Multimedia",
-            "cs.MS": "Mathematical Software",
-            "cs.NA": "Numerical Analysis",
-            "cs.NE": "Neural and Evolutionary Computing",
-            "cs.NI": "Networking and Internet Architecture",
-            "cs.OH": "Other Computer Science",
-            "cs.OS": "Operating Systems",
-            "cs.PF": "Performance",
-            "cs.PL": "Programming Languages",
-            "cs.RO": "Robotics",
-            "cs.SC": "Symbolic Computation",
-            "cs.SD": "Sound",
-            "cs.SE": "Software Engineering",
-            "cs.SI": "Social and Information Networks",
-            "cs.SY": "Systems and Control"
-        },
-        "Mathematics": {
-            "math.AC": "Commutative Algebra",
-            "math.AG": "Algebraic Geometry",
-            "math.AP": "Analysis of PDEs", 
-            "math.AT": "Algebraic Topology",
-            "math.CA": "Classical Analysis and ODEs",
-            "math.CO": "Combinatorics",
-            "math.CT": "Category Theory",
-            "math.CV": "Complex Variables",
-            "math.DG": "Differential Geometry",
-            "math.DS": "Dynamical Systems",
-            "math.FA": "Functional Analysis",
-            "math.GM": "General Mathematics",
-            "math.GN": "General Topology",
-            "math.GR": "Group Theory",
-            "math.GT": "Geometric Topology",
-            "math.HO": "History and Overview",
-            "math.IT": "Information Theory",
-            "math.KT": "K-Theory and Homology",
-            "math.LO": "Logic",
-            "math.MG": "Metric Geometry",
-            "math.MP": "Mathematical Physics",
-            "math.NA": "Numerical Analysis",
-            "math.NT": "Number Theory",
-            "math.OA": "Operator Algebras",
-            "math.OC": "Optimization and Control",
-            "math.PR": "Probability",
-            "math.QA": "Quantum Algebra",
-            "math.RA": "Rings and Algebras",
-            "math.RT": "Representation Theory",
-            "math.SG": "Symplectic Geometry",
-            "math.SP": "Spectral Theory",
-            "math.ST": "Statistics Theory"
-        },
-        "Statistics": {
-            "stat.AP": "Applications",
-            "stat.CO": "Computation",
-            "stat.ME": "Methodology",
-            "stat.ML": "Machine Learning",
-            "stat.OT": "Other Statistics",
-            "stat.TH": "Theory"
-        },
-        "Physics": {
-            "physics.acc-ph": "Accelerator Physics",
-            "physics.ao-ph": "Atmospheric and Oceanic Physics",
-            "physics.atom-ph": "Atomic Physics",
-            "physics.atm-clus": "Atomic and Molecular Clusters",
-            "physics.bio-ph": "Biological Physics",
-            "physics.chem-ph": "Chemical Physics",
-            "physics.class-ph": "Classical Physics",
-            "physics.comp-ph": "Computational Physics",
-            "physics.data-an": "Data Analysis, Statistics and Probability",
-            "physics.ed-ph": "Physics Education",
-            "physics.flu-dyn": "Fluid Dynamics",
-            "physics.gen-ph": "General Physics",
-            "physics.geo-ph": "Geophysics",
-            "physics.hist-ph": "History and Philosophy of Physics",
-            "physics.ins-det": "Instrumentation and Detectors",
-            "physics.med-ph": "Medical Physics",
-            "physics.optics": "Optics",
-            "physics.plasm-ph": "Plasma Physics",
-            "physics.pop-ph": "Popular Physics",
-            "physics.soc-ph": "Physics and Society",
-            "physics.space-ph": "Space Physics"
-        }
-    }
-    
-    return {
-        "message": "รายการหมวดหมู่ที่ใช้ได้ใน arXiv API",
-        "categories": categories,
-        "usage_examples": [
-            "/arxiv/all?category=cs.AI&max_results=10",            "/arxiv/subjects?subjects=cs.AI,cs.CV,cs.LG&max_results_per_subject=5",
-            "/arxiv/papers?category=cs.AI&max_results=50&start=0"
-        ]
-    }
+    return CATEGORIES_BODY.response(request)
 
 @app.get("/papers/all", response_model=AllPapersResponse)
+@runs_on(io_pool)
 def get_all_papers(
+    request: Request,
     category: str = Query(..., description="หมวดหมู่ของบทความ เช่น cs.AI, physics.gen-ph"),
     max_results: int = Query(20, description="จำนวนบทความที่ต้องการ"),
     start: int = Query(0, description="เริ่มต้นจากบทความที่")
@@ -327,26 +489,23 @@ def get_all_papers(
     if "error" in result:
         raise HTTPException(status_code=400, detail=result["error"])
     
+    # summary ที่เคยสรุปไว้แล้ว ดึงในครั้งเดียว
+    paper_repository.attach_summaries(result["papers"])
+
     # บันทึกลงฐานข้อมูล Supabase (optional)
     try:
-        for paper in result["papers"]:
-            supabase.table("papers").upsert({
-                "paper_id": paper["id"],
-                "title": paper["title"],
-                "authors": ", ".join(paper["authors"]),
-                "abstract": paper["abstract"],
-                "published": paper["published"],
-                "pdf_link": paper["pdf_link"],
-                "arxiv_url": paper["arxiv_url"],
-                "categories": ", ".join(paper["categories"])
-            }, on_conflict="paper_id").execute()
+        paper_repository.save_listing(result["papers"])
     except Exception as db_error:
-        print(f"[WARNING] Database save failed: {db_error}")
+        logger.warning(f"Database save failed: {db_error}")
+
+    prefetcher.offer(result["papers"])
     
-    return result
+    return json_response(request, result)
 
 @app.get("/papers/categories", response_model=CategoryPapersResponse)
+@runs_on(io_pool)
 def get_papers_by_categories(
+    request: Request,
     categories: str = Query(..., description="หมวดหมู่ที่ต้องการ คั่นด้วยคอมมา เช่น cs.AI,cs.LG,physics.gen-ph"),
     max_per_category: int = Query(10, description="จำนวนบทความต่อหมวดหมู่")
 ):
@@ -358,10 +517,11 @@ def get_papers_by_categories(
     if "error" in result:
         raise HTTPException(status_code=400, detail=result["error"])
     
-    return result
+    return json_response(request, result)
 
 @app.get("/papers/recent")
-def get_recent_papers(days: int = Query(7, description="จำนวนวันย้อนหลัง")):
+@runs_on(io_pool)
+def get_recent_papers(request: Request, days: int = Query(7, description="จำนวนวันย้อนหลัง")):
     """
     ดึงบทความล่าสุดจาก arXiv
     """
@@ -379,7 +539,7 @@ def get_recent_papers(days: int = Query(7, description="จำนวนวัน
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
         
-        return {
+        return json_response(request, {
             "papers": result["papers"],
             "total": result["total"],
             "date_range": {
@@ -387,9 +547,14 @@ def get_recent_papers(days: int = Query(7, description="จำนวนวัน
                 "end": end_date.isoformat(),
                 "days": days
             }
-        }
+        })
+    except RequestAborted:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching recent papers: {str(e)}")
 
 # Include the chatbot router
-app.include_router(chatbot_router, prefix="/api")
\ No newline at end of file
+app.include_router(chatbot_router, prefix="/api")
+app.include_router(corpus_router, prefix="/api/corpus")
+app.include_router(bulk_router, prefix="/api/bulk")
+app.include_router(admin_router, prefix="/admin")
\ No newline at end of file
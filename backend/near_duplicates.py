@@ -0,0 +1,185 @@
+"""
+Near-duplicate detection for extracted papers (MinHash + LSH).
+
+The same paper reaches us under many identities: an upload of an arXiv PDF,
+a mirror passed to ``summarize_from_pdf_url``, a re-posted preprint. Their
+bytes differ, so the content-hash caches miss, but their text does not.
+Every summarized document leaves a MinHash signature of its word 5-shingles
+here, with its summary. Before summarizing a new document we look for one
+whose estimated Jaccard similarity is at least ``NEAR_DUP_THRESHOLD``
+(default 0.85) and reuse its summary instead of calling GPT.
+
+Signatures use one-permutation hashing: every shingle is hashed once and
+kept as the minimum of one of ``NEAR_DUP_PERMUTATIONS`` bins (empty bins
+borrow from their neighbour), so signing costs one pass over the text. The
+LSH index splits a signature into ``NEAR_DUP_BANDS`` bands and stores one
+SQLite row per band, indexed by the band's hash. A lookup is therefore a
+fixed number of index probes plus a comparison with the few candidates
+they return, however many documents are indexed.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+
+from json_logging import get_logger
+from metrics import stage_timer, CACHE_EVENTS
+
+logger = get_logger(__name__)
+
+NEAR_DUP_PATH = os.getenv("NEAR_DUP_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "near_duplicates.sqlite"))
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.85"))
+NEAR_DUP_PERMUTATIONS = int(os.getenv("NEAR_DUP_PERMUTATIONS", "128"))
+NEAR_DUP_BANDS = int(os.getenv("NEAR_DUP_BANDS", "16"))
+SHINGLE_WORDS = 5
+# Texts shorter than this many words are too small to call duplicates
+MIN_WORDS = 50
+# Candidates read per band; a bucket this full holds boilerplate, not duplicates
+MAX_BUCKET_CANDIDATES = 50
+
+_WORD = re.compile(r"\w+")
+_EMPTY = (1 << 64) - 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    key TEXT PRIMARY KEY,
+    signature BLOB NOT NULL,
+    summary TEXT NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS bands (
+    band INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bands_bucket ON bands (band, bucket);
+CREATE INDEX IF NOT EXISTS bands_key ON bands (key);
+"""
+
+
+@dataclass
+class Duplicate:
+    key: str
+    similarity: float
+    summary: str
+
+
+def _hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of the texts behind two signatures"""
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a) if a else 0.0
+
+
+class NearDuplicateIndex:
+    def __init__(self, path=NEAR_DUP_PATH, threshold=NEAR_DUP_THRESHOLD, permutations=NEAR_DUP_PERMUTATIONS,
+                 bands=NEAR_DUP_BANDS):
+        if permutations % bands:
+            raise ValueError("NEAR_DUP_PERMUTATIONS must be a multiple of NEAR_DUP_BANDS")
+        self.path = path
+        self.threshold = threshold
+        self.permutations = permutations
+        self.bands = bands
+        self.rows = permutations // bands
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    init = sqlite3.connect(self.path)
+                    init.execute("PRAGMA journal_mode=WAL")
+                    init.executescript(_SCHEMA)
+                    init.close()
+                    self._initialized = True
+        conn = self._local.conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def signature(self, text):
+        """MinHash signature of ``text`` (a list of ints), or None when it is too short to compare"""
+        words = _WORD.findall(text.lower())
+        if len(words) < MIN_WORDS:
+            return None
+        bins = [_EMPTY] * self.permutations
+        count = self.permutations
+        for shingle in {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}:
+            value = _hash64(shingle.encode())
+            slot, rest = value % count, value // count
+            if rest < bins[slot]:
+                bins[slot] = rest
+        # Densify: an empty bin takes the value of the next filled one (with an offset so they stay distinct)
+        for slot in range(count):
+            if bins[slot] == _EMPTY:
+                for step in range(1, count):
+                    donor = bins[(slot + step) % count]
+                    if donor != _EMPTY and donor < _EMPTY - step:
+                        bins[slot] = donor + step
+                        break
+        return bins
+
+    def _buckets(self, signature):
+        for band in range(self.bands):
+            values = array("Q", signature[band * self.rows:(band + 1) * self.rows]).tobytes()
+            yield band, _hash64(values) - (1 << 63)  # SQLite integers are signed
+
+    def find(self, signature, exclude=None):
+        """Most similar indexed document at or above the threshold, or None"""
+        if signature is None:
+            return None
+        with stage_timer("near_dup_lookup"):
+            try:
+                conn = self._conn()
+                candidates = set()
+                for band, bucket in self._buckets(signature):
+                    rows = conn.execute("SELECT key FROM bands WHERE band = ? AND bucket = ? LIMIT ?",
+                                        (band, bucket, MAX_BUCKET_CANDIDATES)).fetchall()
+                    candidates.update(key for key, in rows)
+                candidates.discard(exclude)
+                best = None
+                for key in candidates:
+                    row = conn.execute("SELECT signature, summary FROM signatures WHERE key = ?", (key,)).fetchone()
+                    if row is None:
+                        continue
+                    score = similarity(signature, array("Q", row[0]))
+                    if score >= self.threshold and (best is None or score > best.similarity):
+                        best = Duplicate(key, score, row[1])
+            except Exception as e:
+                # A broken index only costs us the shortcut
+                logger.warning(f"Near-duplicate lookup failed: {e}")
+                best = None
+        CACHE_EVENTS.inc(cache="near_duplicate", result="hit" if best else "miss")
+        return best
+
+    def add(self, key, signature, summary):
+        """Index ``key`` (replacing an earlier signature of it) with the summary to hand to its duplicates"""
+        if signature is None:
+            return
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM bands WHERE key = ?", (key,))
+                conn.execute("INSERT OR REPLACE INTO signatures (key, signature, summary, created_at) VALUES (?, ?, ?, ?)",
+                             (key, array("Q", signature).tobytes(), summary, time.time()))
+                conn.executemany("INSERT INTO bands (band, bucket, key) VALUES (?, ?, ?)",
+                                 [(band, bucket, key) for band, bucket in self._buckets(signature)])
+        except Exception as e:
+            logger.warning(f"Near-duplicate index write failed: {e}")
+
+
+near_duplicates = NearDuplicateIndex()
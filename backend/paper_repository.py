@@ -0,0 +1,168 @@
+"""
+Read-through access to the Supabase ``papers`` table.
+
+Summaries written by ``/summarize`` are read back by canonical arXiv id
+before any PDF is downloaded or GPT is called, so a restarted or second
+instance does not pay for a paper twice. Lookups go through an in-process
+LRU (misses are remembered briefly, since another instance may summarize
+the paper meanwhile). Listings resolve all their ids with one ``in``
+query instead of one lookup per paper.
+
+The client comes from ``client_factory`` (Supabase by default), so the
+repository can be pointed at any PostgREST endpoint, e.g. a local stub.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from arxiv_ids import canonical_arxiv_id
+from circuit_breaker import SUPABASE
+from clients import get_supabase
+from json_logging import get_logger
+from metrics import stage_timer, CACHE_EVENTS
+
+logger = get_logger(__name__)
+
+PAPER_CACHE_SIZE = int(os.getenv("PAPER_CACHE_SIZE", "5000"))
+PAPER_CACHE_TTL = float(os.getenv("PAPER_CACHE_TTL", "86400"))
+PAPER_MISS_TTL = float(os.getenv("PAPER_MISS_TTL", "60"))
+# PostgREST puts ``in`` filters in the URL; keep each query well under URL limits
+LOOKUP_BATCH = 100
+
+COLUMNS = "arxiv_id,version,title,authors,published,pdf_link,bibtex,summary,summary_tier,categories"
+_MISSING = object()
+
+
+def _as_text(value):
+    return ", ".join(value) if isinstance(value, (list, tuple)) else value
+
+
+class PaperRepository:
+    def __init__(self, client_factory=get_supabase, table="papers", clock=time.monotonic):
+        self._client_factory = client_factory
+        self.table = table
+        self._clock = clock
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- local cache -----------------------------------------------------
+
+    def _cached(self, arxiv_id):
+        with self._lock:
+            item = self._cache.get(arxiv_id)
+            if item is None:
+                return None
+            row, expires = item
+            if self._clock() >= expires:
+                del self._cache[arxiv_id]
+                return None
+            self._cache.move_to_end(arxiv_id)
+            return item
+
+    def _remember(self, arxiv_id, row):
+        # Only a full-paper summary is final; other rows may be (re)summarized elsewhere soon
+        final = row is not _MISSING and row.get("summary") and row.get("summary_tier") != "abstract"
+        ttl = PAPER_CACHE_TTL if final else PAPER_MISS_TTL
+        with self._lock:
+            self._cache[arxiv_id] = (row, self._clock() + ttl)
+            self._cache.move_to_end(arxiv_id)
+            while len(self._cache) > PAPER_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _table(self):
+        return self._client_factory().table(self.table)
+
+    # --- reads -----------------------------------------------------------
+
+    def get_many(self, ids):
+        """``{canonical id: row}`` for the ids that have a stored paper; one query per LOOKUP_BATCH misses"""
+        wanted = list(dict.fromkeys(filter(None, (canonical_arxiv_id(value) for value in ids))))
+        found, missing = {}, []
+        for arxiv_id in wanted:
+            item = self._cached(arxiv_id)
+            if item is None:
+                missing.append(arxiv_id)
+            elif item[0] is not _MISSING:
+                found[arxiv_id] = item[0]
+        CACHE_EVENTS.inc(len(wanted) - len(missing), cache="papers", result="hit")
+        if not missing:
+            return found
+        CACHE_EVENTS.inc(len(missing), cache="papers", result="miss")
+        try:
+            rows = []
+            with stage_timer("db_read"):
+                for offset in range(0, len(missing), LOOKUP_BATCH):
+                    batch = missing[offset:offset + LOOKUP_BATCH]
+                    with SUPABASE.call():
+                        rows.extend(self._table().select(COLUMNS).in_("arxiv_id", batch).execute().data or [])
+        except Exception as e:
+            # Without the database we simply summarize again; do not cache the failure
+            logger.warning(f"Paper lookup failed: {e}")
+            return found
+        stored = {row["arxiv_id"]: row for row in rows if row.get("arxiv_id")}
+        for arxiv_id in missing:
+            row = stored.get(arxiv_id)
+            self._remember(arxiv_id, row if row is not None else _MISSING)
+            if row is not None:
+                found[arxiv_id] = row
+        return found
+
+    def get(self, arxiv_id):
+        canonical = canonical_arxiv_id(arxiv_id)
+        return self.get_many([canonical]).get(canonical) if canonical else None
+
+    def stored_summary(self, arxiv_id):
+        row = self.get(arxiv_id)
+        return row.get("summary") if row else None
+
+    # --- writes ----------------------------------------------------------
+
+    def save_summary(self, paper):
+        """Upsert a summarized paper (``/summarize`` result with ``arxiv_id`` and ``version``) and cache it.
+
+        A full summary replaces an abstract-based one of the same paper in place.
+        """
+        arxiv_id = canonical_arxiv_id(paper.get("arxiv_id"))
+        row = {key: _as_text(paper.get(key)) for key in ("title", "authors", "published", "pdf_link", "bibtex", "summary")}
+        row["summary_tier"] = paper.get("summary_tier") or "full"
+        row["arxiv_id"] = arxiv_id
+        if paper.get("version") is not None:
+            row["version"] = paper["version"]
+        with stage_timer("db_write"), SUPABASE.call():
+            if arxiv_id:
+                self._table().upsert(row, on_conflict="arxiv_id").execute()
+            else:
+                self._table().insert(row).execute()
+        if arxiv_id:
+            self._remember(arxiv_id, row)
+
+    def save_listing(self, papers):
+        """Upsert listing metadata in one request; never touches ``summary``, so stored summaries survive"""
+        rows = {}
+        for paper in papers:
+            arxiv_id = canonical_arxiv_id(paper.get("arxiv_id") or paper.get("id"))
+            if arxiv_id:
+                rows[arxiv_id] = {
+                    "arxiv_id": arxiv_id,
+                    "title": paper.get("title"),
+                    "authors": _as_text(paper.get("authors")),
+                    "published": paper.get("published"),
+                    "pdf_link": paper.get("pdf_link"),
+                    "categories": _as_text(paper.get("categories")),
+                }
+        if not rows:
+            return
+        with stage_timer("db_write"), SUPABASE.call():
+            self._table().upsert(list(rows.values()), on_conflict="arxiv_id").execute()
+
+    def attach_summaries(self, papers, field="ai_summary"):
+        """Add stored GPT summaries to listing entries (``None`` when the paper was never summarized)"""
+        stored = self.get_many(paper.get("id") for paper in papers)
+        for paper in papers:
+            row = stored.get(canonical_arxiv_id(paper.get("id")))
+            paper[field] = row.get("summary") if row else None
+        return papers
+
+
+paper_repository = PaperRepository()
@@ -0,0 +1,110 @@
+"""
+Per-paper version ledger for incremental re-ingestion.
+
+For every arXiv paper we ingest we keep its version and the fingerprint and
+text of each page. When the paper comes back as a newer version, pages with
+an unchanged content stream are not extracted again, the corpus index keeps
+the chunks whose text did not change, and the stored summary is kept unless
+the share of changed text passes ``SUMMARY_REFRESH_DELTA``.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+from json_logging import get_logger
+from metrics import Histogram
+
+logger = get_logger(__name__)
+
+PAPER_VERSIONS_PATH = os.getenv("PAPER_VERSIONS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "paper_versions.sqlite"))
+# Share of a new version's text that must be new before its summary is regenerated
+SUMMARY_REFRESH_DELTA = float(os.getenv("SUMMARY_REFRESH_DELTA", "0.15"))
+
+VERSION_DELTA = Histogram(
+    "botchana_paper_version_delta",
+    "Share of a new paper version's text that changed since the version we had",
+    buckets=(0.01, 0.05, 0.1, 0.15, 0.25, 0.5, 0.75, 1.0),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    arxiv_id TEXT PRIMARY KEY,
+    version INTEGER,
+    pages TEXT NOT NULL,
+    updated_at REAL
+);
+"""
+
+
+@dataclass
+class PaperVersion:
+    arxiv_id: str
+    version: int
+    pages: list  # [fingerprint, text] per page
+
+    def known_pages(self):
+        return {fingerprint: text for fingerprint, text in self.pages if fingerprint}
+
+
+def content_delta(previous, document):
+    """Share of ``document``'s text on pages that did not exist in ``previous`` (1.0 without a previous version)"""
+    if previous is None:
+        return 1.0
+    old_texts = {text for _, text in previous.pages}
+    total = sum(len(page) for page in document.pages)
+    if not total:
+        return 0.0
+    changed = sum(len(page) for page in document.pages if page not in old_texts)
+    return changed / total
+
+
+class PaperVersions:
+    def __init__(self, path=PAPER_VERSIONS_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    init = sqlite3.connect(self.path)
+                    init.execute("PRAGMA journal_mode=WAL")
+                    init.executescript(_SCHEMA)
+                    init.close()
+                    self._initialized = True
+        conn = self._local.conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, arxiv_id):
+        try:
+            row = self._conn().execute("SELECT version, pages FROM versions WHERE arxiv_id = ?", (arxiv_id,)).fetchone()
+        except Exception as e:
+            logger.warning(f"Version ledger lookup failed: {e}")
+            return None
+        return PaperVersion(arxiv_id, row[0], json.loads(row[1])) if row else None
+
+    def put(self, arxiv_id, version, document):
+        pages = [[fingerprint, text] for fingerprint, text in zip(document.page_fingerprints, document.pages)]
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO versions (arxiv_id, version, pages, updated_at) VALUES (?, ?, ?, ?)",
+                             (arxiv_id, version, json.dumps(pages, ensure_ascii=False), time.time()))
+        except Exception as e:
+            logger.warning(f"Version ledger write failed: {e}")
+
+
+paper_versions = PaperVersions()
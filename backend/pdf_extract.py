@@ -0,0 +1,63 @@
+"""
+PyPDF2 text extraction, the CPU-heavy part of parsing a PDF.
+
+Runs in the ``extract`` process pool (see ``executors``), so it only imports
+what it needs and reports back plain data: page texts, page fingerprints,
+the metadata title and counts. Caching, metrics and the document model stay
+in the parent, in ``document``.
+"""
+import hashlib
+import io
+import logging
+import time
+
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+
+def _page_fingerprint(page):
+    try:
+        contents = page.get_contents()
+        return hashlib.sha1(contents.get_data() if contents is not None else b"").hexdigest()
+    except Exception:
+        return None
+
+
+def _metadata_title(reader):
+    try:
+        title = reader.metadata.title if reader.metadata else None
+    except Exception:
+        return None
+    if title and title.strip() and title.strip().lower() != "untitled":
+        return title.strip()
+    return None
+
+
+def extract_pages(pdf_data, known_pages=None, stop_at=None):
+    """Text of every page of ``pdf_data``.
+
+    ``known_pages`` (``{fingerprint: text}``) skips pages whose content is
+    unchanged. ``stop_at`` is a ``time.time()`` past which extraction stops
+    early with ``aborted`` set, since a request deadline cannot follow the
+    work into another process.
+    """
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
+    pages, fingerprints, reused, extracted = [], [], 0, 0
+    for page_num, page in enumerate(reader.pages):
+        if stop_at is not None and time.time() > stop_at:
+            return {"aborted": True}
+        fingerprint = _page_fingerprint(page)
+        fingerprints.append(fingerprint)
+        if known_pages and fingerprint in known_pages:
+            pages.append(known_pages[fingerprint])
+            reused += 1
+            continue
+        try:
+            pages.append(page.extract_text() or "")
+            extracted += 1
+        except Exception as page_error:
+            logger.warning(f"Failed to extract text from page {page_num}: {page_error}")
+            pages.append("")
+    return {"aborted": False, "pages": pages, "fingerprints": fingerprints, "reused": reused,
+            "extracted": extracted, "metadata_title": _metadata_title(reader)}
@@ -0,0 +1,189 @@
+"""
+Off-peak precomputation for the categories most of our traffic reads.
+
+When ``PRECOMPUTE_ENABLED=1`` a background thread wakes every
+``PRECOMPUTE_POLL_SECONDS``. Inside one of the ``PRECOMPUTE_WINDOWS``
+(local ``HH:MM-HH:MM`` ranges at ``PRECOMPUTE_UTC_OFFSET``) it harvests the
+newest papers of ``PRECOMPUTE_CATEGORIES`` every ``PRECOMPUTE_INTERVAL``
+seconds. Papers without a current summary are handed to the bulk pipeline,
+which stores their full summaries, corpus index entries and RAG chunks. So
+during the day, ``/summarize`` and RAG sessions on new papers hit warm
+caches.
+
+Each window may spend at most ``PRECOMPUTE_TOKEN_BUDGET`` LLM tokens. What a
+window has spent is the actual usage the gateway recorded in the usage ledger
+under the ``precompute`` purpose; only the size of the next job is planned
+with an upper bound per paper (full context plus completion), since its usage
+is not known until it has run. A job still running when its window closes is
+cancelled.
+
+The clock, the entry source, the job runner and the ledger are constructor
+arguments, so ``tick()`` can be driven by tests with a fake clock and local
+stubs.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from arxiv_ids import parse_arxiv_id
+from bulk_jobs import bulk_jobs, PRECOMPUTE_PURPOSE
+from context_builder import SUMMARY_CONTEXT_TOKENS
+from json_logging import get_logger
+from metrics import Counter, Gauge
+from paper_repository import paper_repository
+from service import fetch_arxiv_entries, stored_full_summary
+from usage_ledger import usage_ledger
+
+logger = get_logger(__name__)
+
+PRECOMPUTE_ENABLED = os.getenv("PRECOMPUTE_ENABLED", "0") == "1"
+PRECOMPUTE_CATEGORIES = os.getenv("PRECOMPUTE_CATEGORIES", "cs.AI,cs.CV,cs.LG,cs.CL")
+PRECOMPUTE_WINDOWS = os.getenv("PRECOMPUTE_WINDOWS", "01:00-06:00")
+PRECOMPUTE_UTC_OFFSET = float(os.getenv("PRECOMPUTE_UTC_OFFSET", "7"))  # hours; Bangkok by default
+PRECOMPUTE_INTERVAL = float(os.getenv("PRECOMPUTE_INTERVAL", "1800"))
+PRECOMPUTE_PER_CATEGORY = int(os.getenv("PRECOMPUTE_PER_CATEGORY", "25"))
+PRECOMPUTE_TOKEN_BUDGET = int(os.getenv("PRECOMPUTE_TOKEN_BUDGET", "400000"))
+PRECOMPUTE_POLL_SECONDS = float(os.getenv("PRECOMPUTE_POLL_SECONDS", "60"))
+# Upper bound of one summary (the packed paper context plus max_tokens of the completion), used to size a job
+TOKENS_PER_PAPER = SUMMARY_CONTEXT_TOKENS + 1000
+
+PRECOMPUTE_PAPERS = Counter(
+    "botchana_precompute_papers_total",
+    "Papers handed to off-peak precomputation",
+    ["category"],
+)
+PRECOMPUTE_TOKENS = Gauge(
+    "botchana_precompute_window_tokens",
+    "LLM tokens spent by precomputation in the current off-peak window",
+)
+
+
+def parse_windows(spec):
+    """``"22:00-02:00,13:00-14:00"`` -> [(start minute, end minute)]; a window may wrap past midnight"""
+    windows = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        start, end = (piece.strip() for piece in part.split("-"))
+        windows.append(tuple(int(value[:2]) * 60 + int(value[3:5]) for value in (start, end)))
+    return windows
+
+
+class Precomputer:
+    def __init__(self, categories=PRECOMPUTE_CATEGORIES, windows=PRECOMPUTE_WINDOWS, token_budget=PRECOMPUTE_TOKEN_BUDGET,
+                 interval=PRECOMPUTE_INTERVAL, per_category=PRECOMPUTE_PER_CATEGORY, utc_offset=PRECOMPUTE_UTC_OFFSET,
+                 clock=time.time, jobs=bulk_jobs, fetch_entries=fetch_arxiv_entries, ledger=usage_ledger):
+        self.categories = [category.strip() for category in categories.split(",") if category.strip()]
+        self.windows = parse_windows(windows)
+        self.token_budget = token_budget
+        self.interval = interval
+        self.per_category = per_category
+        self._zone = timezone(timedelta(hours=utc_offset))
+        self._clock = clock
+        self._jobs = jobs
+        self._fetch_entries = fetch_entries
+        self._ledger = ledger
+        self._window = None
+        self._window_tokens = 0  # ledger total for PRECOMPUTE_PURPOSE when the window opened
+        self._last_harvest = None
+        self._job_id = None
+        self._thread = None
+
+    def current_window(self, now):
+        """Key of the off-peak window containing ``now`` (its start as a datetime), or None"""
+        local = datetime.fromtimestamp(now, self._zone)
+        minute = local.hour * 60 + local.minute
+        midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return midnight + timedelta(minutes=start)
+            if start > end and minute >= start:
+                return midnight + timedelta(minutes=start)
+            if start > end and minute < end:
+                return midnight - timedelta(days=1) + timedelta(minutes=start)
+        return None
+
+    def spent(self):
+        """Tokens precompute jobs have used in the current window"""
+        return self._ledger.tokens(PRECOMPUTE_PURPOSE) - self._window_tokens
+
+    def _job_running(self):
+        return self._job_id is not None and self._jobs.store.job_status(self._job_id) == "running"
+
+    def tick(self):
+        """One scheduling step; returns what it did (for logs and tests)"""
+        now = self._clock()
+        window = self.current_window(now)
+        if window is None:
+            if self._job_running():
+                logger.info(f"Off-peak window closed, cancelling precompute job {self._job_id}")
+                self._jobs.cancel(self._job_id)
+                return "cancelled"
+            return "outside_window"
+        if window != self._window:
+            self._window, self._window_tokens = window, self._ledger.tokens(PRECOMPUTE_PURPOSE)
+        spent = self.spent()
+        PRECOMPUTE_TOKENS.set(spent)
+        if self._job_running():
+            return "busy"
+        if self._last_harvest is not None and now - self._last_harvest < self.interval:
+            return "waiting"
+        # The previous job is over, so its usage is all in the ledger
+        affordable = (self.token_budget - spent) // TOKENS_PER_PAPER
+        if affordable <= 0:
+            return "over_budget"
+        self._last_harvest = now
+        picked = self._harvest()[:affordable]
+        if not picked:
+            return "up_to_date"
+        for category, _ in picked:
+            PRECOMPUTE_PAPERS.inc(category=category)
+        entries = [entry for _, entry in picked]
+        status = self._jobs.create(entries, {"precompute": True, "categories": self.categories})
+        self._job_id = status["job_id"]
+        logger.info(f"Precomputing {len(entries)} new papers in job {self._job_id} "
+                    f"({spent}/{self.token_budget} tokens of this window spent so far)")
+        return "started"
+
+    def _harvest(self):
+        """(category, entry) for the newest papers without a current summary, interleaved across categories"""
+        per_category = []
+        for category in self.categories:
+            try:
+                entries = self._fetch_entries(search_query=f"cat:{category}", max_results=self.per_category, newest_first=True)
+            except Exception as e:
+                logger.warning(f"Precompute harvest of {category} failed: {e}")
+                entries = []
+            per_category.append((category, entries))
+        ids = {entry.id: parse_arxiv_id(entry.id) for _, entries in per_category for entry in entries}
+        paper_repository.get_many(arxiv_id for arxiv_id, _ in ids.values())  # one batched lookup
+        picked, seen = [], set()
+        for position in range(max((len(entries) for _, entries in per_category), default=0)):
+            for category, entries in per_category:
+                if position >= len(entries):
+                    continue
+                entry = entries[position]
+                arxiv_id, version = ids[entry.id]
+                if arxiv_id in seen or stored_full_summary(arxiv_id, version)[1]:
+                    continue
+                seen.add(arxiv_id)
+                picked.append((category, entry))
+        return picked
+
+    def start(self, poll_seconds=PRECOMPUTE_POLL_SECONDS):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(poll_seconds,), name="precompute", daemon=True)
+        self._thread.start()
+
+    def _run(self, poll_seconds):
+        while True:
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Precompute tick failed: {e}")
+            time.sleep(poll_seconds)
+
+
+precomputer = Precomputer()
@@ -0,0 +1,187 @@
+"""
+Speculative warming of the papers a listing is likely to lead to.
+
+After ``/arxiv/all`` or ``/papers/all`` the user usually opens one of the
+first few papers. When ``PREFETCH_ENABLED=1``, the top ``PREFETCH_TOP_K``
+PDFs of each listing are downloaded and parsed in the background, so
+``summarize_from_pdf_url`` and ``create_rag_session_from_url`` find them in
+the document cache instead of downloading them. With ``PREFETCH_INDEX=1``
+they are also added to the corpus index.
+
+The warmer stays out of the way of real traffic:
+
+* one background thread, which only starts a paper while at most
+  ``PREFETCH_MAX_FOREGROUND`` HTTP requests are in flight;
+* each job runs under its own ``Deadline``; its checkpoints (download
+  chunks, pages) cancel it as soon as foreground load rises past that level;
+* at most ``PREFETCH_BUDGET_PER_HOUR`` papers per hour and
+  ``PREFETCH_MAX_PDF_BYTES`` per PDF;
+* only the newest listings are kept: older, still-queued papers are dropped.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+from circuit_breaker import pdf_breaker, client_error
+from corpus_index import corpus_index
+from deadline import Deadline, RequestAborted, bind_deadline, capped_timeout, check_deadline
+from document import document_for_url, parse_pdf
+from json_logging import get_logger
+from metrics import BYTES_DOWNLOADED, HTTP_IN_FLIGHT, Counter
+
+logger = get_logger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_TOP_K = int(os.getenv("PREFETCH_TOP_K", "3"))
+PREFETCH_INDEX = os.getenv("PREFETCH_INDEX", "0") == "1"
+PREFETCH_MAX_FOREGROUND = int(os.getenv("PREFETCH_MAX_FOREGROUND", "1"))
+PREFETCH_BUDGET_PER_HOUR = int(os.getenv("PREFETCH_BUDGET_PER_HOUR", "60"))
+PREFETCH_MAX_PDF_BYTES = int(os.getenv("PREFETCH_MAX_PDF_BYTES", str(25 * 1024 * 1024)))
+# Upper bound for one paper (download + extraction)
+PREFETCH_JOB_SECONDS = 60.0
+PREFETCH_QUEUE_SIZE = 4 * PREFETCH_TOP_K
+IDLE_POLL_SECONDS = 0.25
+
+PREFETCH_EVENTS = Counter(
+    "botchana_prefetch_events_total",
+    "Speculative prefetches by outcome",
+    ["result"],
+)
+
+
+class _BackgroundDeadline(Deadline):
+    """Deadline that also gives up as soon as foreground traffic picks up."""
+
+    def __init__(self, seconds, busy):
+        super().__init__(seconds)
+        self._busy = busy
+
+    def check(self):
+        if self._busy():
+            self.cancel("foreground_load")
+        super().check()
+
+
+class Prefetcher:
+    def __init__(self, enabled=PREFETCH_ENABLED, top_k=PREFETCH_TOP_K, budget_per_hour=PREFETCH_BUDGET_PER_HOUR,
+                 max_foreground=PREFETCH_MAX_FOREGROUND, index=PREFETCH_INDEX, load=HTTP_IN_FLIGHT.value,
+                 clock=time.monotonic):
+        self.enabled = enabled
+        self.top_k = top_k
+        self.budget_per_hour = budget_per_hour
+        self.max_foreground = max_foreground
+        self.index = index
+        self._load = load
+        self._clock = clock
+        self._queue = deque(maxlen=PREFETCH_QUEUE_SIZE)
+        self._queued = set()
+        self._recent = OrderedDict()  # url -> when it was warmed
+        self._started = deque()
+        self._wakeup = threading.Condition()
+        self._thread = None
+
+    def busy(self):
+        return self._load() > self.max_foreground
+
+    def offer(self, papers):
+        """Queue the top papers of a listing just served; newest listings are warmed first"""
+        if not self.enabled:
+            return
+        urls = [paper.get("pdf_link") for paper in papers[:self.top_k]]
+        urls = [url for url in urls if url and url.startswith("http")]
+        with self._wakeup:
+            for url in reversed(urls):
+                if url in self._queued or url in self._recent:
+                    continue
+                if len(self._queue) == self._queue.maxlen:
+                    self._queued.discard(self._queue.pop())
+                self._queue.appendleft(url)
+                self._queued.add(url)
+            self._ensure_thread()
+            self._wakeup.notify()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+            self._thread.start()
+
+    def _within_budget(self):
+        hour_ago = self._clock() - 3600
+        while self._started and self._started[0] < hour_ago:
+            self._started.popleft()
+        return len(self._started) < self.budget_per_hour
+
+    def _next_url(self):
+        with self._wakeup:
+            while not self._queue:
+                self._wakeup.wait()
+            url = self._queue.popleft()
+            self._queued.discard(url)
+            return url
+
+    def _run(self):
+        while True:
+            url = self._next_url()
+            # Idle capacity only: wait for foreground traffic to settle first
+            while self.busy():
+                time.sleep(IDLE_POLL_SECONDS)
+            if not self._within_budget():
+                PREFETCH_EVENTS.inc(result="over_budget")
+                continue
+            if document_for_url(url) is not None:
+                PREFETCH_EVENTS.inc(result="already_warm")
+                continue
+            self._started.append(self._clock())
+            self.warm(url)
+
+    def warm(self, url):
+        """Download and parse one PDF under a background deadline; returns the document or None"""
+        deadline = _BackgroundDeadline(PREFETCH_JOB_SECONDS, self.busy)
+        try:
+            with bind_deadline(deadline):
+                pdf_data = self._download(url)
+                document = parse_pdf(pdf_data, source="prefetch", url=url)
+        except RequestAborted as e:
+            PREFETCH_EVENTS.inc(result="cancelled")
+            logger.info(f"Prefetch of {url} cancelled: {e}")
+            return None
+        except Exception as e:
+            PREFETCH_EVENTS.inc(result="failed")
+            logger.warning(f"Prefetch of {url} failed: {e}")
+            return None
+        self._recent[url] = self._clock()
+        while len(self._recent) > PREFETCH_QUEUE_SIZE * 8:
+            self._recent.popitem(last=False)
+        if self.index:
+            corpus_index.submit(document.doc_id, text=document.text, title=document.title or "", url=url, source="prefetch")
+        PREFETCH_EVENTS.inc(result="warmed")
+        logger.info(f"Prefetched {url} ({document.page_count} pages)")
+        return document
+
+    def _download(self, url):
+        parts, size = [], 0
+        breaker = pdf_breaker(url)
+        with breaker.call(neutral=client_error), requests.get(url, stream=True, timeout=capped_timeout(breaker.timeout())) as response:
+            response.raise_for_status()
+            size = int(response.headers.get("content-length") or 0)
+            if size <= PREFETCH_MAX_PDF_BYTES:
+                size = 0
+                for part in response.iter_content(chunk_size=64 * 1024):
+                    check_deadline()
+                    size += len(part)
+                    BYTES_DOWNLOADED.inc(len(part), source="prefetch")
+                    if size > PREFETCH_MAX_PDF_BYTES:
+                        break
+                    parts.append(part)
+        # Outside the breaker: an oversized paper says nothing about the upstream's health
+        if size > PREFETCH_MAX_PDF_BYTES:
+            raise ValueError("PDF larger than PREFETCH_MAX_PDF_BYTES")
+        pdf_data = b"".join(parts)
+        if not pdf_data.startswith(b"%PDF"):
+            raise ValueError("Not a PDF")
+        return pdf_data
+
+prefetcher = Prefetcher()
@@ -0,0 +1,127 @@
+"""
+On-demand sampling profiler for the live process.
+
+``wall`` mode counts every sampled stack of every thread, so time blocked on
+I/O shows up. ``cpu`` mode weights each sample by the CPU time the thread
+actually consumed since the previous sample (Linux per-thread clocks), so
+idle and blocked threads drop out. Results are returned in the folded
+("collapsed") stack format read by flamegraph.pl, speedscope and friends.
+"""
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+MAX_PROFILE_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame, thread_name):
+    stack = []
+    while frame is not None:
+        stack.append(_frame_label(frame))
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+def _thread_cpu_time(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def sample_stacks(seconds, interval=0.005, mode="wall"):
+    """Sample every thread's stack for ``seconds`` and return a Counter of folded stacks."""
+    if mode not in ("wall", "cpu"):
+        raise ValueError("mode must be 'wall' or 'cpu'")
+    if mode == "cpu" and not hasattr(time, "pthread_getcpuclockid"):
+        raise ValueError("cpu mode needs per-thread CPU clocks (Linux)")
+    own_ident = threading.get_ident()
+    folded = Counter()
+    last_cpu = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            weight = 1
+            if mode == "cpu":
+                now_cpu = _thread_cpu_time(ident)
+                previous = last_cpu.get(ident)
+                last_cpu[ident] = now_cpu
+                if now_cpu is None or previous is None:
+                    continue
+                # Weight in microseconds of CPU consumed since the last sample
+                weight = int((now_cpu - previous) * 1_000_000)
+                if weight <= 0:
+                    continue
+            folded[_collapse(frame, names.get(ident, f"thread-{ident}"))] += weight
+        time.sleep(interval)
+    return folded
+
+
+def _memory_report(before, after, limit):
+    diff = after.compare_to(before, "traceback")
+    folded = Counter()
+    top = []
+    for stat in diff:
+        if stat.size_diff <= 0:
+            continue
+        frames = [f"{os.path.basename(f.filename)}:{f.lineno}" for f in stat.traceback]
+        folded[";".join(frames)] += stat.size_diff
+        if len(top) < limit:
+            top.append({
+                "traceback": frames,
+                "size_diff_bytes": stat.size_diff,
+                "count_diff": stat.count_diff,
+            })
+    return {"top_allocations": top, "folded": format_folded(folded)}
+
+
+def format_folded(folded):
+    return "\n".join(f"{stack} {count}" for stack, count in folded.most_common())
+
+
+def run_profile(seconds, mode="wall", interval=0.005, memory=False, memory_top=25, memory_frames=10):
+    """Profile the process for ``seconds``; only one profile may run at a time."""
+    seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    started_tracemalloc = False
+    try:
+        before = None
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(memory_frames)
+                started_tracemalloc = True
+            before = tracemalloc.take_snapshot()
+        folded = sample_stacks(seconds, interval=interval, mode=mode)
+        result = {
+            "mode": mode,
+            "seconds": seconds,
+            "interval": interval,
+            "samples": sum(folded.values()),
+            "folded": format_folded(folded),
+        }
+        if memory:
+            result["memory"] = _memory_report(before, tracemalloc.take_snapshot(), memory_top)
+        return result
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _profile_lock.release()
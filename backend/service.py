@@ -1,124 +1,221 @@
 import os
 import urllib.parse
 import urllib.request
-import feedparser
-import io
 import time
-from PyPDF2 import PdfReader
-from dotenv import load_dotenv
-import openai
 import ssl
+import threading
 import requests
+from collections import OrderedDict
+from json_logging import get_logger
+from tracing import traced
+from lazy import lazy_import
+from clients import environment
+import llm_gateway
+from context_builder import build_summary_context
+from corpus_index import corpus_index, ANONYMOUS
+from document import parse_pdf, document_for_url
+from near_duplicates import near_duplicates
+from usage_ledger import usage_ledger, BudgetExceeded, OK
+from arxiv_ids import parse_arxiv_id
+from paper_repository import paper_repository
+from paper_versions import paper_versions, content_delta, SUMMARY_REFRESH_DELTA, VERSION_DELTA
+from summary_upgrades import summary_upgrades, DONE
+from deadline import RequestAborted, check_deadline, capped_timeout, sleep as deadline_sleep
+from circuit_breaker import ARXIV_API, ARXIV_PDF, CircuitOpenError, pdf_breaker, client_error
+from metrics import (
+    stage_timer, BYTES_DOWNLOADED, CACHE_EVENTS, RETRIES, FALLBACKS
+)
 
-load_dotenv()
+# Heavy modules are imported on first use to keep worker cold starts fast
+feedparser = lazy_import("feedparser")
 
-# Fix SSL context issues for Windows
-try:
-    ssl._create_default_https_context = ssl._create_unverified_context
-except:
-    pass
-
-# Set environment variables to fix SSL issues
-os.environ['PYTHONHTTPSVERIFY'] = '0'
-if 'SSL_CERT_FILE' in os.environ:
-    del os.environ['SSL_CERT_FILE']
-
-# Initialize OpenAI with error handling
-openai_api_key = os.getenv("OPENAI_API_KEY")
-if not openai_api_key:
-    print("[ERROR] OPENAI_API_KEY not found in environment variables")
-    raise ValueError("OPENAI_API_KEY is required")
-
-# Set OpenAI client with proper configuration
-try:
-    client = openai.OpenAI(
-        api_key=openai_api_key,
-        timeout=60.0,  # Increase timeout
-    )
-    print("[INFO] OpenAI client initialized successfully")
-except Exception as e:
-    print(f"[ERROR] Failed to initialize OpenAI client: {e}")
-    client = None
+logger = get_logger(__name__)
 
 headers = {
     "User-Agent": "Mozilla/5.0 (compatible; MyPythonScript/1.0; +https://yourdomain.com)"
 }
 
-def urlopen_with_retry(req, retries=3, delay=2):
-    """Improved urlopen with multiple connection strategies"""
-    url = req.full_url if hasattr(req, 'full_url') else str(req)
-    
-    for attempt in range(retries):
+class BufferedResponse:
+    """Response-like wrapper around bytes that were already read"""
+    def __init__(self, content):
+        self._content = content
+    def read(self):
+        return self._content
+    def decode(self, encoding='utf-8'):
+        return self._content.decode(encoding)
+
+# Upper bound for one urlopen_with_retry call, across every retry and strategy
+ARXIV_API_BUDGET_SECONDS = float(os.getenv("ARXIV_API_BUDGET_SECONDS", "45"))
+
+# Last good body per arXiv API URL, served when the breaker is open or every attempt fails
+_stale_responses = OrderedDict()
+_stale_lock = threading.Lock()
+STALE_RESPONSES_MAX = 256
+
+def _remember_response(url, content):
+    with _stale_lock:
+        _stale_responses[url] = content
+        _stale_responses.move_to_end(url)
+        while len(_stale_responses) > STALE_RESPONSES_MAX:
+            _stale_responses.popitem(last=False)
+
+def _stale_response(url):
+    with _stale_lock:
+        return _stale_responses.get(url)
+
+class _BudgetExhausted(Exception):
+    pass
+
+def _fetch_with_strategies(req, url, attempt, deadline):
+    """Try each connection strategy in turn; every timeout is capped by the breaker and the deadline"""
+    def attempt_timeout():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise _BudgetExhausted("arXiv API time budget exhausted")
+        return capped_timeout(min(ARXIV_API.timeout(), remaining))
+
+    # Strategy 1: Use requests library (most reliable)
+    try:
+        headers_dict = dict(req.headers) if hasattr(req, 'headers') else headers
+        response = requests.get(url, headers=headers_dict, timeout=attempt_timeout(), verify=False)
+        response.raise_for_status()
+        logger.info(f"Connected using requests library (attempt {attempt+1})", extra={"url": url, "strategy": "requests"})
+        BYTES_DOWNLOADED.inc(len(response.content), source="arxiv_api")
+        return response.content
+    except (_BudgetExhausted, RequestAborted):
+        raise
+    except Exception as requests_error:
+        logger.warning(f"Requests failed: {requests_error}", extra={"url": url, "strategy": "requests"})
+        FALLBACKS.inc(kind="urlopen_strategy")
+
+    # Strategy 2: urllib with custom SSL context
+    try:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        response = urllib.request.urlopen(req, timeout=attempt_timeout(), context=ssl_context)
+        logger.info(f"Connected using urllib with SSL context (attempt {attempt+1})", extra={"url": url, "strategy": "urllib_ssl"})
+        return response.read()
+    except (_BudgetExhausted, RequestAborted):
+        raise
+    except Exception as ssl_error:
+        logger.warning(f"urllib with SSL context failed: {ssl_error}", extra={"url": url, "strategy": "urllib_ssl"})
+        FALLBACKS.inc(kind="urlopen_strategy")
+
+    # Strategy 3: Basic urllib
+    try:
+        response = urllib.request.urlopen(req, timeout=attempt_timeout())
+        logger.info(f"Connected using basic urllib (attempt {attempt+1})", extra={"url": url, "strategy": "urllib"})
+        return response.read()
+    except (_BudgetExhausted, RequestAborted):
+        raise
+    except Exception as basic_error:
+        logger.warning(f"Basic urllib failed: {basic_error}", extra={"url": url, "strategy": "urllib"})
+        FALLBACKS.inc(kind="urlopen_strategy")
+
+    # Strategy 4: Try HTTP fallback
+    if url.startswith('https://'):
         try:
-            # Strategy 1: Use requests library (most reliable)
-            try:
-                headers_dict = dict(req.headers) if hasattr(req, 'headers') else headers
-                response = requests.get(url, headers=headers_dict, timeout=30, verify=False)
-                response.raise_for_status()
-                
-                # Create a response-like object for compatibility
-                class MockResponse:
-                    def __init__(self, content):
-                        self._content = content.encode('utf-8')
-                    def read(self):
-                        return self._content
-                    def decode(self, encoding='utf-8'):
-                        return self._content.decode(encoding)
-                
-                print(f"✓ Connected using requests library (attempt {attempt+1})")
-                return MockResponse(response.text)
-            except Exception as requests_error:
-                print(f"Requests failed: {requests_error}")
-            
-            # Strategy 2: urllib with custom SSL context
-            try:
-                ssl_context = ssl.create_default_context()
-                ssl_context.check_hostname = False
-                ssl_context.verify_mode = ssl.CERT_NONE
-                response = urllib.request.urlopen(req, timeout=30, context=ssl_context)
-                print(f"✓ Connected using urllib with SSL context (attempt {attempt+1})")
-                return response
-            except Exception as ssl_error:
-                print(f"urllib with SSL context failed: {ssl_error}")
-            
-            # Strategy 3: Basic urllib
+            http_url = url.replace('https://', 'http://')
+            http_req = urllib.request.Request(http_url, headers=headers)
+            response = urllib.request.urlopen(http_req, timeout=attempt_timeout())
+            logger.info(f"Connected using HTTP fallback (attempt {attempt+1})", extra={"url": url, "strategy": "http"})
+            return response.read()
+        except (_BudgetExhausted, RequestAborted):
+            raise
+        except Exception as http_error:
+            logger.warning(f"HTTP fallback failed: {http_error}", extra={"url": url, "strategy": "http"})
+
+    raise Exception("All connection strategies failed")
+
+@traced("service.urlopen_with_retry")
+def urlopen_with_retry(req, retries=3, delay=2, budget=None):
+    """
+    Improved urlopen with multiple connection strategies.
+
+    Each attempt goes through the arXiv API circuit breaker and uses its
+    adaptive timeout; the whole call never takes longer than ``budget``
+    seconds (ARXIV_API_BUDGET_SECONDS by default). If the breaker is open or
+    every attempt fails, the last good response for the same URL is served.
+    """
+    environment.get()
+    url = req.full_url if hasattr(req, 'full_url') else str(req)
+    deadline = time.monotonic() + (ARXIV_API_BUDGET_SECONDS if budget is None else budget)
+
+    try:
+        for attempt in range(retries):
             try:
-                response = urllib.request.urlopen(req, timeout=30)
-                print(f"✓ Connected using basic urllib (attempt {attempt+1})")
-                return response
-            except Exception as basic_error:
-                print(f"Basic urllib failed: {basic_error}")
-            
-            # Strategy 4: Try HTTP fallback
-            if url.startswith('https://'):
-                try:
-                    http_url = url.replace('https://', 'http://')
-                    http_req = urllib.request.Request(http_url, headers=headers)
-                    response = urllib.request.urlopen(http_req, timeout=30)
-                    print(f"✓ Connected using HTTP fallback (attempt {attempt+1})")
-                    return response
-                except Exception as http_error:
-                    print(f"HTTP fallback failed: {http_error}")
-            
-        except Exception as e:
-            print(f"Error on attempt {attempt+1}/{retries}: {e}")
-            if attempt < retries - 1:
-                print(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-    
-    raise Exception("Failed after retries with all connection strategies")
+                with ARXIV_API.call():
+                    content = _fetch_with_strategies(req, url, attempt, deadline)
+                _remember_response(url, content)
+                return BufferedResponse(content)
+            except (CircuitOpenError, RequestAborted):
+                raise
+            except Exception as e:
+                logger.warning(f"Error on attempt {attempt+1}/{retries}: {e}", extra={"url": url})
+                remaining = deadline - time.monotonic()
+                if attempt < retries - 1 and remaining > 0:
+                    RETRIES.inc(upstream="arxiv_api")
+                    logger.info(f"Retrying in {delay} seconds...")
+                    deadline_sleep(min(delay, remaining))
+                if deadline - time.monotonic() <= 0:
+                    break
+        failure = Exception("Failed after retries with all connection strategies")
+    except CircuitOpenError as open_error:
+        failure = open_error
+
+    stale = _stale_response(url)
+    if stale is not None:
+        logger.warning(f"Serving cached arXiv response: {failure}", extra={"url": url})
+        FALLBACKS.inc(kind="stale_arxiv_response")
+        return BufferedResponse(stale)
+    raise failure
 
 def load_used_papers():
+    """{canonical arXiv id (or the raw line): highest version used, 0 when unknown}"""
     if not os.path.exists("used_papers.txt"):
-        return set()
+        return {}
+    used = {}
     with open("used_papers.txt", "r", encoding="utf-8") as f:
-        return set(line.strip() for line in f.readlines())
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            arxiv_id, version = parse_arxiv_id(line)
+            key = arxiv_id or line
+            used[key] = max(used.get(key, 0), version or 0)
+    return used
+
+def is_used(used_papers, arxiv_id, version):
+    """Already served at this version or later; a newer version counts as new"""
+    return arxiv_id in used_papers and used_papers[arxiv_id] >= (version or 0)
 
 def save_used_paper(paper_id):
     with open("used_papers.txt", "a", encoding="utf-8") as f:
         f.write(paper_id + "\n")
 
+def read_response_body(response, source, chunk_size=64 * 1024):
+    """Read a streamed requests response in chunks, stopping as soon as the request is cancelled"""
+    chunks = []
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        check_deadline()
+        if chunk:
+            chunks.append(chunk)
+            BYTES_DOWNLOADED.inc(len(chunk), source=source)
+    return b"".join(chunks)
+
 def download_pdf_text_from_arxiv(entry):
+    document = download_arxiv_document(entry)
+    return document.text.strip() if document is not None else None
+
+def _versioned_id(entry_id):
+    arxiv_id, version = parse_arxiv_id(entry_id)
+    if not arxiv_id:
+        return entry_id.split("/")[-1]
+    return f"{arxiv_id}v{version}" if version else arxiv_id
+
+def arxiv_pdf_link(entry):
+    """(https PDF link or None, entry id) for a feedparser entry or an entry dict"""
     # ค้นหา pdf link จาก entry.links - try multiple methods
     pdf_link = None
     
@@ -162,17 +259,35 @@ def download_pdf_text_from_arxiv(entry):
     
     # Method 3: Construct PDF link from ArXiv ID
     if not pdf_link and entry_id:
-        arxiv_id = entry_id.split("/")[-1].replace('v', 'v').split('v')[0]  # Clean version numbers
-        pdf_link = f"https://arxiv.org/pdf/{arxiv_id}.pdf"
+        # The exact version we are tracking, so the text matches the entry
+        pdf_link = f"https://arxiv.org/pdf/{_versioned_id(entry_id)}.pdf"
+
+    # Ensure HTTPS
+    if pdf_link and pdf_link.startswith("http://"):
+        pdf_link = "https://" + pdf_link[len("http://"):]
+    return pdf_link, entry_id
 
+@traced("service.download_arxiv_document")
+def download_arxiv_document(entry, known_pages=None):
+    """Download and parse an entry's PDF (``known_pages`` from an earlier version skips unchanged pages)"""
+    environment.get()
+    pdf_link, entry_id = arxiv_pdf_link(entry)
     if not pdf_link:
-        print("[ERROR] No PDF link found")
+        logger.error("No PDF link found")
         return None
 
-    # Ensure HTTPS
-    if pdf_link.startswith("http://"):
-        pdf_link = "https://" + pdf_link[len("http://"):]
+    # Already downloaded and parsed (listing prefetch or an earlier request)
+    document = document_for_url(pdf_link)
+    if document is not None and document.text.strip():
+        return document
+
+    pdf_data = fetch_arxiv_pdf(pdf_link, entry_id)
+    if pdf_data is None:
+        return None
+    return parse_arxiv_pdf(pdf_data, pdf_link, known_pages)
 
+def fetch_arxiv_pdf(pdf_link, entry_id=None):
+    """PDF bytes from ``pdf_link``, falling back to the versioned arXiv link; None if neither is a PDF"""
     # Enhanced headers for better PDF access
     pdf_headers = {
         **headers,
@@ -183,136 +298,215 @@ def download_pdf_text_from_arxiv(entry):
 
     # Try primary PDF link with enhanced error handling
     try:
-        print(f"Trying primary PDF link: {pdf_link}")
-        response = requests.get(pdf_link, headers=pdf_headers, timeout=30, stream=True)
-        response.raise_for_status()
+        logger.info(f"Trying primary PDF link: {pdf_link}")
+        breaker = pdf_breaker(pdf_link)
+        with stage_timer("pdf_download"), breaker.call(neutral=client_error):
+            response = requests.get(pdf_link, headers=pdf_headers, timeout=capped_timeout(breaker.timeout()), stream=True)
+            response.raise_for_status()
+            pdf_data = read_response_body(response, source="arxiv_pdf")
         
         # Verify it's actually a PDF
         content_type = response.headers.get('content-type', '').lower()
-        if 'pdf' not in content_type and len(response.content) < 1000:
+        if 'pdf' not in content_type and len(pdf_data) < 1000:
             raise Exception(f"Invalid content type: {content_type}")
             
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[WARNING] Primary link failed: {e}")
+        logger.warning(f"Primary link failed: {e}")
         # Fallback: try alternative ArXiv PDF URL format
         if entry_id:
-            fallback_id = entry_id.split("/")[-1]
+            fallback_id = _versioned_id(entry_id)
             fallback_link = f"https://arxiv.org/pdf/{fallback_id}.pdf"
-            print(f"Trying fallback: {fallback_link}")
+            logger.info(f"Trying fallback: {fallback_link}")
+            FALLBACKS.inc(kind="pdf_link")
+            RETRIES.inc(upstream="arxiv_pdf")
             try:
-                response = requests.get(fallback_link, headers=pdf_headers, timeout=30, stream=True)
-                response.raise_for_status()
+                with stage_timer("pdf_download"), ARXIV_PDF.call(neutral=client_error):
+                    response = requests.get(fallback_link, headers=pdf_headers, timeout=capped_timeout(ARXIV_PDF.timeout()), stream=True)
+                    response.raise_for_status()
+                    pdf_data = read_response_body(response, source="arxiv_pdf")
                 
                 # Verify fallback PDF
                 content_type = response.headers.get('content-type', '').lower()
-                if 'pdf' not in content_type and len(response.content) < 1000:
+                if 'pdf' not in content_type and len(pdf_data) < 1000:
                     raise Exception(f"Fallback also invalid: {content_type}")
                     
+            except RequestAborted:
+                raise
             except Exception as e2:
-                print(f"[ERROR] Both PDF links failed: {e2}")
+                logger.error(f"Both PDF links failed: {e2}")
                 return None
         else:
-            print("[ERROR] No entry ID available for fallback")
+            logger.error("No entry ID available for fallback")
             return None
 
+    # Validate PDF data
+    if len(pdf_data) < 1000:  # PDF should be at least 1KB
+        logger.error("PDF data too small, likely not a valid PDF")
+        return None
+
+    if not pdf_data.startswith(b'%PDF'):
+        logger.error("Invalid PDF header")
+        return None
+    return pdf_data
+
+def parse_arxiv_pdf(pdf_data, pdf_link, known_pages=None):
+    """Parsed document for downloaded arXiv PDF bytes, or None when no text can be extracted"""
     try:
-        pdf_data = response.content
-        
-        # Validate PDF data
-        if len(pdf_data) < 1000:  # PDF should be at least 1KB
-            print("[ERROR] PDF data too small, likely not a valid PDF")
-            return None
-            
-        if not pdf_data.startswith(b'%PDF'):
-            print("[ERROR] Invalid PDF header")
-            return None
-            
-        pdf_file = io.BytesIO(pdf_data)
-        reader = PdfReader(pdf_file)
+        document = parse_pdf(pdf_data, source="arxiv_pdf", known_pages=known_pages, url=pdf_link)
         
         # Check if PDF has pages
-        if len(reader.pages) == 0:
-            print("[ERROR] PDF has no pages")
+        if document.page_count == 0:
+            logger.error("PDF has no pages")
             return None
 
-        text = ""
-        for page_num, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                if page_text and page_text.strip():
-                    text += page_text + "\n"
-            except Exception as page_error:
-                print(f"[WARNING] Failed to extract text from page {page_num}: {page_error}")
-                continue
+        text = document.text
         
         # Validate extracted text
         if not text.strip():
-            print("[ERROR] No text could be extracted from PDF")
+            logger.error("No text could be extracted from PDF")
             return None
             
         if len(text.strip()) < 100:  # Ensure we have substantial content
-            print("[WARNING] Very little text extracted, might be image-based PDF")
+            logger.warning("Very little text extracted, might be image-based PDF")
             
-        return text.strip()
+        return document
         
+    except RequestAborted:
+        raise
     except Exception as pdf_error:
-        print(f"[ERROR] PDF processing failed: {pdf_error}")
+        logger.error(f"PDF processing failed: {pdf_error}")
         return None
 
 
-def summarize_text_with_gpt(text):
-    try:
-        if not client:
-            raise Exception("OpenAI client not initialized")
-            
-        # Truncate text if it's too long to avoid token limits
-        max_chars = 10000  # Reduced for better reliability
-        if len(text) > max_chars:
-            text = text[:max_chars] + "... [truncated]"
-            
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": (
-                    "You are the professional academic assistant who can summarize the paper and academic document by based on the detail in the research paper and teach a newbie to make them understand clearly. Your job is summarize the text to make a truthful fact of summarize from that document. "
-
-                )},
-                {"role": "user", "content": f"""Summarize this document to get the briefly detail to understand overall in each section. Make sure that it tell a detailed in each sections. Assume that people who read this want to understand the overall detail at a quick look. Please provide meaning of technical word behind like this format "technicalWord [meaning]". Make sure that you didn't ignore or skip any detail in the document that you are going to summarize(image, picture, and diagram). Also, Use ONLY the English language. Don't show text like this "( $g\mu \nu$ ,$G\textGUT$, $SU(5)$, $\nabla_\mu F^\mu \nu_A = J^\nu_A$)" when summary. research paper:\n\n{text}"""}
-            ],
-            max_tokens=1000,  # Reduced for better reliability
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print(f"[ERROR] OpenAI API error: {e}")
-        # Return a fallback summary based on the text content
-        lines = text.split('\n')
-        summary_lines = []
-        
-        # Try to find abstract or introduction
-        abstract_started = False
-        for i, line in enumerate(lines[:50]):  # Check first 50 lines
-            line_clean = line.strip().lower()
-            if 'abstract' in line_clean and len(line_clean) < 20:
-                abstract_started = True
-                continue
-            elif abstract_started and line.strip():
-                if line_clean.startswith(('introduction', '1.', 'keywords', 'key words')):
-                    break
+# Every summary that is not from the LLM starts with this; such summaries are never stored
+FALLBACK_PREFIX = "[AI Summary unavailable"
+BUDGET_REASON = "daily usage budget reached"
+
+def _unavailable(reason):
+    return f"{FALLBACK_PREFIX} - {reason}]"
+
+def _failure_reason(error):
+    """Why an LLM call gave no answer, for the fallback text (and the fallback counter)"""
+    if isinstance(error, BudgetExceeded):
+        return BUDGET_REASON, "budget"
+    logger.error(f"OpenAI API error: {error}")
+    return "API error", None
+
+# summary_tier of a stored or returned summary
+ABSTRACT_TIER = "abstract"
+FULL_TIER = "full"
+
+def _summary_messages(text):
+    # Keep the most useful sections within the token budget instead of a blind character cut
+    context = build_summary_context(text)
+    if context.tokens_saved:
+        logger.info(f"Summary context: {context.tokens} tokens, {context.tokens_saved} saved",
+                    extra={"sections": context.sections})
+    text = context.text
+    return [
+        {"role": "system", "content": (
+            "You are the professional academic assistant who can summarize the paper and academic document by based on the detail in the research paper and teach a newbie to make them understand clearly. Your job is summarize the text to make a truthful fact of summarize from that document. "
+
+        )},
+        {"role": "user", "content": f"""Summarize this document to get the briefly detail to understand overall in each section. Make sure that it tell a detailed in each sections. Assume that people who read this want to understand the overall detail at a quick look. Please provide meaning of technical word behind like this format "technicalWord [meaning]". Make sure that you didn't ignore or skip any detail in the document that you are going to summarize(image, picture, and diagram). Also, Use ONLY the English language. Don't show text like this "( $g\mu \nu$ ,$G\textGUT$, $SU(5)$, $\nabla_\mu F^\mu \nu_A = J^\nu_A$)" when summary. research paper:\n\n{text}"""}
+    ]
+
+def _fallback_summary(text, reason="API error"):
+    # Return a fallback summary based on the text content
+    lines = text.split('\n')
+    summary_lines = []
+    
+    # Try to find abstract or introduction
+    abstract_started = False
+    for i, line in enumerate(lines[:50]):  # Check first 50 lines
+        line_clean = line.strip().lower()
+        if 'abstract' in line_clean and len(line_clean) < 20:
+            abstract_started = True
+            continue
+        elif abstract_started and line.strip():
+            if line_clean.startswith(('introduction', '1.', 'keywords', 'key words')):
+                break
+            summary_lines.append(line.strip())
+            if len(summary_lines) >= 10:  # Limit lines
+                break
+    
+    if not summary_lines:
+        # Fallback to first meaningful lines
+        for line in lines[:30]:
+            if line.strip() and len(line.strip()) > 20:
                 summary_lines.append(line.strip())
-                if len(summary_lines) >= 10:  # Limit lines
+                if len(summary_lines) >= 5:
                     break
-        
-        if not summary_lines:
-            # Fallback to first meaningful lines
-            for line in lines[:30]:
-                if line.strip() and len(line.strip()) > 20:
-                    summary_lines.append(line.strip())
-                    if len(summary_lines) >= 5:
-                        break
-        
-        fallback_summary = ' '.join(summary_lines)[:800] + "..."
-        return f"[AI Summary unavailable - API error] Paper excerpt: {fallback_summary}"
+    
+    fallback_summary = ' '.join(summary_lines)[:800] + "..."
+    return f"{_unavailable(reason)} Paper excerpt: {fallback_summary}"
+
+@traced("service.summarize_text_with_gpt")
+def summarize_text_with_gpt(text, priority=llm_gateway.INTERACTIVE, purpose="summary"):
+    """GPT summary of ``text`` (tokens are billed under ``purpose``), or an excerpt when GPT gives none"""
+    try:
+        check_deadline()
+        with stage_timer("llm"):
+            completion = llm_gateway.gateway.complete(
+                _summary_messages(text),
+                priority=priority,
+                max_tokens=1000,  # Reduced for better reliability
+                temperature=0.3,
+                purpose=purpose,
+            )
+        return completion.text
+    except RequestAborted:
+        raise
+    except Exception as e:
+        reason, kind = _failure_reason(e)
+        FALLBACKS.inc(kind=kind or "llm_excerpt")
+        return _fallback_summary(text, reason)
+
+async def asummarize_text_with_gpt(text, priority=llm_gateway.INTERACTIVE, purpose="summary"):
+    """Async twin of summarize_text_with_gpt for event-loop code: never blocks the loop"""
+    try:
+        check_deadline()
+        with stage_timer("llm"):
+            completion = await llm_gateway.gateway.acomplete(
+                _summary_messages(text),
+                priority=priority,
+                max_tokens=1000,
+                temperature=0.3,
+                purpose=purpose,
+            )
+        return completion.text
+    except RequestAborted:
+        raise
+    except Exception as e:
+        reason, kind = _failure_reason(e)
+        FALLBACKS.inc(kind=kind or "llm_excerpt")
+        return _fallback_summary(text, reason)
+
+@traced("service.summarize_abstract")
+def summarize_abstract(title, abstract):
+    """Quick summary grounded in the arXiv abstract only (seconds instead of the full pipeline)"""
+    try:
+        check_deadline()
+        with stage_timer("llm"):
+            completion = llm_gateway.gateway.complete(
+                [
+                    {"role": "system", "content": "You are the professional academic assistant who explains research papers to newcomers truthfully, using only the information you are given."},
+                    {"role": "user", "content": f"""Summarize this paper for a quick first look, based only on its title and abstract. Explain technical words like this format "technicalWord [meaning]". Use ONLY the English language.\n\nTitle: {title}\n\nAbstract: {abstract}"""},
+                ],
+                priority=llm_gateway.INTERACTIVE,
+                max_tokens=400,
+                temperature=0.3,
+                purpose="abstract",
+            )
+        return completion.text
+    except RequestAborted:
+        raise
+    except Exception as e:
+        reason, kind = _failure_reason(e)
+        FALLBACKS.inc(kind=kind or "llm_abstract")
+        return f"{_unavailable(reason)} Abstract: {abstract}"
 
 def make_bibtex(entry):
     key = entry.id.split('/')[-1]
@@ -321,14 +515,190 @@ def make_bibtex(entry):
     year = entry.published[:4] if hasattr(entry, "published") else "????"
     return f"@article{{{key},\n  title={{ {title} }},\n  author={{ {authors} }},\n  year={{ {year} }},\n  url={{ {entry.id} }}\n}}"
 
-def fetch_and_summarize(query: str):
+def near_duplicate(key, text):
+    """(signature of ``text``, an already-summarized near-duplicate of it or None)"""
+    signature = near_duplicates.signature(text)
+    return signature, near_duplicates.find(signature, exclude=key)
+
+def remember_summary(key, text, summary, signature=None):
+    """Offer a new summary to later near-duplicates of ``text`` (excerpt fallbacks are not worth reusing)"""
+    if summary and not summary.startswith(FALLBACK_PREFIX):
+        near_duplicates.add(key, signature or near_duplicates.signature(text), summary)
+
+def summarize_new_text(key, text, found=None, priority=llm_gateway.INTERACTIVE):
+    """Summary for the text of document ``key``: a near-duplicate's summary when there is one, else GPT's.
+
+    ``found`` is the result of an earlier ``near_duplicate(key, text)``.
+    """
+    signature, duplicate = found or near_duplicate(key, text)
+    if duplicate is not None:
+        logger.info(f"{key} is a near-duplicate of {duplicate.key} (similarity {duplicate.similarity:.2f}), "
+                    f"reusing its summary")
+        usage_ledger.cache_hit("summary")
+        return duplicate.summary
+    summary = summarize_text_with_gpt(text, priority=priority)
+    remember_summary(key, text, summary, signature)
+    return summary
+
+def stored_full_summary(arxiv_id, version):
+    """(stored full-paper summary or None, whether it covers ``version``)"""
+    stored = (paper_repository.get(arxiv_id) if arxiv_id else None) or {}
+    # An abstract-based summary is only a placeholder for the full one
+    summary = stored.get("summary") if stored.get("summary_tier") != ABSTRACT_TIER else None
+    stored_version = stored.get("version")
+    # Rows written before versions were tracked count as current
+    return summary, bool(summary) and (version is None or stored_version is None or stored_version >= version)
+
+def record_version(arxiv_id, version, previous, document, stored_summary):
+    """Remember the pages of this version; returns ``stored_summary`` if too little changed to summarize again"""
+    if arxiv_id:
+        paper_versions.put(arxiv_id, version, document)
+    if previous is None:
+        return None
+    delta = content_delta(previous, document)
+    VERSION_DELTA.observe(delta)
+    logger.info(f"{arxiv_id} v{previous.version} -> v{version}: {delta:.1%} of the text changed, "
+                f"{document.reused_pages}/{document.page_count} pages reused")
+    return stored_summary if stored_summary and delta < SUMMARY_REFRESH_DELTA else None
+
+@traced("service.ingest_arxiv_entry")
+def ingest_arxiv_entry(entry, arxiv_id, version, priority=llm_gateway.INTERACTIVE):
+    """(summary, text) for an arXiv entry, doing only the work its stored state requires.
+
+    Same version already summarized (here or by another instance): the stored
+    summary, with no download. Newer version: unchanged pages are not
+    re-extracted and the stored summary is kept unless enough text changed.
+    ``text`` is None when nothing was downloaded; (None, None) on failure.
+    """
+    stored_summary, current = stored_full_summary(arxiv_id, version)
+    if current:
+        logger.info(f"Using stored summary for {arxiv_id}")
+        usage_ledger.cache_hit("summary")
+        return stored_summary, None
+
+    previous = paper_versions.get(arxiv_id) if arxiv_id else None
+    document = download_arxiv_document(entry, known_pages=previous.known_pages() if previous else None)
+    if document is None:
+        return None, None
+    text = document.text.strip()
+    kept = record_version(arxiv_id, version, previous, document, stored_summary)
+    if kept:
+        return kept, text
+    return summarize_new_text(f"arxiv:{arxiv_id}" if arxiv_id else document.doc_id, text, priority=priority), text
+
+def quick_summary(entry, arxiv_id, version):
+    """(summary, tier, needs_upgrade) without downloading the PDF.
+
+    The stored full-paper summary when it covers ``version``; otherwise the
+    stored or a new abstract-based summary (or the older version's full
+    summary), to be upgraded in the background.
+    """
+    stored = paper_repository.get(arxiv_id) or {}
+    summary = stored.get("summary")
+    if summary and stored.get("summary_tier") != ABSTRACT_TIER:
+        stored_version = stored.get("version")
+        current = version is None or stored_version is None or stored_version >= version
+        usage_ledger.cache_hit("summary")
+        return summary, FULL_TIER, not current
+    if summary:
+        CACHE_EVENTS.inc(cache="abstract_summary", result="hit")
+        usage_ledger.cache_hit("abstract")
+        return summary, ABSTRACT_TIER, True
+    CACHE_EVENTS.inc(cache="abstract_summary", result="miss")
+    return summarize_abstract(entry.title, entry.summary), ABSTRACT_TIER, True
+
+def schedule_summary_upgrade(entry, result):
+    """Store the quick summary, then replace it with the full-paper summary in the background"""
+    arxiv_id, version = result["arxiv_id"], result["version"]
+    if result["summary_tier"] == ABSTRACT_TIER and not result["summary"].startswith(FALLBACK_PREFIX):
+        try:
+            paper_repository.save_summary(result)
+        except Exception as db_error:
+            logger.warning(f"Failed to save abstract summary: {db_error}")
+
+    def upgrade():
+        # Nobody is waiting: the abstract summary already answered the request
+        summary, text = ingest_arxiv_entry(entry, arxiv_id, version, priority=llm_gateway.BACKGROUND)
+        if not summary or summary.startswith(FALLBACK_PREFIX):
+            return None
+        if text:
+            corpus_index.submit(f"arxiv:{arxiv_id}", text=text, title=entry.title, url=result["pdf_link"], source="arxiv")
+        try:
+            paper_repository.save_summary({**result, "summary": summary, "summary_tier": FULL_TIER})
+        except Exception as db_error:
+            logger.warning(f"Failed to save upgraded summary: {db_error}")
+        return summary
+
+    summary_upgrades.submit(arxiv_id, upgrade)
+
+def summary_status(query):
+    """Upgrade state and best available summary for an arXiv id, or None if we know nothing about it"""
+    arxiv_id = parse_arxiv_id(query)[0]
+    if not arxiv_id:
+        return None
+    job = summary_upgrades.status(arxiv_id)
+    row = paper_repository.get(arxiv_id) or {}
+    if job is None and not row.get("summary"):
+        return None
+    if job is not None and job["status"] == DONE:
+        summary, tier = job["summary"], FULL_TIER
+    else:
+        summary, tier = row.get("summary"), row.get("summary_tier") or FULL_TIER
+    return {
+        "arxiv_id": arxiv_id,
+        "status": job["status"] if job is not None else DONE if tier == FULL_TIER else "unknown",
+        "summary_tier": tier if summary else None,
+        "summary": summary,
+        "error": job["error"] if job is not None else None,
+    }
+
+# arXiv accepts this many ids per id_list query
+ARXIV_ID_LIST_BATCH = 100
+
+@traced("service.fetch_arxiv_entries")
+def fetch_arxiv_entries(ids=None, search_query=None, max_results=50, newest_first=False):
+    """Atom entries for explicit arXiv ids (batched ``id_list`` queries) or for an API ``search_query``"""
+    environment.get()
+    base_url = 'https://export.arxiv.org/api/query?'
+    if ids:
+        wanted = list(dict.fromkeys(_versioned_id(value.strip()) for value in ids if value and value.strip()))
+        queries = [{"id_list": ",".join(wanted[offset:offset + ARXIV_ID_LIST_BATCH]), "max_results": ARXIV_ID_LIST_BATCH}
+                   for offset in range(0, len(wanted), ARXIV_ID_LIST_BATCH)]
+    else:
+        queries = [{"search_query": search_query, "start": 0, "max_results": max_results}]
+        if newest_first:
+            queries[0].update(sortBy="submittedDate", sortOrder="descending")
+    entries = []
+    for params in queries:
+        req = urllib.request.Request(base_url + urllib.parse.urlencode(params), headers=headers)
+        with stage_timer("arxiv_search"):
+            data = urlopen_with_retry(req).read().decode('utf-8')
+        # Unknown ids come back as an "Error" entry without an arXiv id
+        entries.extend(entry for entry in feedparser.parse(data).entries if parse_arxiv_id(entry.get("id", ""))[0])
+    return entries
+
+@traced("service.fetch_and_summarize")
+def fetch_and_summarize(query: str, progressive=False):
+    """Find and summarize the first unused paper for ``query``.
+
+    With ``progressive`` an arXiv paper without a stored full summary is
+    answered from its abstract (``summary_tier == "abstract"``) and upgraded
+    in the background; poll ``status_url`` for the full summary.
+    """
+    environment.get()
     try:
         if not query or not query.strip():
             return {"error": "Query cannot be empty"}
+
+        # Near or over the LLM budget: answer from the abstract and skip the background upgrade
+        budget = usage_ledger.current_state()
+        if budget != OK and not progressive:
+            usage_ledger.degrade("abstract_only")
+            progressive = True
         
         # Check if query is a PDF URL
         if query.startswith('http') and 'pdf' in query.lower():
-            print(f"[INFO] Processing direct PDF URL: {query}")
+            logger.info(f"Processing direct PDF URL: {query}")
             return summarize_from_pdf_url(query)
             
         used_papers = load_used_papers()
@@ -339,40 +709,49 @@ def fetch_and_summarize(query: str):
             'max_results': 5  # Further reduced to avoid timeouts
         }
 
-        print(f"[INFO] Searching ArXiv for: {query}")
+        logger.info(f"Searching ArXiv for: {query}")
         url = base_url + urllib.parse.urlencode(params)
         req = urllib.request.Request(url, headers=headers)
         
         try:
-            response = urlopen_with_retry(req)
-            data = response.read().decode('utf-8')
-            feed = feedparser.parse(data)
+            with stage_timer("arxiv_search"):
+                response = urlopen_with_retry(req)
+                data = response.read().decode('utf-8')
+                feed = feedparser.parse(data)
+        except RequestAborted:
+            raise
         except Exception as feed_error:
-            print(f"[ERROR] Failed to fetch from ArXiv: {feed_error}")
+            logger.error(f"Failed to fetch from ArXiv: {feed_error}")
             return {"error": "Failed to connect to ArXiv. Please try again later."}
 
         if not feed.entries:
             return {"error": "No papers found for your query."}
 
-        print(f"[INFO] Found {len(feed.entries)} papers")
+        logger.info(f"Found {len(feed.entries)} papers")
         processed_count = 0
         
         for entry in feed.entries:
             try:
                 paper_id = entry.id
-                if paper_id in used_papers:
-                    print(f"[INFO] Skipping already used paper: {paper_id}")
+                arxiv_id, version = parse_arxiv_id(paper_id)
+                if is_used(used_papers, arxiv_id or paper_id, version):
+                    CACHE_EVENTS.inc(cache="used_papers", result="hit")
+                    logger.info(f"Skipping already used paper: {paper_id}")
                     continue
+                CACHE_EVENTS.inc(cache="used_papers", result="miss")
                 
                 processed_count += 1
-                print(f"[INFO] Processing paper {processed_count}: {entry.title[:100]}...")
+                logger.info(f"Processing paper {processed_count}: {entry.title[:100]}...")
                 
-                text = download_pdf_text_from_arxiv(entry)
-                if not text:
-                    print(f"[WARNING] Could not extract text from {paper_id}")
+                if progressive and arxiv_id and getattr(entry, "summary", None):
+                    summary, tier, needs_upgrade = quick_summary(entry, arxiv_id, version)
+                    text = None
+                else:
+                    summary, text = ingest_arxiv_entry(entry, arxiv_id, version)
+                    tier, needs_upgrade = FULL_TIER, False
+                if not summary:
+                    logger.warning(f"Could not extract text from {paper_id}")
                     continue
-
-                summary = summarize_text_with_gpt(text)
                 bibtex = make_bibtex(entry)
 
                 save_used_paper(paper_id)
@@ -392,74 +771,86 @@ def fetch_and_summarize(query: str):
                     if pdf_link.startswith('http://'):
                         pdf_link = 'https://' + pdf_link[len('http://'):]
                 except Exception as link_error:
-                    print(f"[WARNING] Error extracting PDF link: {link_error}")
+                    logger.warning(f"Error extracting PDF link: {link_error}")
+
+                if text:
+                    corpus_index.submit(f"arxiv:{arxiv_id}" if arxiv_id else paper_id, text=text,
+                                        title=entry.title, url=pdf_link, source="arxiv")
 
                 result = {
+                    "arxiv_id": arxiv_id,
+                    "version": version,
                     "title": entry.title,
                     "authors": ", ".join([author.name for author in entry.authors]) if hasattr(entry, "authors") else "Unknown",
                     "published": entry.published if hasattr(entry, "published") else "Unknown",
                     "pdf_link": pdf_link,
                     "bibtex": bibtex,
-                    "summary": summary
+                    "summary": summary,
+                    "summary_tier": tier,
+                    "status_url": None,
                 }
+                if needs_upgrade and budget == OK:
+                    schedule_summary_upgrade(entry, result)
+                    result["status_url"] = f"/summarize/status/{arxiv_id}"
                 
-                print(f"[INFO] Successfully processed paper: {entry.title[:50]}...")
+                logger.info(f"Successfully processed paper: {entry.title[:50]}...")
                 return result
                 
+            except RequestAborted:
+                raise
             except Exception as entry_error:
-                print(f"[ERROR] Error processing entry: {entry_error}")
+                logger.error(f"Error processing entry: {entry_error}")
                 continue
 
         return {"error": "No suitable papers could be processed (all may have been used before or failed to process)."}
     
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected exception in fetch_and_summarize: {e}")
+        logger.error(f"Unexpected exception in fetch_and_summarize: {e}")
         return {"error": f"Internal server error: {str(e)}"}
 
-def process_uploaded_pdf(file_content, filename):
+@traced("service.process_uploaded_pdf")
+def process_uploaded_pdf(file_content, filename, user_id=None):
     """Process an uploaded PDF file and generate a summary using GPT-4o-mini."""
+    environment.get()
     try:
-        print(f"[INFO] Processing uploaded file: {filename}")
+        logger.info(f"Processing uploaded file: {filename}")
         
         # Validate PDF data
         if len(file_content) < 1000:  # PDF should be at least 1KB
-            print("[ERROR] PDF data too small, likely not a valid PDF")
+            logger.error("PDF data too small, likely not a valid PDF")
             return {"error": "Invalid PDF file (too small)"}
             
         if not file_content.startswith(b'%PDF'):
-            print("[ERROR] Invalid PDF header")
+            logger.error("Invalid PDF header")
             return {"error": "Invalid PDF file format"}
             
         try:
-            pdf_file = io.BytesIO(file_content)
-            reader = PdfReader(pdf_file)
+            document = parse_pdf(file_content, source="upload")
             
             # Check if PDF has pages
-            if len(reader.pages) == 0:
-                print("[ERROR] PDF has no pages")
+            if document.page_count == 0:
+                logger.error("PDF has no pages")
                 return {"error": "PDF has no pages"}
 
-            text = ""
-            for page_num, page in enumerate(reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    if page_text and page_text.strip():
-                        text += page_text + "\n"
-                except Exception as page_error:
-                    print(f"[WARNING] Failed to extract text from page {page_num}: {page_error}")
-                    continue
+            text = document.text
             
             # Validate extracted text
             if not text.strip():
-                print("[ERROR] No text could be extracted from PDF")
+                logger.error("No text could be extracted from PDF")
                 return {"error": "No text could be extracted from PDF"}
                 
             if len(text.strip()) < 100:  # Ensure we have substantial content
-                print("[WARNING] Very little text extracted, might be image-based PDF")
+                logger.warning("Very little text extracted, might be image-based PDF")
                 return {"error": "Very little text could be extracted. The PDF might be image-based."}
                 
-            # Generate summary
-            summary = summarize_text_with_gpt(text)
+            # Uploads stay private to their user (anonymous uploads are never shown in search)
+            corpus_index.submit(document.doc_id, text=text, title=filename.replace('.pdf', ''),
+                                source="upload", owner=user_id or ANONYMOUS)
+
+            # Generate summary (or reuse the one of a paper with nearly the same text)
+            summary = summarize_new_text(document.doc_id, text)
             
             # Create response
             result = {
@@ -470,12 +861,16 @@ def process_uploaded_pdf(file_content, filename):
             
             return result
             
+        except RequestAborted:
+            raise
         except Exception as pdf_error:
-            print(f"[ERROR] PDF processing failed: {pdf_error}")
+            logger.error(f"PDF processing failed: {pdf_error}")
             return {"error": f"PDF processing failed: {str(pdf_error)}"}
             
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected exception in process_uploaded_pdf: {e}")
+        logger.error(f"Unexpected exception in process_uploaded_pdf: {e}")
         return {"error": f"Internal server error: {str(e)}"}
 
 def fetch_all_arxiv_articles(category, max_results=None, start=0):
@@ -490,6 +885,7 @@ def fetch_all_arxiv_articles(category, max_results=None, start=0):
     Returns:
         dict: Contains either articles list or error message
     """
+    environment.get()
     try:
         # Get configuration from environment variables
         base_url = os.getenv("ARXIV_API_BASE_URL", "https://export.arxiv.org/api/query")
@@ -510,23 +906,26 @@ def fetch_all_arxiv_articles(category, max_results=None, start=0):
             'sortOrder': 'descending'
         }
 
-        print(f"[INFO] Fetching ArXiv articles - Category: {category}, Max: {max_results}")
+        logger.info(f"Fetching ArXiv articles - Category: {category}, Max: {max_results}")
         url = base_url + "?" + urllib.parse.urlencode(params)
         req = urllib.request.Request(url, headers=headers)
         
         # Use retry mechanism
         try:
-            response = urlopen_with_retry(req, retries=retry_attempts)
-            data = response.read().decode('utf-8')
-            feed = feedparser.parse(data)
+            with stage_timer("arxiv_listing"):
+                response = urlopen_with_retry(req, retries=retry_attempts)
+                data = response.read().decode('utf-8')
+                feed = feedparser.parse(data)
+        except RequestAborted:
+            raise
         except Exception as feed_error:
-            print(f"[ERROR] Failed to fetch from ArXiv: {feed_error}")
+            logger.error(f"Failed to fetch from ArXiv: {feed_error}")
             return {"error": "Failed to connect to ArXiv API. Please try again later."}
 
         if not feed.entries:
             return {"error": f"No articles found for category: {category}"}
 
-        print(f"[INFO] Found {len(feed.entries)} articles")
+        logger.info(f"Found {len(feed.entries)} articles")
         
         articles = []
         for entry in feed.entries:
@@ -546,7 +945,7 @@ def fetch_all_arxiv_articles(category, max_results=None, start=0):
                     if pdf_link.startswith('http://'):
                         pdf_link = 'https://' + pdf_link[len('http://'):]
                 except Exception as link_error:
-                    print(f"[WARNING] Error extracting PDF link: {link_error}")
+                    logger.warning(f"Error extracting PDF link: {link_error}")
 
                 # Extract categories
                 categories = []
@@ -573,7 +972,7 @@ def fetch_all_arxiv_articles(category, max_results=None, start=0):
                 articles.append(article)
                 
             except Exception as entry_error:
-                print(f"[ERROR] Error processing entry: {entry_error}")
+                logger.error(f"Error processing entry: {entry_error}")
                 continue
 
         result = {
@@ -584,17 +983,21 @@ def fetch_all_arxiv_articles(category, max_results=None, start=0):
             "articles": articles
         }
         
-        print(f"[INFO] Successfully processed {len(articles)} articles")
+        logger.info(f"Successfully processed {len(articles)} articles")
         return result
         
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected exception in fetch_all_arxiv_articles: {e}")
+        logger.error(f"Unexpected exception in fetch_all_arxiv_articles: {e}")
         return {"error": f"Internal server error: {str(e)}"}
 
+@traced("service.fetch_all_arxiv_papers")
 def fetch_all_arxiv_papers(category, max_results=None, start=0):
     """
     ดึงบทความจาก arXiv ตามหมวดหมู่ที่กำหนด (ไม่รวม all category)
     """
+    environment.get()
     try:
         # ใช้ค่าจาก .env
         base_url = os.getenv("ARXIV_API_BASE_URL", "https://export.arxiv.org/api/query")
@@ -615,23 +1018,26 @@ def fetch_all_arxiv_papers(category, max_results=None, start=0):
             'sortOrder': 'descending'
         }
 
-        print(f"[INFO] Fetching {max_results} papers from ArXiv (category: {category})")
+        logger.info(f"Fetching {max_results} papers from ArXiv (category: {category})")
         url = base_url + "?" + urllib.parse.urlencode(params)
         req = urllib.request.Request(url, headers=headers)
         
         try:
-            response = urlopen_with_retry(req, retries=retry_attempts)
-            data = response.read().decode('utf-8')
-            feed = feedparser.parse(data)
+            with stage_timer("arxiv_listing"):
+                response = urlopen_with_retry(req, retries=retry_attempts)
+                data = response.read().decode('utf-8')
+                feed = feedparser.parse(data)
+        except RequestAborted:
+            raise
         except Exception as feed_error:
-            print(f"[ERROR] Failed to fetch from ArXiv: {feed_error}")
+            logger.error(f"Failed to fetch from ArXiv: {feed_error}")
             return {"error": "Failed to connect to ArXiv. Please try again later."}
 
         if not feed.entries:
             return {"error": "No papers found."}
 
         papers = []
-        print(f"[INFO] Found {len(feed.entries)} papers")
+        logger.info(f"Found {len(feed.entries)} papers")
         
         for entry in feed.entries:
             try:
@@ -650,7 +1056,7 @@ def fetch_all_arxiv_papers(category, max_results=None, start=0):
                     if pdf_link.startswith('http://'):
                         pdf_link = 'https://' + pdf_link[len('http://'):]
                 except Exception as link_error:
-                    print(f"[WARNING] Error extracting PDF link: {link_error}")
+                    logger.warning(f"Error extracting PDF link: {link_error}")
 
                 # Create paper object
                 paper = {
@@ -667,7 +1073,7 @@ def fetch_all_arxiv_papers(category, max_results=None, start=0):
                 papers.append(paper)
                 
             except Exception as entry_error:
-                print(f"[ERROR] Error processing entry: {entry_error}")
+                logger.error(f"Error processing entry: {entry_error}")
                 continue
 
         return {
@@ -677,8 +1083,10 @@ def fetch_all_arxiv_papers(category, max_results=None, start=0):
             "max_results": max_results
         }
     
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected exception in fetch_all_arxiv_papers: {e}")
+        logger.error(f"Unexpected exception in fetch_all_arxiv_papers: {e}")
         return {"error": f"Internal server error: {str(e)}"}
 
 def fetch_papers_by_category(categories, max_results_per_category=10):
@@ -698,55 +1106,14 @@ def fetch_papers_by_category(categories, max_results_per_category=10):
         "categories": categories
     }
 
-def extract_pdf_title(reader, fallback_text=None):
-    # Try PDF metadata
-    if reader.metadata and getattr(reader.metadata, 'title', None):
-        meta_title = reader.metadata.title
-        if meta_title and meta_title.strip() and meta_title.lower() != 'untitled':
-            return meta_title.strip()
-    # Try first page (look for a line in quotes or a likely title)
-    if reader.pages:
-        try:
-            first_page = reader.pages[0]
-            text = first_page.extract_text()
-            if text:
-                lines = [line.strip() for line in text.split('\n') if line.strip()]
-                # Heuristic 0: line like 'The research paper titled "..." ...'
-                for line in lines:
-                    if line.lower().startswith('the research paper titled') and '"' in line:
-                        import re
-                        match = re.search(r'the research paper titled ["\']([^"\']{10,})["\']', line, re.IGNORECASE)
-                        if match:
-                            return match.group(1)
-                # Heuristic 1: line in quotes
-                for line in lines:
-                    if (line.startswith('"') and line.endswith('"') or line.startswith("'") and line.endswith("'")) and len(line) > 10:
-                        return line.strip('"').strip("'")
-                # Heuristic 2: line with Title Case and >10 chars
-                for line in lines:
-                    if len(line) > 10 and sum(1 for w in line.split() if w.istitle()) > 1:
-                        return line
-                # Fallback: first non-empty line
-                for line in lines:
-                    if len(line) > 8 and not line.lower().startswith('arxiv'):
-                        return line
-        except Exception:
-            pass
-    # Try fallback_text (e.g. abstract/summary)
-    if fallback_text:
-        import re
-        # Look for The research paper titled "..." or '...'
-        match = re.search(r'the research paper titled ["\']([^"\']{10,})["\']', fallback_text, re.IGNORECASE)
-        if match:
-            return match.group(1)
-    return None
-
+@traced("service.summarize_from_pdf_url")
 def summarize_from_pdf_url(pdf_url: str, abstract_text=None):
     """
     Directly summarize a PDF from a given URL
     """
+    environment.get()
     try:
-        print(f"[INFO] Summarizing PDF from URL: {pdf_url}")
+        logger.info(f"Summarizing PDF from URL: {pdf_url}")
         
         # Ensure HTTPS
         if pdf_url.startswith("http://"):
@@ -760,62 +1127,61 @@ def summarize_from_pdf_url(pdf_url: str, abstract_text=None):
             'Connection': 'keep-alive'
         }
 
+        # Fetched ahead of time (listing prefetch or an earlier request): no download, no extraction
+        document = document_for_url(pdf_url)
+
         # Download PDF
-        try:
-            print(f"[INFO] Downloading PDF from: {pdf_url}")
-            response = requests.get(pdf_url, headers=pdf_headers, timeout=30, stream=True)
-            response.raise_for_status()
+        if document is None:
+            try:
+                logger.info(f"Downloading PDF from: {pdf_url}")
+                breaker = pdf_breaker(pdf_url)
+                with stage_timer("pdf_download"), breaker.call(neutral=client_error):
+                    response = requests.get(pdf_url, headers=pdf_headers, timeout=capped_timeout(breaker.timeout()), stream=True)
+                    response.raise_for_status()
+                    pdf_data = read_response_body(response, source="pdf_url")
             
-            # Verify it's actually a PDF
-            content_type = response.headers.get('content-type', '').lower()
-            if 'pdf' not in content_type and len(response.content) < 1000:
-                return {"error": f"Invalid content type: {content_type}"}
+                # Verify it's actually a PDF
+                content_type = response.headers.get('content-type', '').lower()
+                if 'pdf' not in content_type and len(pdf_data) < 1000:
+                    return {"error": f"Invalid content type: {content_type}"}
                 
-        except Exception as e:
-            print(f"[ERROR] Failed to download PDF: {e}")
-            return {"error": f"Failed to download PDF: {str(e)}"}
+            except RequestAborted:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to download PDF: {e}")
+                return {"error": f"Failed to download PDF: {str(e)}"}
 
         try:
-            pdf_data = response.content
-            
-            # Validate PDF data
-            if len(pdf_data) < 1000:  # PDF should be at least 1KB
-                print("[ERROR] PDF data too small, likely not a valid PDF")
-                return {"error": "PDF data too small, likely not a valid PDF"}
-                
-            if not pdf_data.startswith(b'%PDF'):
-                print("[ERROR] Invalid PDF header")
-                return {"error": "Invalid PDF file format"}
-                
-            pdf_file = io.BytesIO(pdf_data)
-            reader = PdfReader(pdf_file)
+            if document is None:
+                # Validate PDF data
+                if len(pdf_data) < 1000:  # PDF should be at least 1KB
+                    logger.error("PDF data too small, likely not a valid PDF")
+                    return {"error": "PDF data too small, likely not a valid PDF"}
+                    
+                if not pdf_data.startswith(b'%PDF'):
+                    logger.error("Invalid PDF header")
+                    return {"error": "Invalid PDF file format"}
+                    
+                document = parse_pdf(pdf_data, source="pdf_url", url=pdf_url)
             
             # Check if PDF has pages
-            if len(reader.pages) == 0:
-                print("[ERROR] PDF has no pages")
+            if document.page_count == 0:
+                logger.error("PDF has no pages")
                 return {"error": "PDF has no pages"}
 
-            text = ""
-            for page_num, page in enumerate(reader.pages):
-                try:
-                    page_text = page.extract_text()
-                    if page_text and page_text.strip():
-                        text += page_text + "\n"
-                except Exception as page_error:
-                    print(f"[WARNING] Failed to extract text from page {page_num}: {page_error}")
-                    continue
+            text = document.text
             
             # Validate extracted text
             if not text.strip():
-                print("[ERROR] No text could be extracted from PDF")
+                logger.error("No text could be extracted from PDF")
                 return {"error": "No text could be extracted from PDF"}
                 
             if len(text.strip()) < 100:  # Ensure we have substantial content
-                print("[WARNING] Very little text extracted, might be image-based PDF")
+                logger.warning("Very little text extracted, might be image-based PDF")
                 return {"error": "Very little text could be extracted. The PDF might be image-based."}
                 
             # --- Title extraction logic ---
-            title = extract_pdf_title(reader, fallback_text=summary if 'summary' in locals() else None)
+            title = document.title
             if not title:
                 # Try to extract arXiv ID from URL as fallback
                 if 'arxiv.org' in pdf_url:
@@ -826,7 +1192,11 @@ def summarize_from_pdf_url(pdf_url: str, abstract_text=None):
                 if not title:
                     title = "PDF Document"
             # --- End title extraction ---
-            summary = summarize_text_with_gpt(text)
+            found = near_duplicate(document.doc_id, text)
+            # A near-duplicate is already searchable under the key it was indexed with
+            if found[1] is None:
+                corpus_index.submit(document.doc_id, text=text, title=title, url=pdf_url, source="pdf_url")
+            summary = summarize_new_text(document.doc_id, text, found)
             result = {
                 "title": title,
                 "authors": "N/A",  # Cannot extract authors from PDF URL alone
@@ -835,13 +1205,17 @@ def summarize_from_pdf_url(pdf_url: str, abstract_text=None):
                 "bibtex": f"@article{{pdf_summary,\n  title={{ {title} }},\n  url={{ {pdf_url} }}\n}}",
                 "summary": summary
             }
-            print(f"[INFO] Successfully processed PDF from URL")
+            logger.info(f"Successfully processed PDF from URL")
             return result
+        except RequestAborted:
+            raise
         except Exception as pdf_error:
-            print(f"[ERROR] PDF processing failed: {pdf_error}")
+            logger.error(f"PDF processing failed: {pdf_error}")
             return {"error": f"PDF processing failed: {str(pdf_error)}"}
+    except RequestAborted:
+        raise
     except Exception as e:
-        print(f"[ERROR] Unexpected exception in summarize_from_pdf_url: {e}")
+        logger.error(f"Unexpected exception in summarize_from_pdf_url: {e}")
         return {"error": f"Internal server error: {str(e)}"}
 
 
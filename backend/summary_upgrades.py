@@ -0,0 +1,90 @@
+"""
+Background upgrades from abstract-based to full-paper summaries.
+
+``/summarize?progressive=true`` answers right away with a summary of the
+abstract and schedules the full pipeline (download, extraction, GPT) here.
+Jobs are keyed by canonical arXiv id, so a paper is upgraded at most once at
+a time however many users ask for it, and the id doubles as the poll handle
+for ``/summarize/status/{arxiv_id}``. The finished summary replaces the
+abstract one in the ``papers`` table, so other instances see the upgrade too.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from json_logging import get_logger
+from metrics import Counter, Histogram
+
+logger = get_logger(__name__)
+
+SUMMARY_UPGRADE_WORKERS = int(os.getenv("SUMMARY_UPGRADE_WORKERS", "2"))
+# Finished jobs kept for polling; older ones are answered from the papers table
+SUMMARY_UPGRADE_HISTORY = 1000
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+SUMMARY_UPGRADES = Counter(
+    "botchana_summary_upgrades_total",
+    "Abstract-to-full summary upgrades by outcome",
+    ["result"],
+)
+SUMMARY_UPGRADE_DURATION = Histogram(
+    "botchana_summary_upgrade_seconds",
+    "Time from scheduling an upgrade to the full summary being stored",
+)
+
+
+class SummaryUpgrades:
+    def __init__(self, workers=SUMMARY_UPGRADE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._jobs = OrderedDict()  # arxiv_id -> job dict
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="summary-upgrade")
+        return self._executor
+
+    def submit(self, arxiv_id, upgrade):
+        """Run ``upgrade()`` (returns the full summary or None) unless one is already queued for this paper"""
+        with self._lock:
+            job = self._jobs.get(arxiv_id)
+            if job is not None and job["status"] in (PENDING, RUNNING):
+                return job
+            job = self._jobs[arxiv_id] = {"status": PENDING, "scheduled_at": time.time(), "summary": None, "error": None}
+            self._jobs.move_to_end(arxiv_id)
+            self._trim()
+            self._pool().submit(self._run, arxiv_id, job, upgrade)
+        return job
+
+    def _trim(self):
+        finished = [key for key, job in self._jobs.items() if job["status"] in (DONE, FAILED)]
+        for key in finished[:max(0, len(self._jobs) - SUMMARY_UPGRADE_HISTORY)]:
+            del self._jobs[key]
+
+    def _run(self, arxiv_id, job, upgrade):
+        job["status"] = RUNNING
+        started = time.perf_counter()
+        try:
+            summary = upgrade()
+        except Exception as e:
+            logger.error(f"Summary upgrade for {arxiv_id} failed: {e}")
+            summary, job["error"] = None, str(e)
+        job["summary"] = summary
+        job["status"] = DONE if summary else FAILED
+        job["finished_at"] = time.time()
+        SUMMARY_UPGRADES.inc(result=job["status"])
+        if summary:
+            SUMMARY_UPGRADE_DURATION.observe(time.perf_counter() - started)
+            logger.info(f"Upgraded {arxiv_id} to a full-paper summary in {time.perf_counter() - started:.1f}s")
+
+    def status(self, arxiv_id):
+        with self._lock:
+            job = self._jobs.get(arxiv_id)
+            return dict(job) if job is not None else None
+
+
+summary_upgrades = SummaryUpgrades()
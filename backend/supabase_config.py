@@ -1,2 +1,4 @@
-SUPABASE_URL =
-SUPABASE_KEY =
\ No newline at end of file
+import os
+
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
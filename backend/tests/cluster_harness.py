@@ -0,0 +1,233 @@
+"""
+Multi-process cluster harness: runs N uvicorn nodes on this host and checks
+session affinity end to end.
+
+    cd backend && python tests/cluster_harness.py --nodes 3
+
+All nodes are listed in ``CLUSTER_NODES``, but the last one is held back at
+first. The harness then:
+
+1. creates RAG sessions on node 1 (each is born on the node that creates it);
+2. chats about every session through node 2, which has none of them, and
+   checks each call was forwarded to the owner
+   (``botchana_cluster_forwards_total``);
+3. starts the last node and waits until node 1 has handed it the sessions it
+   now owns on the ring (``botchana_cluster_handoffs_total``), then asks it
+   for them directly with forwarding disabled;
+4. stops the last node and checks its sessions are served again through
+   node 2 (node 1 restores them from the shared upload store).
+
+The nodes answer with a stub LLM unless ``--real-llm`` is given (which needs
+``OPENAI_API_KEY``). Supabase is not needed for these endpoints.
+"""
+import argparse
+import asyncio
+import os
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import requests
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+STUB_ANSWER = "The paper studies cats. ### คำอธิบาย งานวิจัยนี้ศึกษาแมว"
+
+
+class _StubCompletions:
+    async def create(self, messages, stream=False, **options):
+        await asyncio.sleep(0.05)
+        usage = SimpleNamespace(prompt_tokens=50, completion_tokens=20)
+        if not stream:
+            return SimpleNamespace(model="stub", usage=usage,
+                                   choices=[SimpleNamespace(message=SimpleNamespace(content=STUB_ANSWER))])
+
+        async def chunks():
+            for word in STUB_ANSWER.split(" "):
+                yield SimpleNamespace(model="stub", usage=None,
+                                      choices=[SimpleNamespace(delta=SimpleNamespace(content=word + " "))])
+            yield SimpleNamespace(model="stub", usage=usage, choices=[])
+        return chunks()
+
+
+def serve(port, real_llm):
+    """Entry point of one node process"""
+    os.chdir(BACKEND)
+    if not real_llm:
+        import llm_gateway
+        stub = SimpleNamespace(chat=SimpleNamespace(completions=_StubCompletions()))
+        llm_gateway.gateway = llm_gateway.LLMGateway(client_factory=lambda: stub)
+    import uvicorn
+    import main
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def make_pdf(pages):
+    """A minimal text PDF (one Helvetica text block per page)"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{3 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>"]
+    font = 3 + 2 * len(pages)
+    for i, lines in enumerate(pages):
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>")
+        body = "BT /F1 10 Tf 14 TL 50 750 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        objects.append(f"<< /Length {len(body)} >>\nstream\n{body}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    out, offsets = "%PDF-1.4\n", []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+class Harness:
+    def __init__(self, nodes, base_port, real_llm, state_dir):
+        self.urls = [f"http://127.0.0.1:{base_port + i}" for i in range(nodes)]
+        self.real_llm = real_llm
+        self.state_dir = state_dir
+        self.secret = secrets.token_hex(16)
+        self.processes = {}
+        self.failures = []
+
+    def env(self, index):
+        env = dict(os.environ)
+        env.update({
+            "CLUSTER_NODES": ",".join(self.urls),
+            "CLUSTER_SELF": self.urls[index],
+            "CLUSTER_SECRET": self.secret,
+            "CLUSTER_HEALTH_INTERVAL": "1",
+            # One host: the nodes share the upload store, like nodes sharing a volume
+            "UPLOAD_STORE_PATH": os.path.join(self.state_dir, "upload_store.sqlite"),
+            "USAGE_PATH": os.path.join(self.state_dir, f"llm_usage-{index}.sqlite"),
+            "NEAR_DUP_PATH": os.path.join(self.state_dir, f"near_duplicates-{index}.sqlite"),
+            "BULK_JOBS_PATH": os.path.join(self.state_dir, f"bulk_jobs-{index}.sqlite"),
+            "PAPER_VERSIONS_PATH": os.path.join(self.state_dir, f"paper_versions-{index}.sqlite"),
+            "ADMISSION_ENABLED": "0",
+            "PRECOMPUTE_ENABLED": "0",
+            "SUPABASE_URL": env.get("SUPABASE_URL") or "http://127.0.0.1:9",
+            "SUPABASE_KEY": env.get("SUPABASE_KEY") or "harness",
+        })
+        return env
+
+    def start(self, index):
+        port = int(self.urls[index].rsplit(":", 1)[1])
+        command = [sys.executable, os.path.abspath(__file__), "--serve", str(port)] + (["--real-llm"] if self.real_llm else [])
+        log = open(os.path.join(self.state_dir, f"node{index + 1}.log"), "wb")
+        self.processes[index] = subprocess.Popen(command, env=self.env(index), cwd=BACKEND, stdout=log, stderr=subprocess.STDOUT)
+        self.wait_healthy(index)
+
+    def stop(self, index):
+        process = self.processes.pop(index)
+        process.terminate()
+        process.wait(timeout=10)
+
+    def stop_all(self):
+        for index in list(self.processes):
+            self.stop(index)
+
+    def wait_healthy(self, index, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.processes[index].poll() is not None:
+                raise RuntimeError(f"node {index + 1} exited; see {self.state_dir}/node{index + 1}.log")
+            try:
+                if requests.get(self.urls[index] + "/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"node {index + 1} did not become healthy")
+
+    def check(self, ok, message):
+        print(f"{'ok  ' if ok else 'FAIL'} {message}")
+        if not ok:
+            self.failures.append(message)
+
+    def chat(self, index, session_id, forwarded=False):
+        headers = {"X-Cluster-Forwarded": "harness"} if forwarded else {}
+        return requests.post(self.urls[index] + "/api/chat_with_rag", headers=headers, timeout=60,
+                             data={"session_id": session_id, "message": "What does the paper study?", "history": "false"})
+
+    def counter(self, index, name):
+        """Value of ``name{result="ok"}`` on a node's /metrics"""
+        text = requests.get(self.urls[index] + "/metrics", timeout=5).text
+        match = re.search(rf'{name}\{{result="ok"\}} (\d+(?:\.\d+)?)', text)
+        return int(float(match.group(1))) if match else 0
+
+    def handoffs(self, index):
+        return self.counter(index, "botchana_cluster_handoffs_total")
+
+    def run(self, sessions):
+        from cluster import HashRing
+
+        last = len(self.urls) - 1
+        for index in range(last):
+            self.start(index)
+        time.sleep(3)  # let the first nodes take the held-back one off their rings
+
+        created = []
+        for n in range(sessions):
+            pdf = make_pdf([[f"Paper {n} studies cats and how they sleep.", "Cats are mammals."] * 20])
+            response = requests.post(self.urls[0] + "/api/create_rag_session", timeout=60,
+                                     files={"pdf": (f"paper{n}.pdf", pdf, "application/pdf")})
+            response.raise_for_status()
+            created.append(response.json()["session_id"])
+        early = HashRing(self.urls[:last])
+        self.check(all(early.node_for(session_id) == self.urls[0] for session_id in created),
+                   f"{sessions} sessions created on node 1 are owned by node 1")
+
+        statuses = [self.chat(1, session_id).status_code for session_id in created]
+        forwards = self.counter(1, "botchana_cluster_forwards_total")
+        self.check(statuses == [200] * sessions and forwards == sessions,
+                   f"node 2 forwarded {forwards} of {sessions} chats to the owner: {statuses}")
+
+        self.start(last)
+        moved = [session_id for session_id in created if HashRing(self.urls).node_for(session_id) == self.urls[last]]
+        deadline = time.time() + 15
+        while self.handoffs(0) < len(moved) and time.time() < deadline:
+            time.sleep(0.5)
+        self.check(self.handoffs(0) == len(moved), f"node 1 handed off {self.handoffs(0)} of the {len(moved)} sessions "
+                                                   f"node {last + 1} now owns")
+        statuses = [self.chat(last, session_id, forwarded=True).status_code for session_id in moved]
+        self.check(statuses == [200] * len(moved), f"node {last + 1} serves its sessions itself: {statuses}")
+
+        self.stop(last)
+        time.sleep(4)  # two missed probes take it off the ring
+        statuses = [self.chat(1, session_id).status_code for session_id in moved]
+        self.check(statuses == [200] * len(moved), f"after node {last + 1} left, its sessions are served again: {statuses}")
+        return not self.failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=8100)
+    parser.add_argument("--sessions", type=int, default=12)
+    parser.add_argument("--real-llm", action="store_true")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.real_llm)
+        return
+    if args.nodes < 3:
+        parser.error("--nodes must be at least 3 (two to forward between, one to join and leave)")
+    state_dir = tempfile.mkdtemp(prefix="botchana-cluster-")
+    harness = Harness(args.nodes, args.base_port, args.real_llm, state_dir)
+    try:
+        passed = harness.run(args.sessions)
+    finally:
+        harness.stop_all()
+    print(f"{'passed' if passed else 'FAILED'}; node logs in {state_dir}")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# Settings are read at import time, so point the SQLite stores somewhere disposable before any backend import
+_STATE_DIR = tempfile.mkdtemp(prefix="botchana-tests-")
+for _name, _file in [("USAGE_PATH", "llm_usage.sqlite"), ("NEAR_DUP_PATH", "near_duplicates.sqlite"),
+                     ("UPLOAD_STORE_PATH", "upload_store.sqlite"), ("BULK_JOBS_PATH", "bulk_jobs.sqlite"),
+                     ("PAPER_VERSIONS_PATH", "paper_versions.sqlite")]:
+    os.environ.setdefault(_name, os.path.join(_STATE_DIR, _file))
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+import admission
+from admission import AdmissionController, Rejected, client_id
+
+
+def scope(headers=(), ip="203.0.113.7"):
+    return {"type": "http", "headers": [(name.encode(), value.encode()) for name, value in headers], "client": (ip, 5000)}
+
+
+@pytest.fixture(autouse=True)
+def known_keys(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_API_KEYS", {"listed-key"})
+    monkeypatch.setattr(admission, "ADMISSION_KEY_QUOTAS", {"quota-key": {"rate": 600}})
+
+
+@pytest.mark.parametrize("headers", [[("x-api-key", "listed-key")], [("authorization", "Bearer quota-key")]])
+def test_known_keys_identify_the_client(headers):
+    client, key = client_id(scope(headers))
+    assert client.startswith("key:") and key == headers[0][1].removeprefix("Bearer ")
+
+
+@pytest.mark.parametrize("headers", [[("x-api-key", "made-up")], [("authorization", "Bearer made-up")], []])
+def test_unknown_keys_fall_back_to_the_ip(headers):
+    assert client_id(scope(headers)) == ("ip:203.0.113.7", None)
+
+
+def test_random_keys_share_one_rate_bucket():
+    controller = AdmissionController(client_rate=60, client_burst=3, client_concurrency=100, capacity=100)
+
+    async def main():
+        for n in range(3):
+            client, key = client_id(scope([("x-api-key", f"random-{n}")]))
+            await controller.acquire(client, 1, key)
+        client, key = client_id(scope([("x-api-key", "random-3")]))
+        with pytest.raises(Rejected) as rejected:
+            await controller.acquire(client, 1, key)
+        return rejected.value
+
+    assert asyncio.run(main()).status == 429
@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from starlette.requests import Request
+
+import chatbot_rag
+import llm_gateway
+from answer_cache import AnswerCache
+
+QUESTION = "What are the main limitations of the proposed method?"
+PARAPHRASE = "What are the main limitation of this proposed methods?"
+ANSWER = {"rag_reply": "It needs labels.", "gpt_reply": "ต้องใช้ข้อมูลที่มี label"}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def cache(clock):
+    return AnswerCache(threshold=0.85, ttl=60, clock=clock)
+
+
+def test_paraphrase_above_threshold_hits(cache):
+    cache.put("paper", QUESTION, ANSWER)
+
+    hit = cache.get("paper", PARAPHRASE)
+    assert hit["rag_reply"] == ANSWER["rag_reply"] and hit["similarity"] >= 0.85
+    assert cache.get("paper", "What are the key limitations of the proposed method?") is None
+    assert cache.get("paper", PARAPHRASE, mode="single") is None
+    assert cache.get("other paper", PARAPHRASE) is None
+
+
+def test_different_table_number_misses(clock):
+    # Low enough that the two questions' cosine alone would pass: only the number check tells them apart
+    cache = AnswerCache(threshold=0.5, ttl=60, clock=clock)
+    cache.put("paper", "What is in table 2?", ANSWER)
+
+    assert cache.get("paper", "What is in table 3?") is None
+    assert cache.get("paper", "what is in table 2") is not None
+
+
+def test_expired_entry_misses(cache, clock):
+    cache.put("paper", QUESTION, ANSWER)
+    clock.now += 59
+    assert cache.get("paper", PARAPHRASE) is not None
+
+    clock.now += 1
+    assert cache.get("paper", PARAPHRASE) is None
+    assert len(cache) == 0
+
+
+class CountingStub:
+    """openai.AsyncOpenAI stand-in that answers every completion with the same text"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, stream=False, **options):
+        self.calls += 1
+        return SimpleNamespace(model="stub", usage=SimpleNamespace(prompt_tokens=40, completion_tokens=5),
+                               choices=[SimpleNamespace(message=SimpleNamespace(content="It needs labels."))])
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = CountingStub()
+    monkeypatch.setattr(llm_gateway, "gateway", llm_gateway.LLMGateway(client_factory=lambda: stub))
+    monkeypatch.setattr(chatbot_rag, "answer_cache", AnswerCache(threshold=0.85, ttl=60))
+    monkeypatch.setitem(chatbot_rag.session_rag_map, "cached", ["The method needs labelled data.", "Table 2 lists results."])
+    return stub
+
+
+def chat(message, no_cache=False, headers=()):
+    request = Request({"type": "http", "method": "POST", "path": "/api/chat_with_rag", "headers": list(headers)})
+    return asyncio.run(chatbot_rag.chat_with_rag(request, session_id="cached", message=message, mode="single",
+                                                 no_cache=no_cache, history=False))
+
+
+def test_chat_serves_paraphrase_from_cache(stub):
+    first = chat(QUESTION)
+    second = chat(PARAPHRASE)
+
+    assert stub.calls == 1
+    assert "cached" not in first and second["cached"] is True
+    assert second["rag_reply"] == first["rag_reply"]
+
+
+def test_chat_bypass_misses(stub):
+    chat(QUESTION)
+    assert "cached" not in chat(QUESTION, no_cache=True)
+    assert "cached" not in chat(QUESTION, headers=[(b"cache-control", b"no-cache")])
+    assert stub.calls == 3
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from starlette.requests import Request
+
+import chatbot_rag
+import llm_gateway
+
+WORDS = ["Cats ", "are ", "mammals ", "per ", "the ", "paper.\n", chatbot_rag.EXPLANATION_MARKER, "\nแมวเป็นสัตว์เลี้ยงลูกด้วยนม"]
+
+
+class StreamingStub:
+    """openai.AsyncOpenAI stand-in that streams one word every 50 ms"""
+
+    def __init__(self):
+        self.finished_at = None
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, stream=False, **options):
+        assert stream
+        return self._chunks()
+
+    async def _chunks(self):
+        for word in WORDS:
+            await asyncio.sleep(0.05)
+            yield SimpleNamespace(model="stub", usage=None,
+                                  choices=[SimpleNamespace(delta=SimpleNamespace(content=word))])
+        yield SimpleNamespace(model="stub", choices=[],
+                              usage=SimpleNamespace(prompt_tokens=40, completion_tokens=len(WORDS)))
+        self.finished_at = time.perf_counter()
+
+
+def _parse(event):
+    name, data = event.strip().split("\n", 1)
+    return name.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+
+def test_stream_sends_tokens_before_completion_then_done(monkeypatch):
+    stub = StreamingStub()
+    monkeypatch.setattr(llm_gateway, "gateway", llm_gateway.LLMGateway(client_factory=lambda: stub))
+    monkeypatch.setitem(chatbot_rag.session_rag_map, "s1", ["Cats are mammals.", "Dogs are too."])
+    request = Request({"type": "http", "method": "POST", "path": "/api/chat_with_rag/stream", "headers": []})
+
+    async def main():
+        response = await chatbot_rag.chat_with_rag_stream(request, session_id="s1", message="Are cats mammals?",
+                                                          no_cache=True, history=False)
+        received = []
+        async for event in response.body_iterator:
+            received.append((time.perf_counter(), *_parse(event)))
+        return received
+
+    received = asyncio.run(main())
+    names = [name for _, name, _ in received]
+    assert names[0] == "token"
+    assert names[-1] == "done" and names.count("done") == 1
+    assert set(names[:-1]) == {"token"}
+    # The first token reached the client while the completion was still being generated
+    assert received[0][0] < stub.finished_at
+    assert "".join(data["text"] for _, name, data in received if name == "token") == "".join(WORDS)
+    done = received[-1][2]
+    assert done["rag_reply"] == "Cats are mammals per the paper."
+    assert done["gpt_reply"] == "แมวเป็นสัตว์เลี้ยงลูกด้วยนม"
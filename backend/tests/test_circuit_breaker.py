@@ -0,0 +1,33 @@
+import pytest
+import requests
+
+from circuit_breaker import CircuitBreaker, CLOSED, OPEN, client_error
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+def fail(breaker, error, times):
+    for _ in range(times):
+        with pytest.raises(type(error)):
+            with breaker.call(neutral=client_error):
+                raise error
+
+
+@pytest.mark.parametrize("status", [400, 403, 404, 410])
+def test_client_errors_do_not_open_the_breaker(status):
+    breaker = CircuitBreaker("pdf:test", failure_threshold=3)
+    fail(breaker, http_error(status), 5)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["consecutive_failures"] == 0
+
+
+@pytest.mark.parametrize("error", [http_error(500), http_error(503), requests.ConnectionError("refused"),
+                                   requests.Timeout("slow")])
+def test_outages_open_the_breaker(error):
+    breaker = CircuitBreaker("pdf:test", failure_threshold=3)
+    fail(breaker, error, 3)
+    assert breaker.state == OPEN
@@ -0,0 +1,147 @@
+import threading
+import uuid
+
+import pytest
+
+import chatbot_rag
+from cluster import Cluster, HashRing, CLUSTER_DOWN_AFTER
+from conversation_memory import conversation_memory
+
+NODES = ["http://10.0.0.1:8000", "http://10.0.0.2:8000", "http://10.0.0.3:8000"]
+KEYS = [str(uuid.UUID(int=n)) for n in range(3000)]
+
+
+def owners(ring):
+    return {key: ring.node_for(key) for key in KEYS}
+
+
+def test_ring_is_deterministic_and_balanced():
+    ring = HashRing(NODES, vnodes=128)
+    assert owners(ring) == owners(HashRing(reversed(NODES), vnodes=128))
+    counts = {node: 0 for node in NODES}
+    for node in owners(ring).values():
+        counts[node] += 1
+    assert min(counts.values()) > len(KEYS) / len(NODES) * 0.7
+
+
+def test_removing_a_node_moves_only_its_keys():
+    ring = HashRing(NODES, vnodes=128)
+    before = owners(ring)
+    ring.remove(NODES[1])
+    after = owners(ring)
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved and all(before[key] == NODES[1] for key in moved)
+    assert NODES[1] not in after.values()
+
+
+def test_adding_a_node_takes_about_its_share():
+    ring = HashRing(NODES[:2], vnodes=128)
+    before = owners(ring)
+    ring.add(NODES[2])
+    after = owners(ring)
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert all(after[key] == NODES[2] for key in moved)
+    assert len(KEYS) / 3 * 0.7 < len(moved) < len(KEYS) / 3 * 1.3
+
+
+class FakeProbe:
+    def __init__(self):
+        self.down = set()
+
+    def __call__(self, node):
+        return node not in self.down
+
+
+def make_cluster(probe=None):
+    return Cluster(nodes=",".join(NODES), self_url=NODES[0], secret="s3cret", vnodes=64, probe=probe or FakeProbe())
+
+
+def test_new_sessions_are_owned_by_the_creating_node():
+    cluster = make_cluster()
+    assert all(cluster.is_local(cluster.new_session_id()) for _ in range(50))
+
+
+def test_node_leaves_the_ring_after_consecutive_failed_probes():
+    probe = FakeProbe()
+    cluster = make_cluster(probe)
+    changes = []
+    cluster.on_change(lambda: changes.append(cluster.ring.nodes))
+    probe.down.add(NODES[2])
+    for _ in range(CLUSTER_DOWN_AFTER - 1):
+        assert cluster.check_members() is False  # one missed probe is not a departure
+    assert cluster.check_members() is True
+    assert changes == [NODES[:2]]
+    probe.down.clear()
+    assert cluster.check_members() is True
+    assert cluster.ring.nodes == NODES
+
+
+def test_mark_down_leaves_the_listeners_to_the_health_thread():
+    cluster = Cluster(nodes=",".join(NODES), self_url=NODES[0], secret="s3cret", vnodes=64, health_interval=60,
+                      probe=FakeProbe())
+    called = threading.Event()
+    callers = []
+    cluster.on_change(lambda: callers.append(threading.current_thread().name) or called.set())
+
+    cluster.mark_down(NODES[1])
+    assert NODES[1] not in cluster.ring.nodes  # off the ring at once
+    assert callers == []  # but nothing slow ran on the caller's thread
+
+    cluster.start()
+    assert called.wait(5)
+    assert callers == ["cluster-health"]
+
+
+@pytest.fixture
+def ring_without_third_node(monkeypatch):
+    probe = FakeProbe()
+    probe.down.add(NODES[2])
+    cluster = make_cluster(probe)
+    for _ in range(CLUSTER_DOWN_AFTER):
+        cluster.check_members()
+    monkeypatch.setattr(chatbot_rag, "cluster", cluster)
+    cluster.on_change(chatbot_rag._hand_off_sessions)
+    return cluster, probe
+
+
+def _seed_sessions(cluster, monkeypatch, count=30):
+    sessions = [cluster.new_session_id() for _ in range(count)]
+    for session_id in sessions:
+        monkeypatch.setitem(chatbot_rag.session_rag_map, session_id, [f"chunk of {session_id}"])
+        monkeypatch.setitem(chatbot_rag.session_hash_map, session_id, f"hash-{session_id}")
+        conversation_memory.restore(session_id, {"summary": "", "turns": [["q", "a"]], "folded": 0})
+    return sessions
+
+
+def test_hand_off_moves_sessions_and_evicts_their_memory(ring_without_third_node, monkeypatch):
+    cluster, probe = ring_without_third_node
+    sessions = _seed_sessions(cluster, monkeypatch)
+    sent = []
+    monkeypatch.setattr(cluster, "hand_off", lambda node, path, payload: sent.append((node, payload)) or True)
+
+    probe.down.clear()
+    assert cluster.check_members() is True  # the listener hands sessions off
+
+    moved = {session_id for session_id in sessions if cluster.owner(session_id) == NODES[2]}
+    assert moved and moved != set(sessions)
+    assert {payload["session_id"] for _, payload in sent} == moved
+    assert all(node == NODES[2] for node, _ in sent)
+    assert all(payload["memory"]["turns"] == [["q", "a"]] for _, payload in sent)
+    for session_id in sessions:
+        kept = session_id not in moved
+        assert (session_id in chatbot_rag.session_rag_map) is kept
+        assert (session_id in chatbot_rag.session_hash_map) is kept
+        assert (session_id in conversation_memory._sessions) is kept
+
+
+def test_failed_hand_off_keeps_the_session(ring_without_third_node, monkeypatch):
+    cluster, probe = ring_without_third_node
+    sessions = _seed_sessions(cluster, monkeypatch)
+    monkeypatch.setattr(cluster, "hand_off", lambda node, path, payload: False)
+
+    probe.down.clear()
+    cluster.check_members()
+
+    for session_id in sessions:
+        assert session_id in chatbot_rag.session_rag_map
+        assert session_id in conversation_memory._sessions
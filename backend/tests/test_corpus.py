@@ -0,0 +1,62 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import admission
+import corpus
+
+HIT = {"paper_id": "arxiv:2401.00001", "title": "Cats", "url": "", "source": "arxiv", "ordinal": 0, "score": 1.0,
+       "text": "Cats are mammals."}
+
+
+@pytest.fixture
+def searches(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_API_KEYS", {"alice-key"})
+    seen = []
+
+    def search(query, k=10, user_id=None, paper_ids=None):
+        seen.append(user_id)
+        return [HIT]
+
+    monkeypatch.setattr(corpus.corpus_index, "search", search)
+    return seen
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(corpus.corpus_router, prefix="/api/corpus")
+    return TestClient(app)
+
+
+def test_search_without_a_key_sees_public_papers_only(client, searches):
+    # A user id in the query string is not an identity
+    response = client.get("/api/corpus/search", params={"q": "cats", "user_id": "key:alice"})
+    assert response.status_code == 200
+    assert searches == [None]
+
+
+def test_search_with_a_known_key_includes_its_uploads(client, searches):
+    client.get("/api/corpus/search", params={"q": "cats"}, headers={"X-API-Key": "alice-key"})
+    client.get("/api/corpus/search", params={"q": "cats"}, headers={"X-API-Key": "guessed-key"})
+    assert searches[0] == admission.client_id({"headers": [(b"x-api-key", b"alice-key")]})[0]
+    assert searches[1] is None
+
+
+def test_chat_ignores_a_user_id_form_field(client, searches, monkeypatch):
+    monkeypatch.setattr(corpus.usage_ledger, "current_state", lambda: corpus.EXHAUSTED)
+    response = client.post("/api/corpus/chat", data={"message": "Are cats mammals?", "user_id": "key:alice"})
+    assert response.status_code == 200
+    assert searches == [None]
+
+
+def test_chat_answers_with_sources_when_the_budget_runs_out_mid_call(client, searches, monkeypatch):
+    async def acomplete(*args, **kwargs):
+        raise corpus.BudgetExceeded("Daily LLM budget reached")
+
+    monkeypatch.setattr(corpus.llm_gateway.gateway, "acomplete", acomplete)
+    response = client.post("/api/corpus/chat", data={"message": "Are cats mammals?"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["degraded"] == "budget"
+    assert body["sources"][0]["text"] == HIT["text"]
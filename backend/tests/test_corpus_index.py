@@ -0,0 +1,35 @@
+import pytest
+
+import corpus_index
+from corpus_index import CorpusIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    return CorpusIndex(str(tmp_path / "index"), shards=1)
+
+
+def test_private_chunks_are_filtered_even_when_they_rank_first(index):
+    for n in range(20):
+        index.add_paper(f"alice:{n}", ["cats cats cats purr and sleep"], owner="key:alice")
+    index.add_paper("arxiv:1", ["cats sleep a lot"])
+    index.add_paper("arxiv:2", ["dogs bark, cats purr"])
+
+    # Alice's uploads fill the over-fetched window, so the shard has to ask again with the owner filter
+    assert {hit["paper_id"] for hit in index.search("cats purr", k=3)} == {"arxiv:1", "arxiv:2"}
+    assert {hit["paper_id"] for hit in index.search("cats purr", k=3, user_id="key:bob")} == {"arxiv:1", "arxiv:2"}
+    assert all(hit["paper_id"].startswith("alice:") for hit in index.search("cats purr", k=3, user_id="key:alice"))
+
+
+def test_common_terms_rank_only_the_newest_matches(index, monkeypatch):
+    monkeypatch.setattr(corpus_index, "POSTING_BUDGET", 5)
+    for n in range(20):
+        index.add_paper(f"arxiv:{n}", [f"cats are mammals, note {n}"])
+    index.add_paper("arxiv:old-rare", ["ocelots are small wild cats"])
+    for n in range(20, 30):
+        index.add_paper(f"arxiv:{n}", [f"cats are mammals, note {n}"])
+
+    hits = index.search("cats", k=10, candidates_per_shard=10)
+    assert {hit["paper_id"] for hit in hits} == {f"arxiv:{n}" for n in range(25, 30)}
+    # A rare term is still ranked over all of its matches
+    assert index.search("ocelots cats", k=1)[0]["paper_id"] == "arxiv:old-rare"
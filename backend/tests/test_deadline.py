@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from deadline import DeadlineMiddleware, current_deadline
+
+SCOPE = {"type": "http", "method": "POST", "path": "/upload-pdf", "headers": []}
+
+
+def test_receive_reads_at_most_one_message_ahead_of_the_app():
+    chunks = 6
+    received = 0
+
+    async def receive():
+        nonlocal received
+        if received == chunks:
+            await asyncio.sleep(3600)  # nothing more until the client goes away
+        received += 1
+        return {"type": "http.request", "body": b"x" * 1024, "more_body": received < chunks}
+
+    ahead = []
+
+    async def app(scope, receive, send):
+        consumed = 0
+        while True:
+            message = await receive()
+            consumed += 1
+            await asyncio.sleep(0.02)  # a slow reader
+            ahead.append(received - consumed)
+            if not message["more_body"]:
+                break
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(DeadlineMiddleware(app)(SCOPE, receive, send))
+    assert [message["type"] for message in sent] == ["http.response.start", "http.response.body"]
+    # One message queued plus the one the pump holds while it waits for room
+    assert max(ahead) <= 2
+
+
+def test_disconnect_after_the_body_cancels_the_app():
+    messages = [{"type": "http.request", "body": b"pdf", "more_body": False}]
+    seen = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def app(scope, receive, send):
+        seen["deadline"] = current_deadline()
+        await receive()
+        try:
+            await asyncio.sleep(5)  # busy when the client leaves
+        except asyncio.CancelledError:
+            seen["cancelled"] = True
+            raise
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    started = time.perf_counter()
+    asyncio.run(DeadlineMiddleware(app)(SCOPE, receive, send))
+    assert time.perf_counter() - started < 1
+    assert seen["deadline"].reason == "client_disconnected"
+    assert sent == []  # nobody to answer
+
+
+def test_disconnect_is_seen_while_the_app_ignores_a_one_message_body():
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    async def app(scope, receive, send):
+        await asyncio.sleep(5)  # never reads the request
+
+    started = time.perf_counter()
+    asyncio.run(DeadlineMiddleware(app)(SCOPE, receive, lambda message: asyncio.sleep(0)))
+    assert time.perf_counter() - started < 1
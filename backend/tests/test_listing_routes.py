@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+import main
+import service
+
+
+def paper(arxiv_id, *categories):
+    return {"id": arxiv_id, "title": arxiv_id, "authors": [], "abstract": "", "published": "", "pdf_link": "",
+            "arxiv_url": f"http://arxiv.org/abs/{arxiv_id}", "categories": list(categories)}
+
+
+def test_arxiv_subjects_groups_papers_by_subject(monkeypatch):
+    listings = {"cs.AI": [paper("2401.00001v1", "cs.AI"), paper("2401.00002v1", "cs.AI", "cs.CV")],
+                "cs.CV": [paper("2401.00003v1", "cs.CV")]}
+    calls = []
+
+    def fetch_all_arxiv_papers(category, max_results=None, start=0):
+        calls.append((category, max_results))
+        return {"papers": listings[category], "total": len(listings[category]), "start": start, "max_results": max_results}
+
+    monkeypatch.setattr(service, "fetch_all_arxiv_papers", fetch_all_arxiv_papers)
+    response = TestClient(main.app).get("/arxiv/subjects", params={"subjects": "cs.AI, cs.CV", "max_results_per_subject": 5})
+
+    assert response.status_code == 200
+    assert calls == [("cs.AI", 5), ("cs.CV", 5)]
+    body = response.json()
+    assert body["total_subjects"] == 2 and body["total_articles"] == 3
+    assert [p["id"] for p in body["results_by_subject"]["cs.AI"]] == ["2401.00001v1", "2401.00002v1"]
+    assert [p["id"] for p in body["results_by_subject"]["cs.CV"]] == ["2401.00002v1", "2401.00003v1"]
+
+
+def test_arxiv_subjects_needs_a_subject():
+    assert TestClient(main.app).get("/arxiv/subjects", params={"subjects": " , "}).status_code == 400
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import llm_gateway
+from circuit_breaker import OPENAI, CLOSED, OPEN, CircuitBreaker
+
+
+class RateLimited(Exception):
+    status_code = 429
+    response = SimpleNamespace(headers={"retry-after-ms": "1"})
+
+
+class StubClient:
+    """Stands in for openai.AsyncOpenAI: sleeps like a slow completion, optionally 429s first."""
+
+    def __init__(self, latency=0.3, rate_limited=0):
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, **options):
+        self.calls += 1
+        if self.calls <= self.rate_limited:
+            raise RateLimited("rate limited")
+        await asyncio.sleep(self.latency)
+        message = SimpleNamespace(content="stub answer")
+        usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], model="stub", usage=usage)
+
+
+def _gateway(client, **kwargs):
+    return llm_gateway.LLMGateway(client_factory=lambda: client, **kwargs)
+
+
+def test_acomplete_keeps_caller_loop_responsive():
+    gateway = _gateway(StubClient(latency=0.3))
+    ticks = []
+
+    async def heartbeat(stop):
+        while not stop.is_set():
+            ticks.append(asyncio.get_running_loop().time())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        stop = asyncio.Event()
+        beat = asyncio.create_task(heartbeat(stop))
+        completion = await gateway.acomplete([{"role": "user", "content": "hi"}], purpose="test")
+        stop.set()
+        await beat
+        return completion
+
+    completion = asyncio.run(main())
+    assert completion.text == "stub answer"
+    # A blocking call would have frozen the heartbeat for the whole 0.3 s
+    assert len(ticks) >= 10
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.15
+
+
+def test_rate_limits_do_not_open_openai_breaker():
+    client = StubClient(latency=0, rate_limited=OPENAI.failure_threshold + 2)
+    gateway = _gateway(client, max_retries=OPENAI.failure_threshold + 3)
+
+    completion = gateway.complete([{"role": "user", "content": "hi"}], purpose="test")
+
+    assert completion.text == "stub answer"
+    assert client.calls == OPENAI.failure_threshold + 3
+    assert OPENAI.state == CLOSED
+    assert OPENAI.snapshot()["consecutive_failures"] == 0
+
+
+def test_breaker_neutral_errors_are_not_failures():
+    breaker = CircuitBreaker("test", failure_threshold=2)
+    for _ in range(3):
+        with pytest.raises(RateLimited):
+            with breaker.call(neutral=llm_gateway._breaker_neutral):
+                raise RateLimited()
+    assert breaker.state == CLOSED
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            with breaker.call(neutral=llm_gateway._breaker_neutral):
+                raise RuntimeError("upstream down")
+    assert breaker.state == OPEN
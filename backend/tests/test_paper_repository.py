@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import pytest
+
+from paper_repository import PaperRepository
+
+
+class StubTable:
+    """Just enough of the PostgREST builder: select().in_().execute(), upsert().execute()"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+        self.writes = []
+
+    def select(self, columns):
+        return self
+
+    def in_(self, column, values):
+        self.queries.append(list(values))
+        self._wanted = values
+        return self
+
+    def upsert(self, row, on_conflict=None):
+        self.writes.append(row)
+        self.rows[row["arxiv_id"]] = dict(row)
+        self._wanted = None
+        return self
+
+    def execute(self):
+        wanted, self._wanted = self._wanted, None
+        return SimpleNamespace(data=[dict(self.rows[i]) for i in wanted or () if i in self.rows])
+
+
+@pytest.fixture
+def table():
+    return StubTable({
+        "2401.00001": {"arxiv_id": "2401.00001", "summary": "first", "summary_tier": "full"},
+        "2401.00002": {"arxiv_id": "2401.00002", "summary": "second", "summary_tier": "full"},
+    })
+
+
+@pytest.fixture
+def repository(table):
+    client = SimpleNamespace(table=lambda name: table)
+    return PaperRepository(client_factory=lambda: client)
+
+
+def test_get_many_is_one_batched_query(repository, table):
+    found = repository.get_many(["2401.00001v2", "https://arxiv.org/abs/2401.00002", "2401.00003", "2401.00001"])
+
+    assert table.queries == [["2401.00001", "2401.00002", "2401.00003"]]
+    assert {i: row["summary"] for i, row in found.items()} == {"2401.00001": "first", "2401.00002": "second"}
+
+
+def test_second_read_is_served_from_the_cache(repository, table):
+    repository.get_many(["2401.00001", "2401.00003"])
+    again = repository.get_many(["2401.00001", "2401.00003"])
+
+    assert len(table.queries) == 1  # the miss is remembered too
+    assert list(again) == ["2401.00001"]
+    assert repository.stored_summary("2401.00001v1") == "first"
+    assert len(table.queries) == 1
+
+
+def test_save_summary_replaces_the_cached_entry(repository, table):
+    assert repository.stored_summary("2401.00003") is None
+    repository.get_many(["2401.00001"])
+
+    repository.save_summary({"arxiv_id": "2401.00003v1", "version": 1, "summary": "third", "authors": ["A", "B"]})
+    repository.save_summary({"arxiv_id": "2401.00001", "summary": "first, revised"})
+
+    assert repository.stored_summary("2401.00003") == "third"
+    assert repository.stored_summary("2401.00001") == "first, revised"
+    assert len(table.queries) == 2  # neither stale entry was served, and no re-read was needed
+    assert table.writes[0]["authors"] == "A, B"
@@ -0,0 +1,139 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import precompute
+from bulk_jobs import PRECOMPUTE_PURPOSE
+from precompute import Precomputer, TOKENS_PER_PAPER
+
+
+def at(day, hour, minute=0):
+    return datetime(2026, 1, day, hour, minute, tzinfo=timezone.utc).timestamp()
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeJobs:
+    def __init__(self):
+        self.created = []
+        self.statuses = {}
+        self.store = SimpleNamespace(job_status=self.statuses.get)
+
+    def create(self, entries, request):
+        job_id = f"job-{len(self.created)}"
+        self.created.append((entries, request))
+        self.statuses[job_id] = "running"
+        return {"job_id": job_id}
+
+    def cancel(self, job_id):
+        self.statuses[job_id] = "cancelled"
+        return True
+
+    def finish(self):
+        for job_id in self.statuses:
+            self.statuses[job_id] = "done"
+
+
+class FakeLedger:
+    def __init__(self):
+        self.used = {}
+
+    def tokens(self, purpose):
+        return self.used.get(purpose, 0)
+
+    def charge(self, tokens):
+        self.used[PRECOMPUTE_PURPOSE] = self.used.get(PRECOMPUTE_PURPOSE, 0) + tokens
+
+
+def fetch_entries(search_query, max_results, newest_first):
+    return [SimpleNamespace(id=f"http://arxiv.org/abs/2601.0000{n}v1") for n in range(3)]
+
+
+@pytest.fixture(autouse=True)
+def nothing_stored(monkeypatch):
+    monkeypatch.setattr(precompute.paper_repository, "get_many", lambda ids: {})
+    monkeypatch.setattr(precompute, "stored_full_summary", lambda arxiv_id, version: (None, False))
+
+
+def precomputer(clock, windows="01:00-06:00", token_budget=10 * TOKENS_PER_PAPER, **kwargs):
+    return Precomputer(categories="cs.AI", windows=windows, token_budget=token_budget, interval=600,
+                       utc_offset=0, clock=clock, fetch_entries=fetch_entries, **kwargs)
+
+
+def test_current_window_same_day():
+    scheduler = precomputer(FakeClock(0))
+    assert scheduler.current_window(at(10, 0, 59)) is None
+    assert scheduler.current_window(at(10, 1)) == datetime(2026, 1, 10, 1, tzinfo=timezone.utc)
+    assert scheduler.current_window(at(10, 5, 59)) == datetime(2026, 1, 10, 1, tzinfo=timezone.utc)
+    assert scheduler.current_window(at(10, 6)) is None
+
+
+def test_current_window_wraps_past_midnight():
+    scheduler = precomputer(FakeClock(0), windows="22:00-02:00")
+    opened = datetime(2026, 1, 10, 22, tzinfo=timezone.utc)
+    assert scheduler.current_window(at(10, 21, 59)) is None
+    assert scheduler.current_window(at(10, 22)) == opened
+    assert scheduler.current_window(at(10, 23, 30)) == opened
+    # After midnight it is still the window that opened the evening before
+    assert scheduler.current_window(at(11, 1, 30)) == opened
+    assert scheduler.current_window(at(11, 2)) is None
+
+
+def test_current_window_uses_local_time():
+    scheduler = Precomputer(windows="01:00-06:00", utc_offset=7, clock=FakeClock(0))
+    # 18:30 UTC is 01:30 the next morning in Bangkok
+    window = scheduler.current_window(at(10, 18, 30))
+    assert window is not None and (window.day, window.hour) == (11, 1)
+    assert scheduler.current_window(at(10, 12)) is None
+
+
+def test_tick_starts_a_job_inside_the_window():
+    clock, jobs = FakeClock(at(10, 0, 30)), FakeJobs()
+    scheduler = precomputer(clock, jobs=jobs, ledger=FakeLedger())
+    assert scheduler.tick() == "outside_window"
+    clock.now = at(10, 1, 10)
+    assert scheduler.tick() == "started"
+    entries, request = jobs.created[0]
+    assert len(entries) == 3 and request["precompute"] is True
+    assert scheduler.tick() == "busy"
+    jobs.finish()
+    assert scheduler.tick() == "waiting"
+
+
+def test_tick_cancels_a_job_when_the_window_closes():
+    clock, jobs = FakeClock(at(10, 5, 50)), FakeJobs()
+    scheduler = precomputer(clock, jobs=jobs, ledger=FakeLedger())
+    assert scheduler.tick() == "started"
+    clock.now = at(10, 6, 1)
+    assert scheduler.tick() == "cancelled"
+    assert jobs.statuses["job-0"] == "cancelled"
+    assert scheduler.tick() == "outside_window"
+
+
+def test_tick_charges_actual_usage_against_the_budget():
+    clock, jobs, ledger = FakeClock(at(10, 1)), FakeJobs(), FakeLedger()
+    scheduler = precomputer(clock, jobs=jobs, ledger=ledger, token_budget=2 * TOKENS_PER_PAPER)
+    assert scheduler.tick() == "started"
+    assert len(jobs.created[0][0]) == 2  # sized by the per-paper upper bound
+    # The job used far less than its upper bound, so there is room for another
+    ledger.charge(TOKENS_PER_PAPER // 2)
+    jobs.finish()
+    clock.now += 601
+    assert scheduler.tick() == "started"
+    assert scheduler.spent() == TOKENS_PER_PAPER // 2
+    # This one used the rest of the window's budget
+    ledger.charge(TOKENS_PER_PAPER + TOKENS_PER_PAPER // 2)
+    jobs.finish()
+    clock.now += 601
+    assert scheduler.tick() == "over_budget"
+    # The next night starts with a fresh budget
+    clock.now = at(11, 1)
+    assert scheduler.tick() == "started"
+    assert scheduler.spent() == 0
@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+import llm_gateway
+import service
+
+
+class RecordingGateway:
+    def __init__(self):
+        self.priorities = []
+
+    def complete(self, messages, priority, **options):
+        self.priorities.append(priority)
+        return SimpleNamespace(text="A summary.")
+
+
+def test_summaries_are_interactive_unless_the_caller_says_otherwise(monkeypatch):
+    gateway = RecordingGateway()
+    monkeypatch.setattr(llm_gateway, "gateway", gateway)
+
+    service.summarize_text_with_gpt("Some paper text.")
+    service.summarize_new_text("doc:priority-test", "Text nobody has summarized before, about priorities.",
+                               found=(None, None), priority=llm_gateway.BACKGROUND)
+
+    assert gateway.priorities == [llm_gateway.INTERACTIVE, llm_gateway.BACKGROUND]
@@ -0,0 +1,110 @@
+"""
+Per-request trace spans.
+
+A request id is bound to a context variable by the HTTP middleware in
+main.py. Because Starlette copies the context into its threadpool, the id
+follows the request through sync endpoints and every function wrapped with
+``traced``. Finished spans are kept in a bounded in-memory store so a single
+slow request can be inspected after the fact.
+"""
+import functools
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_request_id = ContextVar("request_id", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+MAX_TRACES = int(os.getenv("TRACE_STORE_SIZE", "1000"))
+_traces = OrderedDict()
+_traces_lock = threading.Lock()
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def current_span_id():
+    span = _current_span.get()
+    return span["span_id"] if span else None
+
+
+@contextmanager
+def bind_request_id(request_id):
+    """Make ``request_id`` the active trace id for the enclosed block."""
+    token = _request_id.set(request_id)
+    span_token = _current_span.set(None)
+    try:
+        yield request_id
+    finally:
+        _current_span.reset(span_token)
+        _request_id.reset(token)
+
+
+def _record(request_id, span):
+    with _traces_lock:
+        spans = _traces.get(request_id)
+        if spans is None:
+            spans = _traces[request_id] = []
+            while len(_traces) > MAX_TRACES:
+                _traces.popitem(last=False)
+        else:
+            _traces.move_to_end(request_id)
+        spans.append(span)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Record a timed span under the current request id (no-op outside a request)."""
+    request_id = _request_id.get()
+    if request_id is None:
+        yield None
+        return
+    parent = _current_span.get()
+    record = {
+        "name": name,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "thread": threading.current_thread().name,
+        "start": time.time(),
+        "attributes": dict(attributes),
+    }
+    started = time.perf_counter()
+    token = _current_span.set(record)
+    try:
+        yield record
+    except BaseException as exc:
+        record["error"] = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        _current_span.reset(token)
+        record["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        _record(request_id, record)
+
+
+def traced(name=None):
+    """Decorator form of ``span`` for plain functions."""
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_trace(request_id):
+    """Return the finished spans of a request, oldest first, or None if unknown."""
+    with _traces_lock:
+        spans = _traces.get(request_id)
+        return sorted(spans, key=lambda s: s["start"]) if spans is not None else None
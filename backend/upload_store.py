@@ -0,0 +1,158 @@
+"""
+Results of earlier uploads, keyed by the hash of the PDF bytes.
+
+When a class of students uploads the same paper, only the first upload is
+extracted and summarized. Later uploads with the same bytes get the stored
+summary (``/upload-pdf``) or the stored chunks (``/api/create_rag_session``)
+with a single primary-key lookup. The store is one SQLite file
+(``UPLOAD_STORE_PATH``), so it survives restarts and is shared by the
+workers on a host. RAG sessions from a URL also remember which PDF the URL
+served, so a later session for the same URL needs no download at all, and
+each session remembers its PDF and its chat history, so another worker can
+take the session over.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from document import url_key
+from json_logging import get_logger
+from metrics import CACHE_EVENTS
+
+logger = get_logger(__name__)
+
+UPLOAD_STORE_PATH = os.getenv("UPLOAD_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload_store.sqlite"))
+# How long a URL is trusted to still serve the PDF we stored chunks for
+RAG_URL_TTL = float(os.getenv("RAG_URL_TTL", "86400"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    doc_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS rag_chunks (
+    doc_id TEXT PRIMARY KEY,
+    chunks TEXT NOT NULL,
+    chunk_hash TEXT NOT NULL,
+    title TEXT,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS rag_urls (
+    url TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS rag_sessions (
+    session_id TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS rag_memory (
+    session_id TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    turns TEXT NOT NULL,
+    folded INTEGER NOT NULL,
+    updated_at REAL
+);
+"""
+
+
+class UploadStore:
+    def __init__(self, path=UPLOAD_STORE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    init = sqlite3.connect(self.path)
+                    init.execute("PRAGMA journal_mode=WAL")
+                    init.executescript(_SCHEMA)
+                    init.close()
+                    self._initialized = True
+        conn = self._local.conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _lookup(self, kind, sql, *params):
+        try:
+            row = self._conn().execute(sql, params).fetchone()
+        except Exception as e:
+            # A broken store only costs us the shortcut
+            logger.warning(f"Upload store lookup failed: {e}")
+            row = None
+        CACHE_EVENTS.inc(cache=kind, result="hit" if row else "miss")
+        return row
+
+    def _write(self, sql, params):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute(sql, params)
+        except Exception as e:
+            logger.warning(f"Upload store write failed: {e}")
+
+    def get_summary(self, doc_id):
+        row = self._lookup("upload_summary", "SELECT summary FROM summaries WHERE doc_id = ?", doc_id)
+        return row[0] if row else None
+
+    def put_summary(self, doc_id, summary):
+        self._write("INSERT OR REPLACE INTO summaries (doc_id, summary, created_at) VALUES (?, ?, ?)",
+                    (doc_id, summary, time.time()))
+
+    def get_chunks(self, doc_id):
+        """(chunks, chunk content hash, title) stored for a RAG upload, or None"""
+        row = self._lookup("upload_rag", "SELECT chunks, chunk_hash, title FROM rag_chunks WHERE doc_id = ?", doc_id)
+        if not row:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def put_chunks(self, doc_id, chunks, chunk_hash, title=""):
+        self._write("INSERT OR REPLACE INTO rag_chunks (doc_id, chunks, chunk_hash, title, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (doc_id, json.dumps(chunks, ensure_ascii=False), chunk_hash, title, time.time()))
+
+    def doc_id_for_session(self, session_id):
+        """PDF a RAG session was created for, so any worker can restore it from the stored chunks"""
+        row = self._lookup("upload_rag_session", "SELECT doc_id FROM rag_sessions WHERE session_id = ?", session_id)
+        return row[0] if row else None
+
+    def put_session(self, session_id, doc_id):
+        self._write("INSERT OR REPLACE INTO rag_sessions (session_id, doc_id, created_at) VALUES (?, ?, ?)",
+                    (session_id, doc_id, time.time()))
+
+    def get_memory(self, session_id):
+        """Chat history of a session as ``{"summary", "turns", "folded"}``, or None"""
+        row = self._lookup("upload_rag_memory", "SELECT summary, turns, folded FROM rag_memory WHERE session_id = ?", session_id)
+        if not row:
+            return None
+        return {"summary": row[0], "turns": json.loads(row[1]), "folded": row[2]}
+
+    def put_memory(self, session_id, summary, turns, folded):
+        self._write("INSERT OR REPLACE INTO rag_memory (session_id, summary, turns, folded, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, summary, json.dumps(turns, ensure_ascii=False), folded, time.time()))
+
+    def doc_id_for_url(self, url):
+        """Content hash of the PDF last seen at ``url`` (within RAG_URL_TTL), so RAG sessions can skip the download"""
+        row = self._lookup("upload_rag_url", "SELECT doc_id FROM rag_urls WHERE url = ? AND created_at > ?",
+                           url_key(url), time.time() - RAG_URL_TTL)
+        return row[0] if row else None
+
+    def put_url(self, url, doc_id):
+        self._write("INSERT OR REPLACE INTO rag_urls (url, doc_id, created_at) VALUES (?, ?, ?)",
+                    (url_key(url), doc_id, time.time()))
+
+
+upload_store = UploadStore()
@@ -0,0 +1,331 @@
+"""
+Token and cost accounting for LLM calls, with daily budgets.
+
+Every gateway call is recorded with its prompt and completion tokens, model,
+endpoint (route template, or ``background``), user (the admission client id:
+``key:<hash>`` or ``ip:<address>``) and purpose (``summary``, ``rag_answer``,
+``rag_explain`` ...). Answers served from a cache are recorded too, with
+``cache="hit"`` and no tokens. Totals are aggregated in memory and added to
+a SQLite table (``USAGE_PATH``) every ``USAGE_FLUSH_INTERVAL`` seconds, so
+processes sharing the file also share budgets. ``GET /admin/usage`` reports
+them.
+
+Cost uses per-million-token prices per model (``LLM_PRICES``, JSON
+``{"model": [input, output]}``, longest model-name prefix wins). Two daily
+budgets in USD apply (UTC days; 0 turns a budget off):
+
+* ``LLM_DAILY_BUDGET_USD`` for all calls together;
+* ``LLM_USER_DAILY_BUDGET_USD`` for each user.
+
+Past ``LLM_BUDGET_DEGRADE_AT`` of a budget (default 0.8) endpoints switch to
+cheaper modes: abstract-only summaries, single-pass chat. Once a budget is
+spent the gateway refuses new calls with ``BudgetExceeded``, and endpoints
+answer from stored and cached results or plain excerpts instead of failing.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from json_logging import get_logger
+from metrics import Counter
+
+logger = get_logger(__name__)
+
+USAGE_PATH = os.getenv("USAGE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_usage.sqlite"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+LLM_DAILY_BUDGET_USD = float(os.getenv("LLM_DAILY_BUDGET_USD", "0"))
+LLM_USER_DAILY_BUDGET_USD = float(os.getenv("LLM_USER_DAILY_BUDGET_USD", "0"))
+LLM_BUDGET_DEGRADE_AT = float(os.getenv("LLM_BUDGET_DEGRADE_AT", "0.8"))
+# USD per million (prompt, completion) tokens
+DEFAULT_PRICES = {"gpt-4o-mini": (0.15, 0.60), "gpt-4o": (2.50, 10.00)}
+LLM_PRICES = {**DEFAULT_PRICES, **json.loads(os.getenv("LLM_PRICES", "{}"))}
+DEFAULT_PRICE_MODEL = "gpt-4o-mini"
+
+# Budget states, cheapest behaviour last
+OK, DEGRADED, EXHAUSTED = "ok", "degraded", "exhausted"
+BACKGROUND_ENDPOINT = "background"
+
+LLM_COST = Counter(
+    "botchana_llm_cost_usd_total",
+    "Estimated LLM spend by endpoint",
+    ["endpoint"],
+)
+BUDGET_DEGRADATIONS = Counter(
+    "botchana_llm_budget_degradations_total",
+    "Requests served in a cheaper mode because an LLM budget was (nearly) spent",
+    ["mode"],
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_usage (
+    day TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    user TEXT NOT NULL,
+    model TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    cache TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    PRIMARY KEY (day, endpoint, user, model, purpose, cache)
+);
+"""
+_GROUPS = ("endpoint", "user", "model", "purpose", "cache")
+
+
+class BudgetExceeded(Exception):
+    """An LLM budget for today is spent; serve a cheaper answer instead."""
+
+
+@dataclass
+class UsageScope:
+    """Who LLM calls in this context are billed to; the endpoint is read from the ASGI scope once routed"""
+    user: str = None
+    asgi: dict = field(default=None, repr=False)
+
+    @property
+    def endpoint(self):
+        if self.asgi is None:
+            return BACKGROUND_ENDPOINT
+        route = self.asgi.get("route")
+        return getattr(route, "path", None) or self.asgi.get("path", BACKGROUND_ENDPOINT)
+
+
+_scope = ContextVar("usage_scope", default=None)
+
+
+@contextmanager
+def bind_usage(scope):
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+def current_usage():
+    """(endpoint, user) for LLM calls made from this context"""
+    scope = _scope.get()
+    return (scope.endpoint, scope.user) if scope is not None else (BACKGROUND_ENDPOINT, None)
+
+
+class UsageMiddleware:
+    """Pure ASGI middleware binding the client (as admission control identifies it) for usage accounting"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        from admission import client_id
+        with bind_usage(UsageScope(user=client_id(scope)[0], asgi=scope)):
+            await self.app(scope, receive, send)
+
+
+def price_for(model):
+    """(prompt, completion) USD per million tokens"""
+    model = model or DEFAULT_PRICE_MODEL
+    matches = [name for name in LLM_PRICES if model.startswith(name)]
+    return LLM_PRICES[max(matches, key=len)] if matches else LLM_PRICES[DEFAULT_PRICE_MODEL]
+
+
+def usage_day():
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+class UsageLedger:
+    def __init__(self, path=USAGE_PATH, daily_budget=LLM_DAILY_BUDGET_USD, user_budget=LLM_USER_DAILY_BUDGET_USD,
+                 degrade_at=LLM_BUDGET_DEGRADE_AT, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.daily_budget = daily_budget
+        self.user_budget = user_budget
+        self.degrade_at = degrade_at
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # (day, endpoint, user, model, purpose, cache) -> [calls, prompt, completion, cost]
+        self._day = None
+        self._stored = {}  # today's spend already in storage, per user ("" = everyone)
+        self._unflushed = {}  # today's spend not yet flushed, per user ("" = everyone)
+        self._tokens = {}  # tokens this process has recorded, per purpose (not reset daily)
+        self._thread = None
+
+    def _conn(self):
+        """Per-thread connection; SQLite connections must not be shared across threads"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    init = sqlite3.connect(self.path)
+                    init.execute("PRAGMA journal_mode=WAL")
+                    init.executescript(_SCHEMA)
+                    init.close()
+                    self._initialized = True
+        conn = self._local.conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # -- recording -----------------------------------------------------
+
+    def record(self, model, prompt_tokens, completion_tokens, purpose=None, cache="miss", endpoint=None, user=None):
+        """Account one call (or one cache hit); returns its estimated cost in USD"""
+        if endpoint is None:
+            endpoint, user = current_usage()
+        prompt_price, completion_price = price_for(model)
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+        key = (usage_day(), endpoint, user or "", model or "", purpose or "", cache)
+        with self._lock:
+            self._roll_day(key[0])
+            totals = self._pending.setdefault(key, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            totals[3] += cost
+            self._unflushed[""] = self._unflushed.get("", 0.0) + cost
+            self._tokens[purpose] = self._tokens.get(purpose, 0) + prompt_tokens + completion_tokens
+            if user:
+                self._unflushed[user] = self._unflushed.get(user, 0.0) + cost
+        if cost:
+            LLM_COST.inc(cost, endpoint=endpoint)
+        self._ensure_flusher()
+        return cost
+
+    def tokens(self, purpose):
+        """LLM tokens recorded under ``purpose`` by this process since it started"""
+        with self._lock:
+            return self._tokens.get(purpose, 0)
+
+    def cache_hit(self, purpose):
+        """An answer served from a cache or store instead of an LLM call"""
+        self.record(None, 0, 0, purpose=purpose, cache="hit")
+
+    def _roll_day(self, day):
+        # Caller holds _lock
+        if day != self._day:
+            self._day = day
+            self._stored = {}
+            self._unflushed = {}
+
+    # -- budgets -------------------------------------------------------
+
+    def spent(self, user=None):
+        """Today's spend in USD for ``user``, or for everyone"""
+        key = user or ""
+        with self._lock:
+            self._roll_day(usage_day())
+            return self._stored.get(key, 0.0) + self._unflushed.get(key, 0.0)
+
+    def state(self, user=None):
+        """OK, DEGRADED or EXHAUSTED for calls billed to ``user`` (global budget included)"""
+        fractions = []
+        if self.daily_budget > 0:
+            fractions.append(self.spent() / self.daily_budget)
+        if user and self.user_budget > 0:
+            fractions.append(self.spent(user) / self.user_budget)
+        used = max(fractions, default=0.0)
+        if used >= 1:
+            return EXHAUSTED
+        return DEGRADED if used >= self.degrade_at else OK
+
+    def current_state(self):
+        return self.state(current_usage()[1])
+
+    def check(self, user=None):
+        if self.state(user) == EXHAUSTED:
+            raise BudgetExceeded("Daily LLM budget reached")
+
+    def degrade(self, mode):
+        """Count a request that was served in a cheaper mode"""
+        BUDGET_DEGRADATIONS.inc(mode=mode)
+        logger.info(f"LLM budget {self.current_state()}: serving {mode}")
+
+    # -- storage -------------------------------------------------------
+
+    def _ensure_flusher(self):
+        if self._thread is not None or self.flush_interval <= 0:
+            return
+        with self._init_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flushing LLM usage failed: {e}")
+
+    def flush(self):
+        """Add pending totals to storage and reload today's spend (which includes other processes')"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                flushed = dict(self._unflushed)
+            conn = self._conn()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO llm_usage (day, endpoint, user, model, purpose, cache, calls, prompt_tokens, "
+                        "completion_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (day, endpoint, user, model, purpose, cache) DO UPDATE SET "
+                        "calls = calls + excluded.calls, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                        "completion_tokens = completion_tokens + excluded.completion_tokens, cost = cost + excluded.cost",
+                        [key + tuple(totals) for key, totals in pending.items()],
+                    )
+            except Exception:
+                # Keep the totals for the next attempt
+                with self._lock:
+                    for key, totals in pending.items():
+                        merged = self._pending.setdefault(key, [0, 0, 0, 0.0])
+                        for index, value in enumerate(totals):
+                            merged[index] += value
+                raise
+            day = usage_day()
+            rows = conn.execute("SELECT user, SUM(cost) FROM llm_usage WHERE day = ? GROUP BY user", (day,)).fetchall()
+            stored = {user: cost for user, cost in rows if user}
+            stored[""] = sum(cost for _, cost in rows)
+            with self._lock:
+                self._roll_day(day)
+                self._stored = stored
+                # Only what was recorded while we were writing is still unflushed
+                for user, cost in flushed.items():
+                    if user in self._unflushed:
+                        self._unflushed[user] = max(0.0, self._unflushed[user] - cost)
+
+    def report(self, day=None, group_by="endpoint"):
+        """Today's (or ``day``'s) totals grouped by one of endpoint, user, model, purpose, cache"""
+        if group_by not in _GROUPS:
+            raise ValueError(f"group_by must be one of {', '.join(_GROUPS)}")
+        self.flush()
+        rows = self._conn().execute(
+            f"SELECT {group_by}, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost) FROM llm_usage "
+            f"WHERE day = ? GROUP BY {group_by} ORDER BY SUM(cost) DESC",
+            (day or usage_day(),),
+        ).fetchall()
+        return [{group_by: group or None, "calls": calls, "prompt_tokens": prompt, "completion_tokens": completion,
+                 "cost_usd": round(cost, 6)} for group, calls, prompt, completion, cost in rows]
+
+    def snapshot(self):
+        return {"spent_usd": round(self.spent(), 6), "daily_budget_usd": self.daily_budget or None,
+                "user_daily_budget_usd": self.user_budget or None, "state": self.state()}
+
+
+usage_ledger = UsageLedger()